@@ -23,7 +23,7 @@
 			} );
 
 		try {
-			let resp = await fetch( '/api/tracker/mediainfo/', {
+			let resp = await fetch( '/api/tracker/mediainfo/bulk/', {
 				method: 'POST',
 				headers: {
 					Accept: 'application/json',
@@ -47,28 +47,27 @@
 	deletionSubmit.addEventListener( 'click', async () => {
 		const inputs = document.querySelectorAll( '.existing-search-results input[type="checkbox"]' );
 
-		const urls = [ ...inputs ]
+		const ids = [ ...inputs ]
 			.filter( input => input.checked )
 			.map( ( input ) => {
-				return input.getAttribute( 'data-media-api-url' );
+				return input.getAttribute( 'data-media-api-url' ).split( '/' ).filter( part => part ).pop();
 			} );
 
 		try {
-			for ( const url of urls ) {
-				let resp = await fetch( url, {
-					method: 'DELETE',
-					headers: {
-						Accept: 'application/json',
-						'Content-Type': 'application/json',
-						'X-CSRFToken': cookies.getItem( 'csrftoken' )
-					}
-				} );
+			let resp = await fetch( '/api/tracker/mediainfo/bulk/', {
+				method: 'DELETE',
+				headers: {
+					Accept: 'application/json',
+					'Content-Type': 'application/json',
+					'X-CSRFToken': cookies.getItem( 'csrftoken' )
+				},
+				body: JSON.stringify( ids ),
+				credentials: 'same-origin'
+			} );
 
-				if ( resp.status >= 400 ) {
-					window.location.href += 'error/';
-				}
+			if ( resp.status >= 400 ) {
+				window.location.href += 'error/';
 			}
-
 			window.location.href += 'success/';
 		} catch ( err ) {
 			window.location.href += 'error/';
@@ -88,7 +87,12 @@
 	const btnInvertSelection = document.querySelector( '#btn-invert-all' );
 	const radioFindBy = document.querySelectorAll( 'input[name="find-by"]' );
 
-	const existingImages = await ( await fetch( `/api/tracker/mediainfo/?ticket=${ ticketNumber }` ) ).json();
+	let existingImages = [];
+	for ( let url = `/api/tracker/mediainfo/?ticket=${ ticketNumber }&page_size=1000`; url; ) {
+		const page = await ( await fetch( url ) ).json();
+		existingImages = existingImages.concat( page.results );
+		url = page.next;
+	}
 	let existingImageNames = [];
 	for ( const image of existingImages ) {
 		existingImageNames.push( image.page_title );
@@ -0,0 +1,14 @@
+from rest_framework.pagination import CursorPagination
+
+
+class TrackerCursorPagination(CursorPagination):
+    """ Default pagination of the API, newest objects (highest ids) first; cursors stay stable while new objects are added """
+    ordering = '-id'
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+
+class ChangeFeedPagination(TrackerCursorPagination):
+    """ Pages the change feed oldest first, so that clients can follow it by the next link """
+    ordering = 'id'
@@ -0,0 +1,20 @@
+from rest_framework.renderers import JSONRenderer
+
+
+class NDJSONRenderer(JSONRenderer):
+    """
+    Renders one JSON object per line, for bulk pulls (?format=ndjson). Of paginated responses, only results are
+    rendered; the next page is linked in the Link header.
+    """
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if isinstance(data, dict) and 'results' in data:
+            response = (renderer_context or {}).get('response')
+            if response is not None and data.get('next'):
+                response['Link'] = '<%s>; rel="next"' % data['next']
+            data = data['results']
+        if not isinstance(data, list):
+            data = [data]
+        return b''.join(super(NDJSONRenderer, self).render(item) + b'\n' for item in data)
@@ -14,6 +14,7 @@ from .viewsets import (
     ExpeditureViewSet,
     PreexpeditureViewSet,
     ContentTypeViewSet,
+    ChangeLogEntryViewSet,
     LanguagesViewSet
 )
 from rest_framework import routers
@@ -34,4 +35,5 @@ router.register(r'tracker/mediainfo', MediaInfoViewSet)
 router.register(r'tracker/mediainfoold', MediaInfoOldViewSet)
 router.register(r'tracker/expeditures', ExpeditureViewSet)
 router.register(r'tracker/preexpeditures', PreexpeditureViewSet)
+router.register(r'tracker/changes', ChangeLogEntryViewSet)
 router.register(r'tracker/languages', LanguagesViewSet, basename="Languages", )
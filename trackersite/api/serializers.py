@@ -1,64 +1,234 @@
+from urllib.parse import urlparse
 from django.contrib.auth.models import User, Group, Permission
 from tracker.models import Ticket, Topic, Subtopic, Grant, MediaInfo, MediaInfoOld, Expediture, Preexpediture, TrackerProfile, TrackerPreferences
+from tracker.models import ChangeLogEntry
+from tracker.utils import bulk_create_with_ids
+from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import FieldDoesNotExist
+from django.db import transaction
+from django.urls import resolve, Resolver404
 from django.utils.translation import ugettext as _
 from rest_framework import serializers
+from rest_framework.validators import UniqueTogetherValidator
 from tracker.views import TICKET_EXCLUDE_FIELDS
 
 
+class PreloadedRelatedFieldMixin(object):
+    """ Looks related objects up among those loaded at once by BulkListSerializer, before querying them one by one """
+
+    def preloaded(self, pk):
+        return self.context.get('preloaded', {}).get(self.get_queryset().model, {}).get(str(pk))
+
+
+class PreloadedHyperlinkedRelatedField(PreloadedRelatedFieldMixin, serializers.HyperlinkedRelatedField):
+    def get_pk(self, data):
+        try:
+            return resolve(urlparse(data).path).kwargs.get(self.lookup_url_kwarg)
+        except (Resolver404, TypeError, ValueError):
+            return None
+
+    def get_object(self, view_name, view_args, view_kwargs):
+        obj = self.preloaded(view_kwargs.get(self.lookup_url_kwarg)) if self.lookup_field == 'pk' else None
+        if obj is not None:
+            return obj
+        return super(PreloadedHyperlinkedRelatedField, self).get_object(view_name, view_args, view_kwargs)
+
+
+class PreloadedPrimaryKeyRelatedField(PreloadedRelatedFieldMixin, serializers.PrimaryKeyRelatedField):
+    def get_pk(self, data):
+        return data
+
+    def to_internal_value(self, data):
+        obj = self.preloaded(data) if self.pk_field is None else None
+        if obj is not None:
+            return obj
+        return super(PreloadedPrimaryKeyRelatedField, self).to_internal_value(data)
+
+
+class BulkListSerializer(serializers.ListSerializer):
+    """
+    Validates and saves lists of objects at once (see BulkMixin). Objects the items refer to are loaded with one
+    query per relation; for updates, the instance is a dict of objects by (string) id, matched to items by their id.
+    Uniqueness is not validated per item, filter_new can drop duplicates of the whole list instead.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(BulkListSerializer, self).__init__(*args, **kwargs)
+        self.child.validators = [validator for validator in self.child.validators
+                                 if not isinstance(validator, UniqueTogetherValidator)]
+        self.max_length = settings.MAX_NUMBER_OF_ITEMS_IN_BULK
+
+    def to_internal_value(self, data):
+        if isinstance(data, list):
+            self.preload([item for item in data if isinstance(item, dict)])
+        self.validated_instances = []  # instances being updated, in the order of validated items
+        return super(BulkListSerializer, self).to_internal_value(data)
+
+    def preload(self, data):
+        preloaded = self.context.setdefault('preloaded', {})
+        for name, field in self.child.fields.items():
+            if not isinstance(field, PreloadedRelatedFieldMixin) or field.read_only:
+                continue
+            pks = {str(field.get_pk(item[name])) for item in data if item.get(name) is not None}
+            queryset = field.get_queryset()
+            objects = queryset.in_bulk([pk for pk in pks if pk.isdigit()])
+            preloaded.setdefault(queryset.model, {}).update((str(pk), obj) for pk, obj in objects.items())
+
+    def run_child_validation(self, data):
+        if self.instance is None:
+            return super(BulkListSerializer, self).run_child_validation(data)
+        instance = self.instance.get(str(data.get('id'))) if isinstance(data, dict) else None
+        if instance is None:
+            raise serializers.ValidationError({'id': [_('Object with this id does not exist.')]})
+        self.child.instance = instance
+        try:
+            attrs = super(BulkListSerializer, self).run_child_validation(data)
+        finally:
+            self.child.instance = None
+        self.validated_instances.append(instance)
+        return attrs
+
+    def filter_new(self, objects):
+        """ Objects which are to be created out of given (unsaved) ones """
+        return objects
+
+    def create(self, validated_data):
+        model = self.child.Meta.model
+        objects = self.filter_new([model(**attrs) for attrs in validated_data])
+        with transaction.atomic():
+            bulk_create_with_ids(model, objects)
+            ChangeLogEntry.log(model, [obj.id for obj in objects])
+        return objects
+
+    def update(self, instances, validated_data):
+        model = self.child.Meta.model
+        self.changes = []  # (old, new) pairs, for change notifications
+        fields = set()
+        for instance, attrs in zip(self.validated_instances, validated_data):
+            old = model(**{field.attname: getattr(instance, field.attname) for field in model._meta.concrete_fields})
+            for name, value in attrs.items():
+                setattr(instance, name, value)
+            fields.update(attrs)
+            self.changes.append((old, instance))
+        objects = [new for old, new in self.changes]
+        with transaction.atomic():
+            if fields:
+                model.objects.bulk_update(objects, fields)
+            ChangeLogEntry.log(model, [obj.id for obj in objects])
+        return objects
+
+
+class TrackerSerializer(serializers.HyperlinkedModelSerializer):
+    """
+    Serializer supporting sparse representations, driven by query parameters of the request:
+
+    * `fields`: comma separated list of fields to render
+    * `expand`: comma separated list of relations to render as nested objects (see EXPANDED_SERIALIZERS)
+    * `links=false`: relations are rendered as primary keys instead of hyperlinks, `id` replaces `url`
+
+    Only `links` applies to expanded objects as well.
+    """
+
+    def _query_param(self, name):
+        request = self.context.get('request')
+        return request.query_params.get(name) if request is not None else None
+
+    def _query_param_set(self, name):
+        value = self._query_param(name) if self._is_top_level() else None
+        return None if value is None else set(item for item in value.split(',') if item)
+
+    def _is_top_level(self):
+        parent = self.parent
+        if isinstance(parent, serializers.ListSerializer):
+            parent = parent.parent
+        return parent is None
+
+    def _links(self):
+        return self._query_param('links') != 'false'
+
+    def get_default_field_names(self, declared_fields, model_info):
+        if self._links():
+            return super(TrackerSerializer, self).get_default_field_names(declared_fields, model_info)
+        return serializers.ModelSerializer.get_default_field_names(self, declared_fields, model_info)
+
+    def get_field_names(self, declared_fields, info):
+        names = super(TrackerSerializer, self).get_field_names(declared_fields, info)
+        wanted = self._query_param_set('fields')
+        if wanted is not None:
+            names = [name for name in names if name in wanted]
+        return names
+
+    serializer_related_field = PreloadedHyperlinkedRelatedField
+
+    def get_fields(self):
+        if not self._links():
+            self.serializer_related_field = PreloadedPrimaryKeyRelatedField
+        fields = super(TrackerSerializer, self).get_fields()
+        for name in (self._query_param_set('expand') or set()) & set(fields):
+            try:
+                model_field = self.Meta.model._meta.get_field(name)
+            except FieldDoesNotExist:
+                continue
+            if model_field.related_model in EXPANDED_SERIALIZERS and (model_field.many_to_one or model_field.many_to_many):
+                fields[name] = EXPANDED_SERIALIZERS[model_field.related_model](
+                    many=model_field.many_to_many, read_only=True)
+        return fields
+
+
 # Serializers define the API representation.
-class ContentTypeSerializer(serializers.HyperlinkedModelSerializer):
+class ContentTypeSerializer(TrackerSerializer):
     class Meta:
         model = ContentType
         fields = '__all__'
 
 
-class UserSerializerAdmin(serializers.HyperlinkedModelSerializer):
+class UserSerializerAdmin(TrackerSerializer):
     class Meta:
         model = User
         read_only_fields = ('last_login', 'date_joined')
         exclude = ('password', )
 
 
-class UserSerializer(serializers.HyperlinkedModelSerializer):
+class UserSerializer(TrackerSerializer):
     class Meta:
         model = User
         exclude = ('password', 'email', "first_name", "last_name")
 
 
-class TrackerPreferencesSerializer(serializers.HyperlinkedModelSerializer):
+class TrackerPreferencesSerializer(TrackerSerializer):
     class Meta:
         read_only_fields = ('user', )
         fields = '__all__'
         model = TrackerPreferences
 
 
-class TrackerProfileSerializer(serializers.HyperlinkedModelSerializer):
+class TrackerProfileSerializer(TrackerSerializer):
     class Meta:
         read_only_fields = ('mediawiki_username', 'chapter_username', 'user')
         fields = '__all__'
         model = TrackerProfile
 
 
-class GroupSerializer(serializers.HyperlinkedModelSerializer):
+class GroupSerializer(TrackerSerializer):
     class Meta:
         model = Group
         fields = ('id', 'name')
 
 
-class PermissionSerializer(serializers.HyperlinkedModelSerializer):
+class PermissionSerializer(TrackerSerializer):
     class Meta:
         model = Permission
         fields = '__all__'
 
 
-class GrantSerializer(serializers.HyperlinkedModelSerializer):
+class GrantSerializer(TrackerSerializer):
     class Meta:
         model = Grant
         fields = '__all__'
 
 
-class TopicSerializer(serializers.HyperlinkedModelSerializer):
+class TopicSerializer(TrackerSerializer):
     subtopics = serializers.SerializerMethodField()
 
     def get_subtopics(self, Topic):
@@ -76,23 +246,28 @@ class TopicSerializer(serializers.HyperlinkedModelSerializer):
         model = Topic
 
 
-class SubtopicSerializer(serializers.HyperlinkedModelSerializer):
+class SubtopicSerializer(TrackerSerializer):
     class Meta:
         fields = '__all__'
         model = Subtopic
 
 
-class TicketSerializer(serializers.HyperlinkedModelSerializer):
-    state_str = serializers.ReadOnlyField()
+class TicketStateMixin(object):
+    def get_state_str(self, ticket):
+        return ticket.get_state_display()
+
+
+class TicketSerializer(TicketStateMixin, TrackerSerializer):
+    state_str = serializers.SerializerMethodField()
 
     class Meta:
-        read_only_fields = ('media_updated', 'updated', 'created', 'cluster', 'payment_status', 'imported', 'is_completed')
+        read_only_fields = ('media_updated', 'updated', 'created', 'cluster', 'payment_status', 'imported', 'is_completed', 'state')
         exclude = ('cluster', )
         model = Ticket
 
 
-class TicketNoAdminUpdateSerializer(serializers.HyperlinkedModelSerializer):
-    state_str = serializers.ReadOnlyField()
+class TicketNoAdminUpdateSerializer(TicketStateMixin, TrackerSerializer):
+    state_str = serializers.SerializerMethodField()
 
     def validate_deposit(self, deposit):
         if self.instance is None:
@@ -118,7 +293,22 @@ class TicketNoAdminUpdateSerializer(serializers.HyperlinkedModelSerializer):
         model = Ticket
 
 
-class MediaInfoSerializer(serializers.HyperlinkedModelSerializer):
+class MediaInfoListSerializer(BulkListSerializer):
+    def filter_new(self, media):
+        """ Canonicalize titles, leave out media already attached to their ticket (as MediaInfo.save does) """
+        MediaInfo.resolve_pages(media)
+        attached = set(MediaInfo.objects.filter(
+            ticket_id__in={m.ticket_id for m in media}, page_title__in={m.page_title for m in media},
+        ).values_list('ticket_id', 'page_title'))
+        new = []
+        for m in media:
+            if (m.ticket_id, m.page_title) not in attached:
+                attached.add((m.ticket_id, m.page_title))
+                new.append(m)
+        return new
+
+
+class MediaInfoSerializer(TrackerSerializer):
     topic = serializers.SerializerMethodField()
     descriptionurl = serializers.SerializerMethodField()
 
@@ -126,6 +316,9 @@ class MediaInfoSerializer(serializers.HyperlinkedModelSerializer):
         return instance.mediawiki_link()
 
     def get_topic(self, instance):
+        # topic_name is annotated by MediaInfoViewSet
+        if hasattr(instance, 'topic_name'):
+            return instance.topic_name
         return instance.ticket.topic.name
 
     def validate_ticket(self, ticket):
@@ -138,23 +331,25 @@ class MediaInfoSerializer(serializers.HyperlinkedModelSerializer):
 
     class Meta:
         read_only_fields = ('categories', 'width', 'height', 'usages', 'thumb_url')
-        fields = '__all__'
+        exclude = ('synced_hash', )
         model = MediaInfo
+        list_serializer_class = MediaInfoListSerializer
 
 
-class MediaInfoOldSerializer(serializers.HyperlinkedModelSerializer):
+class MediaInfoOldSerializer(TrackerSerializer):
     class Meta:
         fields = '__all__'
         model = MediaInfoOld
 
 
-class ExpeditureAdminSerializer(serializers.HyperlinkedModelSerializer):
+class ExpeditureAdminSerializer(TrackerSerializer):
     class Meta:
         fields = '__all__'
         model = Expediture
+        list_serializer_class = BulkListSerializer
 
 
-class ExpeditureSerializer(serializers.HyperlinkedModelSerializer):
+class ExpeditureSerializer(TrackerSerializer):
 
     def validate_ticket(self, ticket):
         request_user = self.context['request'].user
@@ -168,9 +363,10 @@ class ExpeditureSerializer(serializers.HyperlinkedModelSerializer):
         read_only_fields = ('accounting_info', 'paid')
         fields = '__all__'
         model = Expediture
+        list_serializer_class = BulkListSerializer
 
 
-class PreexpeditureSerializer(serializers.HyperlinkedModelSerializer):
+class PreexpeditureSerializer(TrackerSerializer):
 
     def validate_ticket(self, ticket):
         request_user = self.context['request'].user
@@ -183,3 +379,22 @@ class PreexpeditureSerializer(serializers.HyperlinkedModelSerializer):
     class Meta:
         fields = '__all__'
         model = Preexpediture
+        list_serializer_class = BulkListSerializer
+
+
+class ChangeLogEntrySerializer(serializers.ModelSerializer):
+    seq = serializers.IntegerField(source='id', read_only=True)
+
+    class Meta:
+        fields = ('seq', 'model', 'object_id', 'deleted', 'changed')
+        model = ChangeLogEntry
+
+
+# Serializers of related objects rendered by ?expand=
+EXPANDED_SERIALIZERS = {
+    User: UserSerializer,
+    Grant: GrantSerializer,
+    Topic: TopicSerializer,
+    Subtopic: SubtopicSerializer,
+    Ticket: TicketSerializer,
+}
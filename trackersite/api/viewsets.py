@@ -1,4 +1,7 @@
 from __future__ import absolute_import
+import datetime
+import hashlib
+
 from .serializers import (
     User, UserSerializerAdmin, UserSerializer,
     TrackerProfile, TrackerProfileSerializer,
@@ -14,36 +17,214 @@ from .serializers import (
     Expediture, ExpeditureSerializer, ExpeditureAdminSerializer,
     Preexpediture, PreexpeditureSerializer,
     ContentTypeSerializer,
+    ChangeLogEntry, ChangeLogEntrySerializer,
 )
-from rest_framework import viewsets
+from rest_framework import mixins, viewsets
 from rest_framework import status
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from .pagination import ChangeFeedPagination
 from .permissions import (ReadOnly, CanEditTicketElseReadOnly, CanEditExpedituresElseReadOnly, IsSelfTrackerProfile,
                           IsOwnTrackerPreferences)
 from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import FieldDoesNotExist
 from django.utils.translation import activate
 from django.conf import settings
-from django.db.utils import IntegrityError
+from django.db.models import F
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.http import parse_etags
+from tracker.csvimport import MediaImporter, ExpeditureImporter, PreexpeditureImporter
+from tracker.models import WAIT_NEEDED_ACK_TYPES, TicketSummary, bulk_deletion, notify_media, notify_del_media, \
+    notify_expeditures_changed, notify_expeditures_removed, notify_preexpeditures_changed, notify_preexpeditures_removed
 
 # ViewSets define the view behavior.
 
 
-class ContentTypeViewSet(viewsets.ModelViewSet):
+class ExpandMixin(object):
+    """ Joins or prefetches relations rendered as nested objects (?expand=, see TrackerSerializer) """
+    # what serializers of expanded objects need prefetched
+    expand_prefetch = {
+        Ticket: ('ticketack_set', ),
+        Topic: ('subtopic_set', 'admin'),
+        User: ('groups', 'user_permissions'),
+    }
+
+    def filter_queryset(self, queryset):
+        queryset = super(ExpandMixin, self).filter_queryset(queryset)
+        for name in self.request.query_params.get('expand', '').split(','):
+            try:
+                field = queryset.model._meta.get_field(name)
+            except FieldDoesNotExist:
+                continue
+            if field.many_to_many and field.concrete:
+                queryset = queryset.prefetch_related(name)
+            elif field.many_to_one:
+                queryset = queryset.select_related(name)
+            else:
+                continue
+            queryset = queryset.prefetch_related(
+                *['%s__%s' % (name, lookup) for lookup in self.expand_prefetch.get(field.related_model, ())])
+        return queryset
+
+
+class ChangeTrackingMixin(object):
+    """
+    Lets clients pull only what changed, using the change log (see ChangeLogEntry):
+
+    * `updated_since` (ISO date or datetime) limits the objects to those saved since then; it can go back
+      TRACKER_CHANGE_LOG_RETENTION_DAYS at most, older changes are pruned from the log
+    * responses carry an ETag derived from the last change log entry, If-None-Match is answered by 304 without
+      running the query
+    """
+
+    def filter_queryset(self, queryset):
+        queryset = super(ChangeTrackingMixin, self).filter_queryset(queryset)
+        value = self.request.query_params.get('updated_since')
+        if value is not None:
+            since = parse_datetime(value)
+            if since is None and parse_date(value) is not None:
+                since = datetime.datetime.combine(parse_date(value), datetime.time())
+            if since is None:
+                raise ValidationError({'updated_since': ['Must be an ISO 8601 date or datetime.']})
+            if timezone.is_naive(since):
+                since = timezone.make_aware(since)
+            if since < ChangeLogEntry.retained_since():
+                raise ValidationError({'updated_since': [
+                    'Changes are kept for %d days only, load all objects instead.' % settings.TRACKER_CHANGE_LOG_RETENTION_DAYS]})
+            queryset = queryset.filter(id__in=ChangeLogEntry.objects.filter(
+                model=queryset.model._meta.model_name, changed__gte=since).values('object_id'))
+        return queryset
+
+    def get_etag(self, request):
+        key = '%s|%s|%s|%s|%s' % (
+            ChangeLogEntry.last_seq(), request.get_full_path(), request.user.pk,
+            request.accepted_media_type, request.META.get('HTTP_ACCEPT_LANGUAGE', ''),
+        )
+        return '"%s"' % hashlib.md5(key.encode('utf-8')).hexdigest()
+
+    def with_etag(self, handler, request, *args, **kwargs):
+        etag = self.get_etag(request)
+        if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = handler(request, *args, **kwargs)
+        if response.status_code in (status.HTTP_200_OK, status.HTTP_304_NOT_MODIFIED):
+            response['ETag'] = etag
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.with_etag(super(ChangeTrackingMixin, self).list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.with_etag(super(ChangeTrackingMixin, self).retrieve, request, *args, **kwargs)
+
+
+class BulkMixin(object):
+    """
+    Endpoint /bulk/ creating (POST, list of objects), updating (PATCH, list of objects with their ids) or deleting
+    (DELETE, list of ids) many ticket items at once. Whole lists are validated first (see BulkListSerializer), then
+    written in one transaction together with what signal receivers would have done for each object, which is done in
+    one pass. Background jobs are scheduled once the transaction commits.
+    """
+    bulk_importer = None  # CSV importer finishing created objects, see tracker.csvimport
+
+    @action(detail=False, methods=['post', 'patch', 'delete'])
+    def bulk(self, request):
+        if not isinstance(request.data, list):
+            raise ValidationError({api_settings.NON_FIELD_ERRORS_KEY: ['Expected a list of items.']})
+        if request.method == 'POST':
+            return self.bulk_create(request)
+        if request.method == 'PATCH':
+            return self.bulk_partial_update(request)
+        return self.bulk_destroy(request)
+
+    def get_bulk_objects(self, ids):
+        """ Objects of given ids, by (string) id, which the user may change """
+        ids = [str(pk) for pk in ids]
+        # requested_user is what permissions check
+        objects = self.get_queryset().select_related('ticket__requested_user').in_bulk([pk for pk in ids if pk.isdigit()])
+        for obj in objects.values():
+            self.check_object_permissions(self.request, obj)
+        return {str(pk): obj for pk, obj in objects.items()}
+
+    def bulk_create(self, request):
+        serializer = self.get_serializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        with transaction.atomic():
+            self.bulk_created(serializer.save())
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+    def bulk_created(self, objects):
+        self.bulk_importer(self.request.user).finish(objects)
+
+    def bulk_partial_update(self, request):
+        instances = self.get_bulk_objects(item.get('id') for item in request.data if isinstance(item, dict))
+        tickets = {obj.ticket_id: obj.ticket for obj in instances.values()}
+        serializer = self.get_serializer(instances, data=request.data, many=True, partial=True)
+        serializer.is_valid(raise_exception=True)
+        with transaction.atomic():
+            objects = serializer.save()
+            tickets.update((obj.ticket_id, obj.ticket) for obj in objects)
+            self.bulk_updated(serializer.changes, tickets)
+        return Response(serializer.data)
+
+    def bulk_updated(self, changes, tickets):
+        """
+        Finish updated objects, given as (old, new) pairs; tickets (by id) are those they belong to, now or before
+        the update
+        """
+        TicketSummary.rebuild(ticket_ids=tickets.keys())
+        for ticket in tickets.values():
+            ticket.flush_cache()
+
+    def bulk_destroy(self, request):
+        objects = self.get_bulk_objects(request.data)
+        missing = [str(pk) for pk in request.data if str(pk) not in objects]
+        if missing:
+            raise ValidationError({api_settings.NON_FIELD_ERRORS_KEY: [
+                'Objects with ids %s do not exist.' % ', '.join(missing)]})
+        objects = list(objects.values())
+        model = self.get_queryset().model
+        ids = [obj.id for obj in objects]
+        with transaction.atomic():
+            # what post_delete receivers would do for every object is done in bulk_destroyed
+            with bulk_deletion():
+                model.objects.filter(id__in=ids).delete()
+            self.bulk_destroyed(objects)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    def bulk_destroyed(self, objects):
+        """ Finish deleted objects """
+        ChangeLogEntry.log(self.get_queryset().model, [obj.id for obj in objects], deleted=True)
+        tickets = {obj.ticket_id: obj.ticket for obj in objects}
+        TicketSummary.rebuild(ticket_ids=tickets.keys())
+        for ticket in tickets.values():
+            ticket.flush_cache()
+
+
+class ContentTypeViewSet(ExpandMixin, viewsets.ModelViewSet):
     queryset = ContentType.objects.all()
     serializer_class = ContentTypeSerializer
     permission_classes = (ReadOnly, )
+    pagination_class = None
 
 
-class UserViewSet(viewsets.ModelViewSet):
+class UserViewSet(ExpandMixin, viewsets.ModelViewSet):
     queryset = User.objects.none()
     filter_fields = ('is_active', 'is_staff', 'is_superuser')
     search_fields = ('first_name', 'last_name', 'username', 'email')
+    pagination_class = None  # all users are loaded for @mentions in comments
 
     def get_queryset(self):
+        users = User.objects.prefetch_related('groups', 'user_permissions')
         if self.request.user and self.request.user.is_staff:
-            return User.objects.all()
+            return users
         else:
-            return User.objects.filter(is_active=True)
+            return users.filter(is_active=True)
 
     def get_object(self):
         pk = self.kwargs.get('pk')
@@ -60,17 +241,18 @@ class UserViewSet(viewsets.ModelViewSet):
             return UserSerializer
 
 
-class TrackerPreferencesViewSet(viewsets.ModelViewSet):
+class TrackerPreferencesViewSet(ExpandMixin, viewsets.ModelViewSet):
     queryset = TrackerPreferences.objects.none()
     serializer_class = TrackerPreferencesSerializer
     permission_classes = (IsOwnTrackerPreferences, )
+    pagination_class = None
 
     def get_queryset(self):
         if self.request.user.is_authenticated:
             return TrackerPreferences.objects.filter(user=self.request.user)
 
 
-class TrackerProfileViewSet(viewsets.ModelViewSet):
+class TrackerProfileViewSet(ExpandMixin, viewsets.ModelViewSet):
     queryset = TrackerProfile.objects.none()
     serializer_class = TrackerProfileSerializer
     permission_classes = (IsSelfTrackerProfile,)
@@ -91,35 +273,40 @@ class TrackerProfileViewSet(viewsets.ModelViewSet):
         return super(TrackerProfileViewSet, self).get_object()
 
 
-class PermissionViewSet(viewsets.ModelViewSet):
+class PermissionViewSet(ExpandMixin, viewsets.ModelViewSet):
     queryset = Permission.objects.all()
     serializer_class = PermissionSerializer
     permission_classes = (ReadOnly, )
+    pagination_class = None
 
 
-class GroupViewSet(viewsets.ModelViewSet):
+class GroupViewSet(ExpandMixin, viewsets.ModelViewSet):
     queryset = Group.objects.all()
     serializer_class = GroupSerializer
     search_fields = ('name', )
+    pagination_class = None
 
 
-class GrantViewSet(viewsets.ModelViewSet):
+class GrantViewSet(ChangeTrackingMixin, ExpandMixin, viewsets.ModelViewSet):
     queryset = Grant.objects.all()
     serializer_class = GrantSerializer
+    pagination_class = None
 
 
-class TopicViewSet(viewsets.ModelViewSet):
-    queryset = Topic.objects.all()
+class TopicViewSet(ChangeTrackingMixin, ExpandMixin, viewsets.ModelViewSet):
+    queryset = Topic.objects.prefetch_related('subtopic_set', 'admin')
     serializer_class = TopicSerializer
     filter_fields = ('grant', 'open_for_tickets', 'ticket_media', 'ticket_expenses', 'ticket_preexpenses')
     search_fields = ('name', 'description', 'form_description')
+    pagination_class = None  # used by ticket forms
 
 
-class SubtopicViewSet(viewsets.ModelViewSet):
+class SubtopicViewSet(ChangeTrackingMixin, ExpandMixin, viewsets.ModelViewSet):
     queryset = Subtopic.objects.all()
     serializer_class = SubtopicSerializer
     filter_fields = ('topic', )
     search_fields = ('name', 'description')
+    pagination_class = None  # used by ticket forms
 
 
 class LanguagesViewSet(viewsets.ViewSet):
@@ -134,8 +321,9 @@ class LanguagesViewSet(viewsets.ViewSet):
         return Response(languages)
 
 
-class TicketViewSet(viewsets.ModelViewSet):
+class TicketViewSet(ChangeTrackingMixin, ExpandMixin, viewsets.ModelViewSet):
     queryset = Ticket.objects.all()
+    filter_fields = ('state', )
     search_fields = ('name', 'description')
     permission_classes = (CanEditTicketElseReadOnly, )
 
@@ -147,35 +335,59 @@ class TicketViewSet(viewsets.ModelViewSet):
     def perform_create(self, serializer):
         serializer.save(requested_user=self.request.user)
 
-
-class MediaInfoViewSet(viewsets.ModelViewSet):
-    queryset = MediaInfo.objects.all()
+    @action(detail=False)
+    def ready(self, request):
+        """ Tickets ready for the ack given in `ack` parameter (precontent or content), optionally in one `topic` """
+        ack = request.query_params.get('ack', 'content')
+        if ack not in WAIT_NEEDED_ACK_TYPES:
+            return Response({'ack': ['Must be one of: %s.' % ', '.join(WAIT_NEEDED_ACK_TYPES)]},
+                            status=status.HTTP_400_BAD_REQUEST)
+        queryset = self.filter_queryset(self.get_queryset()).ready_for(ack)
+        if request.query_params.get('topic', '').isdigit():
+            queryset = queryset.filter(topic_id=request.query_params['topic'])
+
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(self.get_serializer(page, many=True).data)
+        return Response(self.get_serializer(queryset, many=True).data)
+
+
+class MediaInfoViewSet(ChangeTrackingMixin, BulkMixin, ExpandMixin, viewsets.ModelViewSet):
+    queryset = MediaInfo.objects.annotate(topic_name=F('ticket__topic__name'))
     serializer_class = MediaInfoSerializer
     permission_classes = (CanEditExpedituresElseReadOnly, )
     filter_fields = ('ticket', )
     search_fields = ('name', )
 
-    def create(self, request, *args, **kwargs):
-        items = request.data
-        if not isinstance(request.data, list):
-            items = [items]
-
-        created_items = []
-        for item in items:
-            serializer = self.get_serializer(data=item)
-            serializer.is_valid(raise_exception=True)
-            try:
-                self.perform_create(serializer)
-            except IntegrityError:
-                continue
-
-            created_items.append(item)
+    bulk_importer = MediaImporter
 
-        headers = self.get_success_headers(created_items)
-        return Response(created_items, status=status.HTTP_201_CREATED, headers=headers)
-
-
-class MediaInfoOldViewSet(viewsets.ModelViewSet):
+    def create(self, request, *args, **kwargs):
+        if isinstance(request.data, list):
+            # lists of media used to be posted here, before /bulk/ was added
+            return self.bulk_create(request)
+        return super(MediaInfoViewSet, self).create(request, *args, **kwargs)
+
+    def bulk_updated(self, changes, tickets):
+        super(MediaInfoViewSet, self).bulk_updated(changes, tickets)
+        for mediainfo in {mediainfo.ticket_id: mediainfo for old, mediainfo in changes}.values():
+            notify_media(MediaInfo, mediainfo, created=False, raw=False)
+        ticket_ids, user_id = list(tickets.keys()), self.request.user.id
+        transaction.on_commit(lambda: Ticket.schedule_media_sync(ticket_ids, user_id))
+
+    def bulk_destroyed(self, media):
+        super(MediaInfoViewSet, self).bulk_destroyed(media)
+        # the notification is about the ticket, not the particular media
+        for mediainfo in {mediainfo.ticket_id: mediainfo for mediainfo in media}.values():
+            notify_del_media(MediaInfo, mediainfo)
+        if settings.MEDIAINFO_MEDIAWIKI_TEMPLATE and settings.MEDIAINFO_MEDIAWIKI_INFO_TEMPLATE:
+            MediaInfo.resolve_pages(media)
+            page_ids = [mediainfo.page_id for mediainfo in media if mediainfo.page_id]
+            if page_ids:
+                user_id = self.request.user.id
+                transaction.on_commit(lambda: MediaInfo.remove_many_from_mediawiki(page_ids, user_id))
+
+
+class MediaInfoOldViewSet(ChangeTrackingMixin, ExpandMixin, viewsets.ModelViewSet):
     queryset = MediaInfoOld.objects.all()
     serializer_class = MediaInfoOldSerializer
     permission_classes = (ReadOnly, )
@@ -183,21 +395,67 @@ class MediaInfoOldViewSet(viewsets.ModelViewSet):
     search_fields = ('name', )
 
 
-class ExpeditureViewSet(viewsets.ModelViewSet):
+class ExpeditureViewSet(ChangeTrackingMixin, BulkMixin, ExpandMixin, viewsets.ModelViewSet):
     queryset = Expediture.objects.all()
     permission_classes = (CanEditExpedituresElseReadOnly, )
     filter_fields = ('ticket', 'wage', 'paid')
     search_fields = ('description', 'accounting_info')
+    bulk_importer = ExpeditureImporter
 
     def get_serializer_class(self):
         if not self.request.user.is_staff:
             return ExpeditureSerializer
         return ExpeditureAdminSerializer
 
+    def bulk_updated(self, changes, tickets):
+        Ticket.objects.filter(id__in=tickets.keys()).update_payment_status()
+        super(ExpeditureViewSet, self).bulk_updated(changes, tickets)
+        notify_expeditures_changed(changes)
 
-class PreexpeditureViewSet(viewsets.ModelViewSet):
+    def bulk_destroyed(self, expeditures):
+        Ticket.objects.filter(id__in={expediture.ticket_id for expediture in expeditures}).update_payment_status()
+        super(ExpeditureViewSet, self).bulk_destroyed(expeditures)
+        notify_expeditures_removed(expeditures)
+
+
+class PreexpeditureViewSet(ChangeTrackingMixin, BulkMixin, ExpandMixin, viewsets.ModelViewSet):
     queryset = Preexpediture.objects.all()
     serializer_class = PreexpeditureSerializer
     permission_classes = (CanEditExpedituresElseReadOnly, )
     filter_fields = ('ticket', 'wage')
     search_fields = ('description', )
+    bulk_importer = PreexpeditureImporter
+
+    def bulk_updated(self, changes, tickets):
+        super(PreexpeditureViewSet, self).bulk_updated(changes, tickets)
+        notify_preexpeditures_changed(changes)
+
+    def bulk_destroyed(self, preexpeditures):
+        super(PreexpeditureViewSet, self).bulk_destroyed(preexpeditures)
+        notify_preexpeditures_removed(preexpeditures)
+
+
+class ChangeLogEntryViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
+    """
+    Feed of changes of tracker objects, oldest first. Follow it by the next links, or pass the last seen sequence
+    number as `since`. Sequence numbers increase monotonically, though a change committed by a concurrent
+    transaction may show up with a lower one than changes already read. Changes are kept for
+    TRACKER_CHANGE_LOG_RETENTION_DAYS; a `since` before the oldest kept one is rejected, as the changes in between
+    may have been pruned.
+    """
+    queryset = ChangeLogEntry.objects.all()
+    serializer_class = ChangeLogEntrySerializer
+    permission_classes = (ReadOnly, )
+    pagination_class = ChangeFeedPagination
+    filter_fields = ('model', )
+
+    def filter_queryset(self, queryset):
+        queryset = super(ChangeLogEntryViewSet, self).filter_queryset(queryset)
+        since = self.request.query_params.get('since')
+        if since is not None:
+            if not since.isdigit():
+                raise ValidationError({'since': ['Must be a sequence number.']})
+            if int(since) < ChangeLogEntry.first_seq() - 1:
+                raise ValidationError({'since': ['Changes since then were pruned, load all objects instead.']})
+            queryset = queryset.filter(id__gt=int(since))
+        return queryset
@@ -143,6 +143,22 @@ MESSAGE_STORAGE = 'django.contrib.messages.storage.fallback.FallbackStorage'
 TRACKER_CURRENCY = _('CZK')
 TRACKER_USER_AGENT = 'DevTracker (https://github.com/wikimedia/wikimedia-cz-tracker)'
 
+# How many days must pass after a ticket was (pre)submitted before it can be (pre)approved
+TRACKER_MIN_WAIT_DAYS = 3
+
+# MediaWiki API client: (connect, read) timeouts in seconds, how many times to retry a request throttled by the
+# server (HTTP 429/503 or maxlag error) and the delay before the first retry (doubled for each next one), and the
+# maxlag parameter sent with requests (None to not send it)
+MEDIAWIKI_TIMEOUT = (5, 30)
+MEDIAWIKI_MAX_RETRIES = 4
+MEDIAWIKI_RETRY_DELAY = 1
+MEDIAWIKI_MAXLAG = 5
+
+# How long (in seconds) is the validity of user's MediaWiki OAuth token cached, and after how long it's checked again
+# by a background task
+MEDIAWIKI_TOKEN_STATUS_TTL = 24 * 60 * 60
+MEDIAWIKI_TOKEN_REVALIDATE_AFTER = 15 * 60
+
 LANGUAGES = (
     ('en', _('English')),
     ('cs', _('Czech')),
@@ -194,6 +210,12 @@ REST_FRAMEWORK = {
         'django_filters.rest_framework.DjangoFilterBackend',
         'rest_framework.filters.SearchFilter',
     ),
+    'DEFAULT_PAGINATION_CLASS': 'api.pagination.TrackerCursorPagination',
+    'DEFAULT_RENDERER_CLASSES': (
+        'rest_framework.renderers.JSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+        'api.renderers.NDJSONRenderer',
+    ),
     # Use Django's standard `django.contrib.auth` permissions,
     # or allow read-only access for unauthenticated users.
     'DEFAULT_PERMISSION_CLASSES': [
@@ -210,6 +232,17 @@ REST_FRAMEWORK = {
 # Setting this to False will remove the limitation
 MAX_NUMBER_OF_ROWS_ON_IMPORT = 100
 
+# How many objects can be created, updated or deleted at once through /bulk/ endpoints of the API
+MAX_NUMBER_OF_ITEMS_IN_BULK = 1000
+
+# Entries of the change log (API change feed, updated_since filter) older than this are removed by the
+# prunechangelog command; the feed and the filter reject positions further back
+TRACKER_CHANGE_LOG_RETENTION_DAYS = 90
+
+# Background jobs of a ticket (MediaWiki updates) run this long after the first change which scheduled them,
+# changes made meanwhile are handled by the same job
+TRACKER_JOB_DELAY_SECONDS = 30
+
 STATUTORY_DECLARATION_TEXT = 'I hereby declare that my travel expenses are true and accurate and that I spent money economically and effectivelly.'
 
 MESSAGE_TAGS = {
@@ -1,18 +1,115 @@
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
 from requests_oauthlib import OAuth1
+import datetime
 import requests
 import logging
+import threading
+import time
 from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUS_CODES = (429, 503)
+TOKEN_STATUS_KEY = 'mediawiki-token-status:%s'
+MAX_RETRY_DELAY = 120
+MAX_SESSIONS = 64
+
+
+class SessionPool(object):
+    """
+    Process-wide pool of keep-alive sessions, one per API URL and OAuth token, so that MediaWiki instances created
+    all over the place reuse connections. Least recently used sessions are closed once there are too many of them.
+    """
+
+    def __init__(self, max_sessions=MAX_SESSIONS):
+        self.max_sessions = max_sessions
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, api_url, token=None):
+        key = (api_url, token)
+        with self.lock:
+            session = self.sessions.pop(key, None)
+            if session is None:
+                session = requests.Session()
+                session.headers.update({'User-Agent': settings.TRACKER_USER_AGENT})
+            self.sessions[key] = session
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)[1].close()
+            return session
+
+    def clear(self):
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions.clear()
+
+
+class RequestStats(object):
+    """ Counters of requests made by MediaWiki clients of this process """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def record(self, latency, error=False, retry=False):
+        with self.lock:
+            self.requests += 1
+            self.errors += error
+            self.retries += retry
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'errors': self.errors,
+                'retries': self.retries,
+                'average_latency': self.total_latency / self.requests if self.requests else 0.0,
+                'max_latency': self.max_latency,
+            }
+
+
+sessions = SessionPool()
+stats = RequestStats()
+
+
+def retry_after(response):
+    """ Seconds to wait before retrying, as requested by the Retry-After header of response, or None """
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
 
 
 class MediaWiki():
-    def __init__(self, user=None, api_url=None):
-        self.session = requests.Session()
-        self.session.headers.update({'User-Agent': settings.TRACKER_USER_AGENT})
+    MAX_QUERY_PAGES = 50  # most titles or page IDs a single query can ask for without apihighlimits
+
+    def __init__(self, user=None, api_url=None, timeout=None, max_retries=None):
         self.user = user
         if api_url:
             self.api_url = api_url
         else:
             self.api_url = settings.MEDIAINFO_MEDIAWIKI_API
+        self.timeout = timeout if timeout is not None else settings.MEDIAWIKI_TIMEOUT
+        self.max_retries = max_retries if max_retries is not None else settings.MEDIAWIKI_MAX_RETRIES
 
         if self.user:
             provider = user.social_auth.filter(provider="mediawiki")
@@ -24,11 +121,24 @@ class MediaWiki():
             self.tokens = None
         if self.tokens is None:
             self.user = None      # Fail sliently, this user isn't connected with any MediaWiki account
+        self.session = sessions.get(self.api_url, self.tokens.get('oauth_token') if self.tokens else None)
+
+    def retry_delay(self, attempt, response=None):
+        """ Exponential backoff, unless the server told us how long to wait """
+        delay = settings.MEDIAWIKI_RETRY_DELAY * 2 ** attempt
+        if response is not None:
+            delay = max(delay, retry_after(response) or 0)
+        return min(delay, MAX_RETRY_DELAY)
+
+    def should_retry(self, response):
+        return response.status_code in RETRY_STATUS_CODES or response.headers.get('MediaWiki-API-Error') == 'maxlag'
 
     def request(self, payload, method="POST", authorized_only=False):
-        kwargs = {}
+        kwargs = {"timeout": self.timeout}
         payload = dict(payload)  # Convert payload to dict explicitly, in case it's request.POST, which cannot be modified
         payload["format"] = "json"
+        if settings.MEDIAWIKI_MAXLAG is not None:
+            payload.setdefault("maxlag", settings.MEDIAWIKI_MAXLAG)
         if self.user:
             kwargs["auth"] = OAuth1(
                 settings.SOCIAL_AUTH_MEDIAWIKI_KEY,
@@ -39,13 +149,45 @@ class MediaWiki():
         elif authorized_only:
             raise ValueError("Given user isn't connected with any MediaWiki account and you require authorized request only.")
         if method == "POST":
-            r = self.session.post(self.api_url, data=payload, **kwargs)
+            kwargs["data"] = payload
         else:
-            r = self.session.get(self.api_url, params=payload, **kwargs)
+            kwargs["params"] = payload
+
+        attempt = 0
+        while True:
+            retry = attempt < self.max_retries
+            started = time.monotonic()
+            try:
+                r = self.session.request(method, self.api_url, **kwargs)
+            except requests.exceptions.ConnectionError:
+                # the request did not get to the server (this includes connect timeouts, but not read timeouts,
+                # after which non-idempotent requests like edits must not be repeated)
+                stats.record(time.monotonic() - started, error=True, retry=retry)
+                if not retry:
+                    raise
+                delay = self.retry_delay(attempt)
+                logger.warning(f'API request to {self.api_url} failed to connect, retrying in {delay}s')
+            except requests.exceptions.RequestException:
+                stats.record(time.monotonic() - started, error=True)
+                raise
+            else:
+                should_retry = self.should_retry(r)
+                stats.record(time.monotonic() - started, error=should_retry or not r.ok, retry=retry and should_retry)
+                if not (retry and should_retry):
+                    break
+                delay = self.retry_delay(attempt, r)
+                logger.warning(f'API request to {self.api_url} was throttled (status={r.status_code}, '
+                               f'error={r.headers.get("MediaWiki-API-Error")}), retrying in {delay}s')
+            time.sleep(delay)
+            attempt += 1
+
+        if self.user and r.headers.get('MediaWiki-API-Error') == 'mwoauth-invalid-authorization':
+            forget_token_status(self.user.id)  # so that it's checked again, see check_token
+
         try:
             r.raise_for_status()
         except requests.exceptions.HTTPError:
-            logging.getLogger(__name__).error(
+            logger.error(
                 f'API request to {r.url} failed (status={r.status_code}, request_headers={r.request.headers}, response_headers={r.headers}, response={r.text}, user={self.user})'
             )
             raise
@@ -59,6 +201,48 @@ class MediaWiki():
             "type": type
         }).json()["query"]["tokens"]["%stoken" % type]
 
+    def query_continued(self, payload):
+        """ Run a query, following its continuation; yields the query part of every response """
+        continuation = {}
+        while True:
+            data = self.request(dict(payload, **continuation)).json()
+            yield data.get("query", {})
+            if "continue" not in data:
+                break
+            continuation = data["continue"]
+
+    def query_pages(self, titles=(), pageids=()):
+        """
+        Look up pages by titles and by page IDs, MAX_QUERY_PAGES of them per request.
+
+        Returns a pair of dicts, which map the requested titles and page IDs to pages (dicts with at least pageid and
+        canonical title), or to None for pages which don't exist.
+        """
+        by_title = {}
+        by_id = {}
+        titles = list(dict.fromkeys(titles))
+        pageids = list(dict.fromkeys(int(page_id) for page_id in pageids))
+        for key, values in (("titles", titles), ("pageids", pageids)):
+            for i in range(0, len(values), self.MAX_QUERY_PAGES):
+                batch = values[i:i + self.MAX_QUERY_PAGES]
+                query = self.request({
+                    "action": "query",
+                    "format": "json",
+                    "formatversion": 2,
+                    key: "|".join(str(value) for value in batch),
+                }).json().get("query", {})
+                pages = [page for page in query.get("pages", []) if "missing" not in page and "invalid" not in page]
+                if key == "titles":
+                    normalized = {n["from"]: n["to"] for n in query.get("normalized", [])}
+                    pages = {page["title"]: page for page in pages}
+                    for title in batch:
+                        by_title[title] = pages.get(normalized.get(title, title))
+                else:
+                    pages = {page["pageid"]: page for page in pages}
+                    for page_id in batch:
+                        by_id[page_id] = pages.get(page_id)
+        return by_title, by_id
+
     def get_content(self, page_id, rvslot="main"):
         payload = {
             "action": "query",
@@ -91,3 +275,35 @@ class MediaWiki():
         }
 
         return self.request(payload)
+
+
+def get_token_status(user_id):
+    """ Status of OAuth token of given user as cached by check_token, or None if it's not known """
+    return cache.get(TOKEN_STATUS_KEY % user_id)
+
+
+def forget_token_status(user_id):
+    cache.delete(TOKEN_STATUS_KEY % user_id)
+
+
+def check_token(user):
+    """
+    Ask MediaWiki whether OAuth token of user is still valid, and cache the answer for MEDIAWIKI_TOKEN_STATUS_TTL.
+
+    Returns the status, a dict with 'valid' (True, False, or None if user has no token) and 'checked' (timestamp),
+    or None if MediaWiki could not be asked.
+    """
+    mw = MediaWiki(user, timeout=(2, 5), max_retries=0)  # callers may keep users waiting
+    status = {'valid': None, 'checked': time.time()}
+    if mw.tokens:
+        try:
+            resp = mw.request({
+                "action": "query",
+                "meta": "userinfo"
+            }, authorized_only=True).json()
+        except (requests.exceptions.RequestException, ValueError):
+            logger.warning('Could not verify MediaWiki token of user %s', user)
+            return None
+        status['valid'] = resp.get('error', {}).get('code', "") != "mwoauth-invalid-authorization"
+    cache.set(TOKEN_STATUS_KEY % user.id, status, settings.MEDIAWIKI_TOKEN_STATUS_TTL)
+    return status
@@ -72,11 +72,11 @@ class TicketAdmin(admin.ModelAdmin):
         extra_context['add_ack_form'] = AddAckForm()
         return super(TicketAdmin, self).change_view(request, object_id, extra_context=extra_context)
 
-    exclude = ('media_updated', 'updated', 'cluster', 'payment_status', 'imported', 'is_completed')
+    exclude = ('media_updated', 'updated', 'cluster', 'payment_status', 'imported', 'is_completed', 'state')
     readonly_fields = ('state_str', 'requested_user_details')
     list_display = ('event_date', 'id', 'name', 'subtopic', 'admin_topic', 'requested_by', 'state_str')
     list_display_links = ('name',)
-    list_filter = ('topic', 'subtopic', 'payment_status')
+    list_filter = ('topic', 'subtopic', 'payment_status', 'state')
     date_hierarchy = 'event_date'
     search_fields = ['id', 'requested_user__username', 'requested_text', 'name']
     inlines = [SignatureAdmin, MediaInfoAdmin, PreexpeditureAdmin, ExpeditureAdmin]
@@ -164,6 +164,7 @@ admin.site.register(models.Subtopic, SubtopicAdmin)
 
 def open_topics_for_tickets(modeladmin, request, queryset):
     queryset.update(open_for_tickets=True)
+    models.ChangeLogEntry.log(models.Topic, queryset.values_list('id', flat=True))
 
 
 open_topics_for_tickets.short_description = _("Mark selected topics as opened for new tickets")
@@ -171,6 +172,7 @@ open_topics_for_tickets.short_description = _("Mark selected topics as opened fo
 
 def close_topics_for_tickets(modeladmin, request, queryset):
     queryset.update(open_for_tickets=False)
+    models.ChangeLogEntry.log(models.Topic, queryset.values_list('id', flat=True))
 
 
 close_topics_for_tickets.short_description = _("Mark selected topics as closed for new tickets")
@@ -0,0 +1,335 @@
+"""
+Bulk import of objects from CSV files uploaded through the import view.
+
+All rows of a file are validated first, using a fixed number of queries to load whatever they refer to. If any row
+is invalid, nothing is imported and the errors are reported per row. Otherwise all objects are inserted with
+bulk_create, and what signal receivers would have done for objects saved one by one (change log, ticket summaries,
+notifications) is done in a single pass, all in one transaction. Background jobs (MediaWiki updates) are scheduled
+once it commits.
+"""
+import abc
+import csv
+import datetime
+from collections import namedtuple
+from itertools import zip_longest
+
+from django.contrib.auth.models import User
+from django.core.exceptions import NON_FIELD_ERRORS, PermissionDenied, ValidationError
+from django.db import transaction
+from django.utils import timezone
+from django.utils.translation import ugettext as _, ugettext_lazy
+
+from socialauth.api import MediaWiki
+from tracker.models import Ticket, Topic, Grant, Preexpediture, Expediture, MediaInfo, TicketSummary, \
+    ChangeLogEntry, TrackerProfile, TrackerPreferences, ticket_state, notify_ticket, \
+    notify_preexpeditures_added, notify_expeditures_added, notify_media
+from tracker.utils import bulk_create_with_ids
+
+RowError = namedtuple('RowError', 'line column message')
+ImportResult = namedtuple('ImportResult', 'objects errors truncated')
+
+
+class CsvImporter(abc.ABC):
+    """ Imports objects of one model from rows of a CSV file """
+    model = None
+    columns = ()
+    validate_exclude = ()  # fields resolved by the importer itself, which full_clean would look up once per row
+
+    def __init__(self, user):
+        self.user = user
+
+    def check_permission(self):
+        """ Raise PermissionDenied if the user can't import objects of this kind at all """
+
+    def prepare(self, rows):
+        """ Load everything the rows refer to, before any of them is built """
+
+    @abc.abstractmethod
+    def build(self, row):
+        """ Build an unsaved object from row (dict of column: value), raise ValidationError if the row is invalid """
+
+    def finish(self, objects):
+        """
+        Do what signal receivers would have done, if the objects were saved one by one. Runs in the transaction which
+        inserted them; background jobs are to be scheduled on commit.
+        """
+
+    def run(self, csvfile, limit=None):
+        """ Import objects from csvfile, or just report errors if there are any. Only the first limit rows are read. """
+        reader = csv.reader(csvfile, delimiter=';', quotechar='"')
+        header = next(reader, [])
+        missing = [column for column in self.columns if column not in header]
+        if missing:
+            return ImportResult([], [RowError(1, None, _('Missing columns: %s') % ', '.join(missing))], False)
+
+        rows = []
+        truncated = False
+        for line in reader:
+            if not any(line):
+                continue
+            if limit is not None and len(rows) >= limit:
+                truncated = True
+                break
+            rows.append((reader.line_num, dict(zip_longest(header, line, fillvalue=''))))
+        self.prepare([row for line_num, row in rows])
+
+        objects = []
+        errors = []
+        for line_num, row in rows:
+            try:
+                obj = self.build(row)
+                obj.full_clean(exclude=self.validate_exclude, validate_unique=False)
+            except ValidationError as e:
+                messages = e.message_dict if hasattr(e, 'error_dict') else {NON_FIELD_ERRORS: e.messages}
+                for column, column_messages in messages.items():
+                    errors.append(RowError(line_num, None if column == NON_FIELD_ERRORS else column, ' '.join(column_messages)))
+            else:
+                objects.append(obj)
+        if errors:
+            return ImportResult([], errors, truncated)
+
+        with transaction.atomic():
+            bulk_create_with_ids(self.model, objects)
+            ChangeLogEntry.log(self.model, [obj.id for obj in objects])
+            self.finish(objects)
+        return ImportResult(objects, [], truncated)
+
+
+class TicketImporter(CsvImporter):
+    model = Ticket
+    columns = ('event_date', 'name', 'topic', 'event_url', 'description', 'deposit')
+    validate_exclude = ('topic', 'requested_user', 'media_updated', 'payment_status')  # the latter two can't be set by users
+
+    def prepare(self, rows):
+        self.topics = {}
+        for topic in Topic.objects.select_related('grant').filter(name__in={row['topic'] for row in rows}):
+            self.topics.setdefault(topic.name, topic)  # the same topic Topic.objects.filter(name=...)[0] gives
+
+    def build(self, row):
+        topic = self.topics.get(row['topic'])
+        if topic is None:
+            raise ValidationError({'topic': _('Topic %s does not exist.') % row['topic']})
+        event_date = row['event_date']
+        if event_date in ('', 'None'):
+            event_date = datetime.date.today()  # as Ticket.save does
+        ticket = Ticket(
+            event_date=event_date,
+            name=row['name'],
+            topic=topic,
+            event_url=row['event_url'],
+            description=row['description'],
+            deposit=row['deposit'],
+            requested_user=self.user,
+            updated=timezone.now(),
+        )
+        ticket.state = ticket_state(ticket.imported, ticket.rating_percentage, set())
+        return ticket
+
+    def finish(self, tickets):
+        TicketSummary.rebuild(ticket_ids=[ticket.id for ticket in tickets])
+        for topic in {ticket.topic for ticket in tickets}:
+            topic.flush_cache()
+        for ticket in tickets:
+            notify_ticket(Ticket, ticket, created=True, raw=False)
+
+
+class TopicImporter(CsvImporter):
+    model = Topic
+    columns = ('name', 'grant', 'open_for_new_tickets', 'media', 'preexpenses', 'expenses', 'description', 'form_description')
+    validate_exclude = ('grant', )
+
+    def check_permission(self):
+        if not self.user.is_staff:
+            raise PermissionDenied(_('You must be a staffer in order to be able to import topics.'))
+
+    def prepare(self, rows):
+        self.grants = {}
+        for grant in Grant.objects.filter(full_name__in={row['grant'] for row in rows}):
+            self.grants.setdefault(grant.full_name, []).append(grant)
+
+    def build(self, row):
+        grants = self.grants.get(row['grant'], [])
+        if not grants:
+            raise ValidationError({'grant': _('Grant %s does not exist.') % row['grant']})
+        if len(grants) > 1:
+            raise ValidationError({'grant': _('There is more than one grant named %s.') % row['grant']})
+        return Topic(
+            name=row['name'],
+            grant=grants[0],
+            open_for_tickets=row['open_for_new_tickets'] != 'False',
+            ticket_media=row['media'] != 'False',
+            ticket_preexpenses=row['preexpenses'] != 'False',
+            ticket_expenses=row['expenses'] != 'False',
+            description=row['description'],
+            form_description=row['form_description'],
+        )
+
+
+class GrantImporter(CsvImporter):
+    model = Grant
+    columns = ('full_name', 'short_name', 'slug', 'description')
+
+    def check_permission(self):
+        if not self.user.is_staff:
+            raise PermissionDenied(_('You must be a staffer in order to be able to import grants.'))
+
+    def prepare(self, rows):
+        self.slugs = set(Grant.objects.filter(slug__in={row['slug'] for row in rows}).values_list('slug', flat=True))
+
+    def build(self, row):
+        if row['slug'] in self.slugs:
+            raise ValidationError({'slug': _('Grant with slug %s already exists.') % row['slug']})
+        self.slugs.add(row['slug'])
+        return Grant(full_name=row['full_name'], short_name=row['short_name'], slug=row['slug'], description=row['description'])
+
+
+class TicketItemImporter(CsvImporter):
+    """ Imports objects belonging to tickets, which are identified by the ticket_id column """
+    validate_exclude = ('ticket', )
+    permission_message = None
+
+    def prepare(self, rows):
+        ticket_ids = set()
+        for row in rows:
+            try:
+                ticket_ids.add(int(row['ticket_id']))
+            except ValueError:
+                pass
+        self.tickets = Ticket.objects.select_related('topic__grant', 'requested_user').in_bulk(ticket_ids)
+
+    def can_edit(self, ticket):
+        # Same as Ticket.can_edit, but without loading acks of every ticket (is_completed is computed from them)
+        if self.user.is_staff:
+            return True
+        return ticket.requested_user_id == self.user.id and (
+            not ticket.is_completed or self.user.has_perm('tracker.change_ticket'))
+
+    def get_ticket(self, row):
+        try:
+            ticket = self.tickets.get(int(row['ticket_id']))
+        except ValueError:
+            ticket = None
+        if ticket is None:
+            raise ValidationError({'ticket_id': _('Ticket %s does not exist.') % row['ticket_id']})
+        if not self.can_edit(ticket):
+            raise ValidationError({'ticket_id': self.permission_message})
+        return ticket
+
+    def finish_tickets(self, objects):
+        tickets = {obj.ticket_id: obj.ticket for obj in objects}
+        TicketSummary.rebuild(ticket_ids=tickets.keys())
+        for ticket in tickets.values():
+            ticket.flush_cache()
+        return tickets
+
+
+class PreexpeditureImporter(TicketItemImporter):
+    model = Preexpediture
+    columns = ('ticket_id', 'description', 'amount', 'wage')
+    permission_message = ugettext_lazy("You can't add preexpenses to a ticket that you did not create.")
+
+    def build(self, row):
+        return Preexpediture(ticket=self.get_ticket(row), description=row['description'], amount=row['amount'],
+                             wage=row['wage'] or False)
+
+    def finish(self, preexpeditures):
+        self.finish_tickets(preexpeditures)
+        notify_preexpeditures_added(preexpeditures)
+
+
+class ExpeditureImporter(TicketItemImporter):
+    model = Expediture
+    columns = ('ticket_id', 'description', 'amount', 'wage')
+    permission_message = ugettext_lazy("You can't add expenses to a ticket that you did not create.")
+
+    def build(self, row):
+        expediture = Expediture(ticket=self.get_ticket(row), description=row['description'], amount=row['amount'],
+                                wage=row['wage'] or False)
+        if self.user.is_staff:
+            expediture.accounting_info = row.get('accounting_info', '')
+            expediture.paid = row.get('paid') or False
+        return expediture
+
+    def finish(self, expeditures):
+        Ticket.objects.filter(id__in={expediture.ticket_id for expediture in expeditures}).update_payment_status()
+        self.finish_tickets(expeditures)
+        notify_expeditures_added(expeditures)
+
+
+class MediaImporter(TicketItemImporter):
+    model = MediaInfo
+    columns = ('ticket_id', 'name')
+    validate_exclude = ('ticket', 'width', 'height')
+    permission_message = ugettext_lazy("You can't add media items to a ticket that you did not create.")
+
+    def prepare(self, rows):
+        super(MediaImporter, self).prepare(rows)
+        # one request per MediaWiki.MAX_QUERY_PAGES files
+        self.pages, pageids = MediaWiki(user=None).query_pages(titles=[row['name'] for row in rows])
+        self.attached = set(MediaInfo.objects.filter(ticket_id__in=self.tickets.keys()).values_list('ticket_id', 'page_title'))
+
+    def build(self, row):
+        ticket = self.get_ticket(row)
+        page = self.pages.get(row['name'])
+        if page is None:
+            raise ValidationError({'name': _('File %s does not exist.') % row['name']})
+        page_id, page_title = page['pageid'], page['title']
+        if (ticket.id, page_title) in self.attached:
+            raise ValidationError({'name': _('File %(name)s is already attached to ticket %(ticket)s.') % {
+                'name': page_title, 'ticket': ticket.id}})
+        self.attached.add((ticket.id, page_title))
+        return MediaInfo(ticket=ticket, page_id=page_id, page_title=page_title)
+
+    def finish(self, media):
+        tickets = self.finish_tickets(media)
+        Ticket.objects.filter(id__in=tickets.keys()).update(updated=timezone.now())
+        ChangeLogEntry.log(Ticket, tickets.keys())
+        ticket_ids, user_id = list(tickets.keys()), self.user.id
+        transaction.on_commit(lambda: Ticket.schedule_media_sync(ticket_ids, user_id))
+        # the notification is about the ticket, not the particular media
+        for mediainfo in {mediainfo.ticket_id: mediainfo for mediainfo in media}.values():
+            notify_media(MediaInfo, mediainfo, created=True, raw=False)
+
+
+class UserImporter(CsvImporter):
+    model = User
+    columns = ('username', 'password', 'first_name', 'last_name', 'is_superuser', 'is_staff', 'is_active', 'email')
+
+    def check_permission(self):
+        if not self.user.is_superuser:
+            raise PermissionDenied(_('You must be a superuser in order to be able to import users.'))
+
+    def prepare(self, rows):
+        self.usernames = set(User.objects.filter(username__in={row['username'] for row in rows}).values_list('username', flat=True))
+
+    def build(self, row):
+        if row['username'] in self.usernames:
+            raise ValidationError({'username': _('User %s already exists.') % row['username']})
+        self.usernames.add(row['username'])
+        user = User(
+            username=row['username'],
+            email=row['email'],
+            first_name=row['first_name'],
+            last_name=row['last_name'],
+            is_superuser=row['is_superuser'] or False,
+            is_staff=row['is_staff'] or False,
+            is_active=row['is_active'] or False,
+        )
+        user.set_password(row['password'])
+        return user
+
+    def finish(self, users):
+        # see create_user_profile
+        TrackerProfile.objects.bulk_create([TrackerProfile(user=user) for user in users])
+        TrackerPreferences.objects.bulk_create([TrackerPreferences(user=user) for user in users])
+
+
+IMPORTERS = {
+    'ticket': TicketImporter,
+    'topic': TopicImporter,
+    'grant': GrantImporter,
+    'preexpense': PreexpeditureImporter,
+    'expense': ExpeditureImporter,
+    'media': MediaImporter,
+    'user': UserImporter,
+}
@@ -1,10 +1,87 @@
 # -*- coding: utf-8 -*-
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
+from django.db import connections
+from django.db.models import Q, Max
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from contextlib import contextmanager
+import multiprocessing
+import os
 import os.path
 import json
+import re
+import tempfile
 from django.utils import translation
-from tracker.models import Ticket
+from tracker.models import Ticket, TicketSummary
+
+STATE_FILE = 'state.json'
+ROW_ID_RE = re.compile(r'>(\d+)</a>$')
+
+
+@contextmanager
+def atomic_file(path):
+    """ Open a temporary file which replaces path once it is closed, so that readers never see a partially written file """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            yield f
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class JSONListWriter(object):
+    """ Writes a JSON list to a file one item at a time, so the list is never held in memory """
+    encoder = json.JSONEncoder()
+
+    def __init__(self, f):
+        self.f = f
+        self.empty = True
+        f.write('[')
+
+    def write(self, item):
+        if not self.empty:
+            self.f.write(', ')
+        self.empty = False
+        for chunk in self.encoder.iterencode(item):
+            self.f.write(chunk)
+
+    def close(self):
+        self.f.write(']')
+
+
+def row_ticket_id(row):
+    return int(ROW_ID_RE.search(row[0]).group(1))
+
+
+def render_language(base_path, langcode, do_archived, max_id):
+    """
+    Render cache files for one language, streaming rows straight to disk. Only tickets up to max_id are included,
+    so that all languages rendered in one run show the same set of tickets.
+    """
+    summaries = TicketSummary.objects.select_related('ticket').filter(ticket_id__lte=max_id).order_by('-ticket_id')
+    archived_path = os.path.join(base_path, 'archived', '%s.json' % langcode)
+    with translation.override(langcode), atomic_file(os.path.join(base_path, '%s.json' % langcode)) as f:
+        f.write('{"data": ')
+        data = JSONListWriter(f)
+        if do_archived:
+            with atomic_file(archived_path) as archived_file:
+                archived = JSONListWriter(archived_file)
+                for summary in summaries.filter(ticket__is_completed=True).iterator():
+                    row = summary.as_row()
+                    archived.write(row)
+                    data.write(row)
+                archived.close()
+        else:
+            for row in json.loads(open(archived_path).read()):
+                data.write(row)
+        for summary in summaries.filter(ticket__is_completed=False).iterator():
+            data.write(summary.as_row())
+        data.close()
+        f.write('}')
 
 
 class Command(BaseCommand):
@@ -23,8 +100,25 @@ class Command(BaseCommand):
             dest='do_archived',
             help='We will update cache for both unarchived and archived tickets.'
         )
+        parser.add_argument(
+            '--incremental',
+            action='store_true',
+            dest='incremental',
+            help='Only re-render tickets changed since the last run and merge them into the existing cache. '
+                 'Falls back to a full run if there is no previous run to build on.'
+        )
+        parser.add_argument(
+            '--jobs',
+            action='store',
+            dest='jobs',
+            type=int,
+            default=1,
+            help='Number of worker processes rendering languages in parallel in a full run, default is 1'
+        )
 
     def handle(self, *args, **options):
+        if options['jobs'] < 1:
+            raise CommandError('--jobs must be at least 1')
         base_path = options['base_path'] or os.path.join(settings.TRACKER_PUBLIC_DEPLOY_ROOT, 'tickets')
         base_path_dirs = ('archived', )
         if not os.path.exists(base_path):
@@ -32,26 +126,78 @@ class Command(BaseCommand):
         for dir in base_path_dirs:
             if not os.path.exists(os.path.join(base_path, dir)):
                 os.mkdir(os.path.join(base_path, dir))
-        archived_tickets = {}
+
+        started = timezone.now()
+        if options['incremental']:
+            if self.handle_incremental(base_path):
+                self.write_state(base_path, started)
+                return
+            options['do_archived'] = True  # nothing to build on, do a full run that later runs can build on
+
         if not options['do_archived']:
             for langcode, langname in settings.LANGUAGES:
-                archived_path = os.path.join(base_path, 'archived', '%s.json' % langcode)
-                if os.path.exists(archived_path):
-                    archived_tickets[langcode] = json.loads(open(archived_path).read())
-                else:
+                if not os.path.exists(os.path.join(base_path, 'archived', '%s.json' % langcode)):
                     options['do_archived'] = True   # we don't have archived tickets cached yet, we must do that now
                     break
 
+        max_id = TicketSummary.objects.aggregate(max_id=Max('ticket_id'))['max_id'] or 0
+        tasks = [(base_path, langcode, options['do_archived'], max_id) for langcode, langname in settings.LANGUAGES]
+        if options['jobs'] > 1:
+            connections.close_all()  # forked workers must not share the parent's database connection
+            with multiprocessing.get_context('fork').Pool(options['jobs']) as pool:
+                pool.starmap(render_language, tasks)
+        else:
+            for task in tasks:
+                render_language(*task)
+
+        # archived tickets are only fully up to date after --do-archived, so only such runs can be built on
         if options['do_archived']:
-            for langcode, langname in settings.LANGUAGES:
-                with translation.override(langcode):
-                    archived_tickets[langcode] = [ticket.get_cached_ticket() for ticket in Ticket.objects.filter(is_completed=True).order_by('-id')]
-                    open(os.path.join(base_path, 'archived', '%s.json' % langcode), 'w').write(json.dumps(
-                        archived_tickets[langcode]
-                    ))
+            self.write_state(base_path, started)
+
+    def write_state(self, base_path, started):
+        with atomic_file(os.path.join(base_path, STATE_FILE)) as f:
+            json.dump({'updated': started.isoformat()}, f)
+
+    def handle_incremental(self, base_path):
+        """
+        Merge tickets changed since the last run into the existing cache files.
+        Returns False if there is nothing to merge into, so that a full run is needed.
+        """
+        state_path = os.path.join(base_path, STATE_FILE)
+        if not os.path.exists(state_path):
+            return False
+        since = parse_datetime(json.loads(open(state_path).read())['updated'])
 
         for langcode, langname in settings.LANGUAGES:
+            if not os.path.exists(os.path.join(base_path, '%s.json' % langcode)):
+                return False
+
+        changed = list(TicketSummary.objects.select_related('ticket').filter(
+            Q(refreshed__gt=since) | Q(ticket__updated__gt=since)))
+        completed = dict(Ticket.objects.values_list('id', 'is_completed'))
+
+        for langcode, langname in settings.LANGUAGES:
+            cached = json.loads(open(os.path.join(base_path, '%s.json' % langcode)).read())['data']
+            rows = {}
+            for row in cached:
+                ticket_id = row_ticket_id(row)
+                if ticket_id in completed:
+                    rows[ticket_id] = row
+            if not changed and len(rows) == len(cached):
+                continue  # nothing changed or got deleted
+
             with translation.override(langcode):
-                open(os.path.join(base_path, '%s.json' % langcode), 'w').write(json.dumps({
-                    "data": archived_tickets[langcode] + [ticket.get_cached_ticket() for ticket in Ticket.objects.filter(is_completed=False).order_by('-id')]
-                }))
+                for summary in changed:
+                    rows[summary.ticket_id] = summary.as_row()
+
+            ticket_ids = sorted(rows, reverse=True)
+            with atomic_file(os.path.join(base_path, 'archived', '%s.json' % langcode)) as f:
+                json.dump([rows[ticket_id] for ticket_id in ticket_ids if completed.get(ticket_id)], f)
+            with atomic_file(os.path.join(base_path, '%s.json' % langcode)) as f:
+                f.write('{"data": ')
+                data = JSONListWriter(f)
+                for ticket_id in [i for i in ticket_ids if completed.get(i)] + [i for i in ticket_ids if not completed.get(i)]:
+                    data.write(rows[ticket_id])
+                data.close()
+                f.write('}')
+        return True
@@ -0,0 +1,12 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from tracker.models import ChangeLogEntry
+
+
+class Command(BaseCommand):
+    help = 'Remove change log entries older than TRACKER_CHANGE_LOG_RETENTION_DAYS; meant to be run daily from cron'
+
+    def handle(self, *args, **options):
+        deleted = ChangeLogEntry.prune()
+        self.stdout.write('Removed %d change log entries older than %d days.' % (
+            deleted, settings.TRACKER_CHANGE_LOG_RETENTION_DAYS))
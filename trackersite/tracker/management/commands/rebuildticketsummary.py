@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from tracker.models import TicketSummary
+
+
+class Command(BaseCommand):
+    help = 'Recompute summaries of all tickets'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            TicketSummary.rebuild(batch_size=options['batch_size'])
+        self.stdout.write('Rebuilt %d ticket summaries.' % TicketSummary.objects.count())
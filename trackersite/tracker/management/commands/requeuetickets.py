@@ -1,10 +1,11 @@
 from django.core.management.base import BaseCommand, CommandError
 from tracker.models import Ticket, MediaInfo
+from tracker.utils import schedule_ticket_job
 from os import getcwd, path
 
 
 class Command(BaseCommand):
-    help = 'Re-triggers add_to_mediawiki for specified ticket(s)'
+    help = 'Re-triggers adding of MediaWiki templates to media of specified ticket(s)'
 
     def add_arguments(self, parser):
         parser.add_argument('ticket_ids', nargs='*', type=int)
@@ -25,11 +26,10 @@ class Command(BaseCommand):
                         ticket_ids.append(int(line.strip()))
 
         self.stdout.write('Got %s ticket ids. Processing...' % str(len(ticket_ids)))
+        existing = set(Ticket.objects.filter(id__in=ticket_ids).values_list('id', flat=True))
         for ticket_id in ticket_ids:
-            try:
-                for mediainfo in MediaInfo.objects.filter(ticket_id=ticket_id):
-                    MediaInfo.add_to_mediawiki(mediainfo.id, MediaInfo.get_maintenance_user_id())
-
-            except Ticket.DoesNotExist:
+            if ticket_id not in existing:
                 raise CommandError('Ticket %s does not exist' % ticket_id)
+            # one job per ticket, shared with other changes of the ticket
+            schedule_ticket_job(Ticket._update_mediainfo, ticket_id, MediaInfo.get_maintenance_user_id())
         self.stdout.write('Done.')
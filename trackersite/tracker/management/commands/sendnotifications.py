@@ -1,6 +1,10 @@
 from __future__ import print_function
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+from django.core.mail import EmailMultiAlternatives, get_connection
 from django.core.management.base import BaseCommand
-from tracker.models import Notification, Ticket
+from django.db import models
+from tracker.models import Notification, Ticket, Topic
 from django.contrib.auth.models import User
 from django.template.loader import get_template
 from django.conf import settings
@@ -11,9 +15,20 @@ from datetime import date
 
 class Command(BaseCommand):
     help = 'Process pending notifications'
-    subject_c = {"date": date.today()}
     subject_template = get_template('notification/notification_subject.txt')
     html_template = get_template('notification/notification_html.html')
+    notification_groups = {
+        "ack_notifs": ("ack_add", "ack_remove"),
+        "ticket_change_notifs": ("ticket_change", "ticket_change_all"),
+        "preexpeditures_notifs": ("preexpeditures_change", "preexpeditures_new"),
+        "expeditures_notifs": ("expeditures_change", "expeditures_new"),
+        "media_notifs": ("media_change", "media_new"),
+        "ticket_new_notifs": ("ticket_new", ),
+        "ticket_delete_notifs": ("ticket_delete", ),
+        "comment_notifs": ("comment", ),
+        "supervisor_notes_notifs": ("supervisor_notes", ),
+        "document_notifs": ("document", ),
+    }
 
     def get_user_object(self, user):
         if user.startswith('#') and user[1:].isdigit():
@@ -21,50 +36,69 @@ class Command(BaseCommand):
         else:
             return User.objects.get(username=user)
 
-    def get_ready_tickets_for_user(self, user):
-        admin_of = user.topic_set.all()
+    def load_ready_tickets(self, topic_ids):
+        """ Find tickets that may be ready for (pre)approval in given topics, each topic is processed only once """
+        missing = set(topic_ids) - set(self.ready_tickets)
+        for topic_id in missing:
+            self.ready_tickets[topic_id] = {'precontent': [], 'content': []}
+        for ack in ('precontent', 'content'):
+            for ticket in Ticket.objects.filter(topic_id__in=missing).ready_for(ack).order_by('id'):
+                self.ready_tickets[ticket.topic_id][ack].append(ticket)
+
+    def get_ready_tickets_for_user(self, topic_ids):
         res = {
             'precontent': [],
             'content': [],
         }
-        for topic in admin_of:
-            res['precontent'] += self.ready_tickets_precontent.get(topic, [])
-            res['content'] += self.ready_tickets_content.get(topic, [])
+        for topic_id in topic_ids:
+            res['precontent'] += self.ready_tickets[topic_id]['precontent']
+            res['content'] += self.ready_tickets[topic_id]['content']
         return res
 
-    def process_user(self, user, email_user=None, dry_run=False):
-        if email_user is None:
-            email_user = user
-        if not email_user.email:
-            return
-        ready_tickets = self.get_ready_tickets_for_user(user)
-        ready_sum = sum([len(ready_tickets[x]) for x in ready_tickets])
-        if len(Notification.objects.filter(target_user=user)) > 0 or ready_sum < 0:
-            c = {
-                "ack_notifs": Notification.objects.filter(target_user=user, notification_type__in=["ack_add", "ack_remove"]),
-                "ticket_change_notifs": Notification.objects.filter(target_user=user, notification_type__in=["ticket_change", "ticket_change_all"]),
-                "preexpeditures_notifs": Notification.objects.filter(target_user=user, notification_type__in=["preexpeditures_change", "preexpeditures_new"]),
-                "expeditures_notifs": Notification.objects.filter(target_user=user, notification_type__in=["expeditures_change", "expeditures_new"]),
-                "media_notifs": Notification.objects.filter(target_user=user, notification_type__in=["media_change", "media_new"]),
-                "ticket_new_notifs": Notification.objects.filter(target_user=user, notification_type="ticket_new"),
-                "ticket_delete_notifs": Notification.objects.filter(target_user=user, notification_type="ticket_delete"),
-                "comment_notifs": Notification.objects.filter(target_user=user, notification_type="comment"),
-                "supervisor_notes_notifs": Notification.objects.filter(target_user=user, notification_type="supervisor_notes"),
-                "document_notifs": Notification.objects.filter(target_user=user, notification_type="document"),
-                "ready_tickets": ready_tickets,
-                "BASE_URL": settings.BASE_URL,
-            }
-            if user.trackerpreferences.email_language:
-                translation.activate(user.trackerpreferences.email_language)
-            else:
-                translation.deactivate()
+    def render(self, user, notifications, topic_ids):
+        """ Render subject and HTML body of the digest in user's language """
+        c = {key: [] for key in self.notification_groups}
+        for notification in notifications:
+            for key, notification_types in self.notification_groups.items():
+                if notification.notification_type in notification_types:
+                    c[key].append(notification)
+        c.update({
+            "ready_tickets": self.get_ready_tickets_for_user(topic_ids),
+            "BASE_URL": settings.BASE_URL,
+        })
+        with translation.override(user.trackerpreferences.email_language or settings.LANGUAGE_CODE):
+            return self.subject_template.render(self.subject_c).strip(), self.html_template.render(c)
+
+    def send_messages(self, messages):
+        with get_connection() as connection:
+            return connection.send_messages(messages)
+
+    def process_batch(self, batch, email_user=None, dry_run=False):
+        """ Render digests of a batch of (user, notifications) pairs and send them over pooled SMTP connections """
+        admin_of = {}
+        for user_id, topic_id in Topic.admin.through.objects.filter(
+                user_id__in=[user.id for user, _ in batch]).values_list('user_id', 'topic_id'):
+            admin_of.setdefault(user_id, []).append(topic_id)
+        self.load_ready_tickets(set(topic_id for topic_ids in admin_of.values() for topic_id in topic_ids))
+
+        messages = []
+        for user, notifications in batch:
+            recipient = email_user or user
+            if not recipient.email:
+                continue
+            subject, html = self.render(user, notifications, admin_of.get(user.id, []))
             if dry_run:
-                print('Subject: %s' % self.subject_template.render(self.subject_c))
-                print('To: %s' % email_user.email)
+                print('Subject: %s' % subject)
+                print('To: %s' % recipient.email)
                 print('')
-                print(self.html_template.render(c))
-            else:
-                email_user.email_user(self.subject_template.render(self.subject_c), strip_tags(self.html_template.render(c)), html_message=self.html_template.render(c))
+                print(html)
+                continue
+            message = EmailMultiAlternatives(subject, strip_tags(html), to=[recipient.email])
+            message.attach_alternative(html, 'text/html')
+            messages.append(message)
+
+        chunks = [messages[i::self.workers] for i in range(self.workers)]
+        list(self.executor.map(self.send_messages, [chunk for chunk in chunks if chunk]))
 
     def add_arguments(self, parser):
         parser.add_argument(
@@ -93,37 +127,58 @@ class Command(BaseCommand):
             dest='dry_run',
             help='Do not send any emails, input them on screen (produces large output)'
         )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=100,
+            help='How many users are processed (and their notifications deleted) at once'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=4,
+            help='How many SMTP connections are used in parallel'
+        )
 
     def handle(self, *args, **options):
-        users = User.objects.all()
+        self.subject_c = {"date": date.today()}
+        self.ready_tickets = {}
+        self.workers = max(options['workers'], 1)
+
+        # Notifications fired while the digests are being sent are left for the next run
+        last_id = Notification.objects.aggregate(last_id=models.Max('id'))['last_id']
+        if last_id is None:
+            return
+        notifications = Notification.objects.filter(target_user__isnull=False, id__lte=last_id)
 
         # Handle process users argument
         if options['process_users']:
-            users = []
-            for process_user in options['process_users']:
-                users.append(self.get_user_object(process_user))
+            notifications = notifications.filter(
+                target_user__in=[self.get_user_object(process_user) for process_user in options['process_users']])
 
         # Handle email_user argument
         email_user = None
         if options['email_user']:
             email_user = self.get_user_object(options['email_user'][0])
 
-        # Precalculate list of ready tickets
-        self.ready_tickets_precontent = {}
-        self.ready_tickets_content = {}
-        for ticket in Ticket.objects.all():
-            if ticket.can_ack_be_added('precontent'):
-                if ticket.topic not in self.ready_tickets_precontent:
-                    self.ready_tickets_precontent[ticket.topic] = []
-                self.ready_tickets_precontent[ticket.topic].append(ticket)
-
-            if ticket.can_ack_be_added('content'):
-                if ticket.topic not in self.ready_tickets_content:
-                    self.ready_tickets_content[ticket.topic] = []
-                self.ready_tickets_content[ticket.topic].append(ticket)
-
-        # Process notifications
-        for user in users:
-            self.process_user(user, email_user=email_user, dry_run=options['dry_run'])
-            if options['delete']:
-                Notification.objects.filter(target_user=user).delete()
+        notifications = notifications.select_related('target_user__trackerpreferences').order_by(
+            'target_user_id', 'fired', 'id')
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        with self.executor:
+            batch = []
+            for _, user_notifications in groupby(notifications.iterator(), key=lambda n: n.target_user_id):
+                user_notifications = list(user_notifications)
+                batch.append((user_notifications[0].target_user, user_notifications))
+                if len(batch) >= options['batch_size']:
+                    self.finish_batch(batch, email_user, options)
+                    batch = []
+            if batch:
+                self.finish_batch(batch, email_user, options)
+
+    def finish_batch(self, batch, email_user, options):
+        self.process_batch(batch, email_user=email_user, dry_run=options['dry_run'])
+        if options['delete']:
+            Notification.objects.filter(
+                target_user_id__in=[user.id for user, _ in batch],
+                id__lte=max(n.id for _, notifications in batch for n in notifications),
+            ).delete()
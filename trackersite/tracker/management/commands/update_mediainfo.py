@@ -1,5 +1,6 @@
 from django.core.management.base import BaseCommand
 from tracker.models import Ticket
+from tracker.utils import schedule_ticket_job
 
 
 class Command(BaseCommand):
@@ -9,4 +10,4 @@ class Command(BaseCommand):
         for ticket in Ticket.objects.all():
             acks = ticket.ack_set()
             if 'archive' not in acks and 'close' not in acks and ticket.mediainfo_set.all().count() > 0:
-                Ticket.update_media(ticket.id)
+                schedule_ticket_job(Ticket.update_media, ticket.id)
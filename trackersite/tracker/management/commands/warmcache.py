@@ -0,0 +1,38 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from tracker.models import Ticket, Topic
+
+
+class Command(BaseCommand):
+    help = 'Pre-populate cached values of hot topics and their tickets, eg. after a deploy'
+    topic_cached_getters = (
+        'media_count', 'expeditures', 'preexpeditures', 'accepted_expeditures', 'paid_together', 'paid_wages',
+        'tickets_per_payment_status', 'payment_summary',
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=30,
+            help='Topics with tickets updated in that many last days are considered hot'
+        )
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            dest='all',
+            help='Warm up all topics'
+        )
+
+    def handle(self, *args, **options):
+        topics = Topic.objects.order_by('id')
+        if not options['all']:
+            since = timezone.now() - datetime.timedelta(days=options['days'])
+            topics = topics.filter(ticket__updated__gte=since).distinct()
+        topics = Topic.prefetch_finance(topics)
+        Topic.prefetch_cache(topics, self.topic_cached_getters)
+
+        tickets = Ticket.prefetch_cache(Ticket.objects.filter(topic__in=topics), Ticket.listing_cached_getters)
+        self.stdout.write('Warmed up %d topics with %d tickets.' % (len(topics), len(tickets)))
@@ -1,7 +1,13 @@
-from socialauth.api import MediaWiki
+import time
+
+from socialauth.api import check_token, get_token_status
+from django.core.cache import cache
 from django.shortcuts import redirect
 from django.urls import reverse
 from django.conf import settings
+from tracker.models import TrackerProfile
+
+REVALIDATING_KEY = 'mediawiki-token-revalidating:%s'
 
 
 def WarnIEUsers(get_response):
@@ -26,17 +32,18 @@ def InvalidOauth(get_response):
                 request.user.is_authenticated and
                 settings.MEDIAINFO_MEDIAWIKI_API is not None
         ):
-            # Verify MediaWiki token, if we have any to verify
-            mw = MediaWiki(request.user)
-            if mw.tokens:
-                resp = mw.request({
-                    "action": "query",
-                    "meta": "userinfo"
-                }, authorized_only=True).json()
-                if resp.get('error', {}).get('code', "") == "mwoauth-invalid-authorization":
-                    return redirect(reverse('invalid_oauth_tokens', kwargs={
-                        'provider': 'mediawiki'
-                    }) + "?next=" + request.path)
+            # Verify MediaWiki token, if we have any to verify. Only a token we know nothing about is verified right
+            # away, known ones are verified again in the background once in a while.
+            status = get_token_status(request.user.id)
+            if status is None:
+                status = check_token(request.user)
+            elif (time.time() - status['checked'] > settings.MEDIAWIKI_TOKEN_REVALIDATE_AFTER and
+                    cache.add(REVALIDATING_KEY % request.user.id, True, settings.MEDIAWIKI_TOKEN_REVALIDATE_AFTER)):
+                TrackerProfile.revalidate_mediawiki_token(request.user.id)
+            if status is not None and status['valid'] is False:
+                return redirect(reverse('invalid_oauth_tokens', kwargs={
+                    'provider': 'mediawiki'
+                }) + "?next=" + request.path)
         return response
 
     return process_request
@@ -0,0 +1,103 @@
+# Generated by Django 3.0.14 on 2026-10-18 13:03
+
+from django.db import migrations, models
+import decimal
+
+import django.db.models.deletion
+
+
+def _ticket_state(imported, rating_percentage, acks):
+    if imported:
+        return 'historical'
+
+    if 'close' in acks:
+        return 'closed'
+    elif 'archive' in acks:
+        return 'archived'
+    elif 'content' in acks:
+        if not rating_percentage:
+            return 'wfrating'
+
+        if 'docs' in acks:
+            return 'complete'
+        elif 'user_docs' in acks:
+            return 'wffill'
+        else:
+            return 'wfdocssub'
+    elif 'precontent' in acks:
+        if 'user_content' in acks:
+            return 'wfapproval'
+        else:
+            return 'wfsubmiting'
+    else:
+        if 'user_precontent' in acks:
+            return 'wfpreapproval'
+        elif 'user_content' in acks:
+            return 'wfapproval'
+        else:
+            return 'draft'
+
+
+def _reduce(total, rating_percentage):
+    reduced = total * rating_percentage / 100
+    return reduced.quantize(decimal.Decimal('0.01'), rounding=decimal.ROUND_HALF_UP)
+
+
+def populate_ticketsummary(apps, schema_editor):
+    Ticket = apps.get_model('tracker', 'Ticket')
+    TicketSummary = apps.get_model('tracker', 'TicketSummary')
+
+    for ticket in Ticket.objects.select_related('topic__grant', 'subtopic', 'requested_user'):
+        acks = set(ticket.ticketack_set.values_list('ack_type', flat=True))
+        expeditures = ticket.expediture_set.aggregate(
+            amount=models.Sum('amount'), paid=models.Sum('amount', filter=models.Q(paid=True)))
+        summary = TicketSummary(
+            ticket=ticket,
+            state=_ticket_state(ticket.imported, ticket.rating_percentage, acks),
+            grant_name=ticket.topic.grant.full_name,
+            grant_slug=ticket.topic.grant.slug,
+            topic_name=ticket.topic.name,
+            subtopic_name=ticket.subtopic.name if ticket.subtopic else '',
+            requested_by=ticket.requested_user.username if ticket.requested_user else ticket.requested_text,
+            preexpeditures_amount=ticket.preexpediture_set.aggregate(amount=models.Sum('amount'))['amount'] or 0,
+            expeditures_amount=expeditures['amount'] or 0,
+            media_count=(ticket.mediainfoold_set.aggregate(media=models.Sum('count'))['media'] or 0) + ticket.mediainfo_set.count(),
+        )
+        if ticket.rating_percentage is not None:
+            if 'content' in acks:
+                summary.accepted_expeditures = _reduce(expeditures['amount'] or decimal.Decimal(0), ticket.rating_percentage)
+            summary.paid_expeditures = _reduce(expeditures['paid'] or decimal.Decimal(0), ticket.rating_percentage)
+        summary.save()
+
+
+def unpopulate_ticketsummary(apps, schema_editor):
+    pass  # the table is dropped by CreateModel's reverse
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracker', '0088_expediture_archived'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TicketSummary',
+            fields=[
+                ('ticket', models.OneToOneField(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, primary_key=True, related_name='summary', serialize=False, to='tracker.Ticket')),
+                ('state', models.CharField(choices=[('historical', 'historical'), ('closed', 'closed'), ('archived', 'archived'), ('wfrating', 'waiting for content rating'), ('complete', 'complete'), ('wffill', 'waiting for filing of documents'), ('wfdocssub', 'waiting for document submission'), ('wfapproval', 'waiting for approval'), ('wfsubmiting', 'waiting for submitting'), ('wfpreapproval', 'waiting for preapproval'), ('draft', 'draft')], db_index=True, max_length=20, verbose_name='state')),
+                ('grant_name', models.CharField(db_index=True, max_length=80)),
+                ('grant_slug', models.SlugField()),
+                ('topic_name', models.CharField(db_index=True, max_length=80)),
+                ('subtopic_name', models.CharField(blank=True, max_length=80)),
+                ('requested_by', models.CharField(blank=True, db_index=True, max_length=150)),
+                ('preexpeditures_amount', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('expeditures_amount', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('accepted_expeditures', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('paid_expeditures', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('media_count', models.PositiveIntegerField(default=0)),
+                ('refreshed', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.RunPython(populate_ticketsummary, unpopulate_ticketsummary),
+    ]
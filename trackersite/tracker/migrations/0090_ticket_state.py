@@ -0,0 +1,63 @@
+# Generated by Django 3.0.14 on 2026-10-18 13:09
+
+from django.db import migrations, models
+
+STATES = ('historical', 'closed', 'archived', 'wfrating', 'complete', 'wffill', 'wfdocssub', 'wfapproval',
+          'wfsubmiting', 'wfpreapproval', 'draft')
+ACK_TYPES = ('close', 'archive', 'content', 'docs', 'user_docs', 'precontent', 'user_content', 'user_precontent')
+
+
+def _state_annotations():
+    annotations = {
+        'acks_%s' % ack_type: models.Count('ticketack', filter=models.Q(ticketack__ack_type=ack_type))
+        for ack_type in ACK_TYPES
+    }
+
+    def has(ack_type):
+        return models.Q(**{'acks_%s__gt' % ack_type: 0})
+
+    annotations['computed_state'] = models.Case(
+        models.When(imported=True, then=models.Value('historical')),
+        models.When(has('close'), then=models.Value('closed')),
+        models.When(has('archive'), then=models.Value('archived')),
+        models.When(has('content') & (models.Q(rating_percentage__isnull=True) | models.Q(rating_percentage=0)),
+                    then=models.Value('wfrating')),
+        models.When(has('content') & has('docs'), then=models.Value('complete')),
+        models.When(has('content') & has('user_docs'), then=models.Value('wffill')),
+        models.When(has('content'), then=models.Value('wfdocssub')),
+        models.When(has('precontent') & has('user_content'), then=models.Value('wfapproval')),
+        models.When(has('precontent'), then=models.Value('wfsubmiting')),
+        models.When(has('user_precontent'), then=models.Value('wfpreapproval')),
+        models.When(has('user_content'), then=models.Value('wfapproval')),
+        default=models.Value('draft'),
+        output_field=models.CharField(max_length=20),
+    )
+    return annotations
+
+
+def populate_state(apps, schema_editor):
+    Ticket = apps.get_model('tracker', 'Ticket')
+
+    computed = Ticket.objects.annotate(**_state_annotations())
+    for state in STATES:
+        Ticket.objects.filter(id__in=computed.filter(computed_state=state).values('id')).update(state=state)
+
+
+def unpopulate_state(apps, schema_editor):
+    pass  # the column is dropped by AddField's reverse
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracker', '0089_ticketsummary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ticket',
+            name='state',
+            field=models.CharField(choices=[('historical', 'historical'), ('closed', 'closed'), ('archived', 'archived'), ('wfrating', 'waiting for content rating'), ('complete', 'complete'), ('wffill', 'waiting for filing of documents'), ('wfdocssub', 'waiting for document submission'), ('wfapproval', 'waiting for approval'), ('wfsubmiting', 'waiting for submitting'), ('wfpreapproval', 'waiting for preapproval'), ('draft', 'draft')], db_index=True, default='draft', max_length=20, verbose_name='state'),
+        ),
+        migrations.RunPython(populate_state, unpopulate_state),
+    ]
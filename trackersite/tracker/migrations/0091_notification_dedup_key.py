@@ -0,0 +1,18 @@
+# Generated by Django 3.0.14 on 2026-10-18 13:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracker', '0090_ticket_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='dedup_key',
+            field=models.CharField(blank=True, db_index=True, max_length=40, verbose_name='dedup_key'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 3.0.14 on 2026-10-18 13:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracker', '0091_notification_dedup_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='event_key',
+            field=models.CharField(blank=True, max_length=100, verbose_name='event_key'),
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='payload',
+            field=models.TextField(blank=True, verbose_name='payload'),
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='ticket_id',
+            field=models.IntegerField(blank=True, null=True, verbose_name='ticket_id'),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['ticket_id', 'notification_type'], name='tracker_not_ticket__9ea104_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['event_key', 'notification_type'], name='tracker_not_event_k_34d735_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.14 on 2026-10-18 14:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracker', '0093_changelogentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mediainfo',
+            name='synced_hash',
+            field=models.CharField(blank=True, help_text='Hash of the page and template last added to it on MediaWiki', max_length=40, verbose_name='synced hash'),
+        ),
+    ]
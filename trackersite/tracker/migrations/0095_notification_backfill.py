@@ -0,0 +1,45 @@
+# Generated by Django 3.0.14 on 2026-10-18 16:05
+
+import re
+
+from django.db import migrations
+
+TICKET_URL = re.compile(r'/ticket/(\d+)/')
+ITEM_MODELS = {
+    'expeditures_new': ('Expediture', 'expediture'),
+    'preexpeditures_new': ('Preexpediture', 'preexpediture'),
+}
+
+
+def backfill_notifications(apps, schema_editor):
+    """
+    Fill in ticket_id of notifications created before it existed from the ticket URL in their text, and event_key of
+    those about a new (pre)expediture from the one expediture of the ticket their text names, so that they keep
+    suppressing follow-up notifications.
+    """
+    Notification = apps.get_model('tracker', 'Notification')
+
+    for notification in Notification.objects.filter(ticket_id=None, payload='').iterator():
+        match = TICKET_URL.search(notification.text)
+        if match is None:
+            continue
+        notification.ticket_id = int(match.group(1))
+        if notification.notification_type in ITEM_MODELS:
+            model_name, prefix = ITEM_MODELS[notification.notification_type]
+            items = apps.get_model('tracker', model_name).objects.filter(ticket_id=notification.ticket_id)
+            # expeditures are rendered as "description (amount currency)"
+            named = [item.id for item in items if '<tt>%s (%s ' % (item.description, item.amount) in notification.text]
+            if len(named) == 1:
+                notification.event_key = '%s:%d' % (prefix, named[0])
+        notification.save(update_fields=['ticket_id', 'event_key'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracker', '0094_mediainfo_synced_hash'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_notifications, migrations.RunPython.noop),
+    ]
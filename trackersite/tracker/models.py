@@ -1,13 +1,15 @@
 # -*- coding: utf-8 -*-
 import datetime
 import decimal
+import hashlib
 import json
 import logging
 import re
-from collections import OrderedDict
+import threading
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
 
 from background_task import background
-from background_task.models import Task
 from background_task.signals import task_error
 from django import template
 from django.conf import settings
@@ -20,7 +22,8 @@ from django.core.cache import cache
 from django.core.files.storage import FileSystemStorage
 from django.core.validators import RegexValidator
 from django.db import models
-from django.db.models.signals import pre_save, post_save, post_delete
+from django.db.models.functions import Coalesce
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
 from django.dispatch import receiver
 from django.forms.models import model_to_dict
 from django.urls import NoReverseMatch
@@ -29,7 +32,7 @@ from django.utils import timezone
 from django.utils import translation
 from django.utils.encoding import force_text
 from django.utils.formats import number_format
-from django.utils.functional import cached_property
+from django.utils.functional import cached_property, Promise
 from django.utils.html import escape
 from django.utils.safestring import mark_safe
 from django.utils.text import format_lazy
@@ -38,9 +41,9 @@ from django_comments.moderation import CommentModerator, moderator
 from django_comments.signals import comment_was_posted
 from pytz import utc
 
-from socialauth.api import MediaWiki
-from tracker.services import get_request
-from tracker.utils import notify_on_failure
+from socialauth.api import MediaWiki, check_token, forget_token_status
+from tracker.services import get_request, get_request_cache
+from tracker.utils import notify_on_failure, schedule_ticket_job
 from users.models import UserWrapper
 
 PAYMENT_STATUS_CHOICES = (
@@ -62,6 +65,20 @@ ACK_TYPES = (
     ('close', _('closed')),
 )
 
+TICKET_STATES = (
+    ('historical', _('historical')),
+    ('closed', _('closed')),
+    ('archived', _('archived')),
+    ('wfrating', _('waiting for content rating')),
+    ('complete', _('complete')),
+    ('wffill', _('waiting for filing of documents')),
+    ('wfdocssub', _('waiting for document submission')),
+    ('wfapproval', _('waiting for approval')),
+    ('wfsubmiting', _('waiting for submitting')),
+    ('wfpreapproval', _('waiting for preapproval')),
+    ('draft', _('draft')),
+)
+
 NOTIFICATION_TYPES = [
     ('muted', _('All notifications')),
     ('comment', _('Comment added')),
@@ -118,12 +135,18 @@ class ModelDiffMixin(object):
         """
         return self.diff.get(field_name, None)
 
+    def reset_diff(self):
+        """
+        Takes current state as the initial one.
+        """
+        self.__initial = self._dict
+
     def save(self, *args, **kwargs):
         """
         Saves model and set initial state.
         """
         super(ModelDiffMixin, self).save(*args, **kwargs)
-        self.__initial = self._dict
+        self.reset_diff()
 
     @property
     def _dict(self):
@@ -142,6 +165,26 @@ def get_user(support_none=False):
         return r.user
 
 
+_bulk_deletion = threading.local()
+
+
+@contextmanager
+def bulk_deletion():
+    """
+    Ticket items deleted within this block don't get post_delete receivers run one by one; the caller does what they
+    would have done for all of them at once (see BulkMixin.bulk_destroy).
+    """
+    _bulk_deletion.active = True
+    try:
+        yield
+    finally:
+        _bulk_deletion.active = False
+
+
+def in_bulk_deletion():
+    return getattr(_bulk_deletion, 'active', False)
+
+
 def uber_ack(ack_type):
     """ Return 'super-ack' for given user-editable ack. """
     return {
@@ -151,6 +194,39 @@ def uber_ack(ack_type):
     }[ack_type]
 
 
+def ticket_state(imported, rating_percentage, acks):
+    """ Return state code (see TICKET_STATES) of a ticket with given attributes and set of ack types. """
+    if imported:
+        return 'historical'
+
+    if 'close' in acks:
+        return 'closed'
+    elif 'archive' in acks:
+        return 'archived'
+    elif 'content' in acks:
+        if not rating_percentage:
+            return 'wfrating'
+
+        if 'docs' in acks:
+            return 'complete'
+        elif 'user_docs' in acks:
+            return 'wffill'
+        else:
+            return 'wfdocssub'
+    elif 'precontent' in acks:
+        if 'user_content' in acks:
+            return 'wfapproval'
+        else:
+            return 'wfsubmiting'
+    else:
+        if 'user_precontent' in acks:
+            return 'wfpreapproval'
+        elif 'user_content' in acks:
+            return 'wfapproval'
+        else:
+            return 'draft'
+
+
 def money(value):
     # TODO: Import this from tracker.templatetags.trackertags (Txxxxx)
     if value == 0:
@@ -176,43 +252,123 @@ class Model(models.Model):
         abstract = True
 
 
-class CachedModel(Model):
-    """ Model which has some values cached """
+class CachedMixin(object):
+    """
+    Object which has some values cached. Each object has a version, bumping it invalidates all of its cached values at
+    once. Cached values of other objects, which aggregate over this one, are listed by cache_dependents() and are
+    invalidated together with it.
+    """
+
+    @property
+    def cache_id(self):
+        return self.id
+
+    @staticmethod
+    def version_key(class_name, object_id):
+        return u'm:%s:%s:_version' % (class_name, object_id)
 
     def _get_item_key(self, name):
-        return u'm:%s:%s:%s' % (self.__class__.__name__, self.id, name)
+        return u'm:%s:%s:%s' % (self.__class__.__name__, self.cache_id, name)
 
     def _get_version_key(self):
-        return u'm:%s:%s:_version' % (self.__class__.__name__, self.id)
+        return CachedMixin.version_key(self.__class__.__name__, self.cache_id)
 
-    def _cache_version(self):
-        return cache.get(self._get_version_key()) or 1
+    def cache_dependents(self):
+        """ Version keys of objects, whose cached values depend on this object """
+        return []
+
+    @staticmethod
+    def _fetch(keys):
+        """ Get keys from the request-local cache, asking memcached only for those which are not there yet """
+        local = get_request_cache()
+        missing = [key for key in keys if key not in local]
+        if missing:
+            found = cache.get_many(missing)
+            local.update({key: found.get(key) for key in missing})
+        return {key: local[key] for key in keys}
 
     def flush_cache(self):
-        cache.set(self._get_version_key(), self._cache_version() + 1)
+        self.__dict__.pop('_cache_prefetched', None)
+        keys = [self._get_version_key()] + self.cache_dependents()
+        versions = cache.get_many(keys)
+        versions = {key: (versions.get(key) or 1) + 1 for key in keys}
+        cache.set_many(versions, timeout=None)
+        get_request_cache().update(versions)
 
     flush_cache.alters_data = True
 
+    @classmethod
+    def compute_cached_values(cls, name, objects):
+        """ Compute cached value `name` of all given objects, returns dictionary cache_id -> value """
+        raw_method = getattr(cls, name).raw_method
+        return {obj.cache_id: raw_method(obj) for obj in objects}
+
+    @classmethod
+    def prefetch_cache(cls, objects, names):
+        """
+        Load given cached values of all objects with one cache round trip. Missing values are computed for all objects
+        at once by compute_cached_values() and written back with one set_many. Values are kept on the objects (for use
+        in one request).
+        """
+        objects = list(objects)
+        keys = [obj._get_version_key() for obj in objects]
+        keys += [obj._get_item_key(name) for obj in objects for name in names]
+        found = cache.get_many(keys)
+
+        missing = {}
+        for obj in objects:
+            version = found.get(obj._get_version_key()) or 1
+            obj._cache_prefetched = {}
+            for name in names:
+                entry = found.get(obj._get_item_key(name))
+                if isinstance(entry, tuple) and entry[0] == version:
+                    obj._cache_prefetched[name] = entry[1]
+                else:
+                    missing.setdefault(name, []).append((obj, version))
+
+        computed = {}
+        for name, missed in missing.items():
+            values = cls.compute_cached_values(name, [obj for obj, _ in missed])
+            for obj, version in missed:
+                obj._cache_prefetched[name] = values[obj.cache_id]
+                computed[obj._get_item_key(name)] = (version, values[obj.cache_id])
+        if computed:
+            cache.set_many(computed)
+        return objects
+
     @staticmethod
     def cached_getter(raw_method):
         def wrapped(self):
+            prefetched = self.__dict__.get('_cache_prefetched', {})
+            if raw_method.__name__ in prefetched:
+                return prefetched[raw_method.__name__]
             key = self._get_item_key(raw_method.__name__)
-            version = self._cache_version()
-            cached = cache.get(key, version=version)
-            if cached is not None:
-                return cached
+            version_key = self._get_version_key()
+            found = CachedMixin._fetch([version_key, key])
+            version = found[version_key] or 1
+            # values are stored together with the version they were computed for
+            if isinstance(found[key], tuple) and found[key][0] == version:
+                return found[key][1]
             else:
                 value = raw_method(self)
-                cache.set(key, value, version=version)
+                cache.set(key, (version, value))
+                get_request_cache()[key] = (version, value)
                 return value
 
+        wrapped.__name__ = raw_method.__name__
+        wrapped.__doc__ = raw_method.__doc__
+        wrapped.raw_method = raw_method
         return wrapped
 
+
+class CachedModel(Model, CachedMixin):
+    """ Model which has some values cached """
+
     class Meta:
         abstract = True
 
 
-cached_getter = CachedModel.cached_getter
+cached_getter = CachedMixin.cached_getter
 
 
 class DecimalRangeField(models.DecimalField):
@@ -246,6 +402,138 @@ class Signature(Model):
     signed_text = models.TextField(_('Signed text'))
 
 
+def payment_status(expeditures, paid_expeditures):
+    """ Return payment status (see PAYMENT_STATUS_CHOICES) of a ticket with given numbers of all and paid expeditures. """
+    if expeditures == 0:
+        return 'n/a'
+    elif paid_expeditures == 0:
+        return 'unpaid'
+    elif paid_expeditures < expeditures:
+        return 'partially_paid'
+    else:
+        return 'paid'
+
+
+def ticket_state_annotations():
+    """
+    Annotations computing ticket state in SQL, the same way ticket_state does, from conditional aggregates over
+    ticket acks. The state code ends up in `computed_state`.
+    """
+    annotations = OrderedDict(
+        ('acks_%s' % ack_type, models.Count('ticketack', filter=models.Q(ticketack__ack_type=ack_type)))
+        for ack_type, label in ACK_TYPES
+    )
+
+    def has(ack_type):
+        return models.Q(**{'acks_%s__gt' % ack_type: 0})
+
+    annotations['computed_state'] = models.Case(
+        models.When(imported=True, then=models.Value('historical')),
+        models.When(has('close'), then=models.Value('closed')),
+        models.When(has('archive'), then=models.Value('archived')),
+        models.When(has('content') & (models.Q(rating_percentage__isnull=True) | models.Q(rating_percentage=0)),
+                    then=models.Value('wfrating')),
+        models.When(has('content') & has('docs'), then=models.Value('complete')),
+        models.When(has('content') & has('user_docs'), then=models.Value('wffill')),
+        models.When(has('content'), then=models.Value('wfdocssub')),
+        models.When(has('precontent') & has('user_content'), then=models.Value('wfapproval')),
+        models.When(has('precontent'), then=models.Value('wfsubmiting')),
+        models.When(has('user_precontent'), then=models.Value('wfpreapproval')),
+        models.When(has('user_content'), then=models.Value('wfapproval')),
+        default=models.Value('draft'),
+        output_field=models.CharField(max_length=20),
+    )
+    return annotations
+
+
+class TicketQuerySet(models.QuerySet):
+    def with_computed_state(self):
+        """ Annotate tickets with `computed_state`, see ticket_state_annotations """
+        return self.annotate(**ticket_state_annotations())
+
+    def update_payment_status(self):
+        """ Recompute payment status of all tickets in the queryset at once, see Ticket.update_payment_status """
+        counts = self.order_by().annotate(
+            expeditures=models.Count('expediture'),
+            paid_expeditures=models.Count('expediture', filter=models.Q(expediture__paid=True)),
+        ).values_list('id', 'expeditures', 'paid_expeditures')
+        statuses = {}
+        for ticket_id, expeditures, paid_expeditures in counts:
+            statuses.setdefault(payment_status(expeditures, paid_expeditures), []).append(ticket_id)
+        for status, ticket_ids in statuses.items():
+            self.model.objects.filter(id__in=ticket_ids).update(payment_status=status)
+            ChangeLogEntry.log(self.model, ticket_ids)
+
+    update_payment_status.alters_data = True
+
+    def _finance_rows(self, field):
+        return self.order_by().annotate(
+            expeditures_total=models.Sum('expediture__amount'),
+            paid_total=models.Sum('expediture__amount', filter=models.Q(expediture__paid=True)),
+            paid_wages_total=models.Sum('expediture__amount', filter=models.Q(expediture__paid=True, expediture__wage=True)),
+            content_acked=models.Exists(TicketAck.objects.filter(ticket=models.OuterRef('pk'), ack_type='content')),
+        ).values_list(field, 'rating_percentage', 'payment_status', 'expeditures_total', 'paid_total', 'paid_wages_total',
+                      'content_acked')
+
+    def finance_by(self, field):
+        """
+        Finance totals of tickets in the queryset grouped by value of given field (eg. 'topic_id' or
+        'topic__grant_id'), see TicketFinance. Sums of expeditures are computed by the database in one query,
+        reduction by rating percentage is done per ticket in Python, so that it's rounded the same way as Ticket's
+        methods.
+        """
+        finances = {}
+        for row in self._finance_rows(field):
+            finances.setdefault(row[0], TicketFinance()).add_ticket(*row[1:])
+        return finances
+
+    def finance(self):
+        """ Finance totals of all tickets in the queryset, see TicketFinance """
+        finance = TicketFinance()
+        for row in self._finance_rows('id'):
+            finance.add_ticket(*row[1:])
+        return finance
+
+    def for_listing(self):
+        """
+        Tickets prepared for ticket tables: related objects are joined or prefetched and amounts shown in the table are
+        annotated (as `listing_*`), so that Ticket.compute_cached_values() needs no further queries.
+        """
+        def total(items, aggregate):
+            return models.Subquery(items.filter(ticket=models.OuterRef('pk')).order_by().values('ticket').annotate(
+                total=aggregate).values('total'))
+
+        return self.select_related('topic__grant', 'subtopic', 'requested_user').prefetch_related(
+            'ticketack_set').annotate(
+            listing_expeditures_count=Coalesce(total(Expediture.objects, models.Count('id')), 0),
+            listing_expeditures_amount=total(Expediture.objects, models.Sum('amount')),
+            listing_paid_amount=total(Expediture.objects.filter(paid=True), models.Sum('amount')),
+            listing_preexpeditures_count=Coalesce(total(Preexpediture.objects, models.Count('id')), 0),
+            listing_preexpeditures_amount=total(Preexpediture.objects, models.Sum('amount')),
+            listing_media_count=(Coalesce(total(MediaInfoOld.objects, models.Sum('count')), 0) +
+                                 Coalesce(total(MediaInfo.objects, models.Count('id')), 0)),
+        )
+
+    def ready_for(self, ack):
+        """
+        Tickets to which given ack can be added already, see Ticket.can_ack_be_added.
+
+        Computed in the database: the corresponding user ack has to be older than
+        TRACKER_MIN_WAIT_DAYS and the ticket must not have the ack (nor be archived or closed) yet.
+        """
+        if ack not in WAIT_NEEDED_ACK_TYPES:
+            return self
+        acks = TicketAck.objects.filter(ticket=models.OuterRef('pk'))
+        blocking = ['archive', 'close', ack]
+        if ack == 'precontent':
+            blocking.append('content')  # HACK: To not include approved tickets that are "waiting for preapproval"
+        waited = timezone.now() - datetime.timedelta(days=settings.TRACKER_MIN_WAIT_DAYS)
+        return self.annotate(
+            user_ack_waited=models.Exists(acks.filter(ack_type='user_%s' % ack, added__lt=waited)),
+            ack_blocked=models.Exists(acks.filter(ack_type__in=blocking)),
+        ).filter(user_ack_waited=True, ack_blocked=False)
+
+
 class Ticket(CachedModel, ModelDiffMixin):
     """ One unit of tracked / paid stuff. """
     updated = models.DateTimeField(_('updated'))
@@ -288,23 +576,23 @@ class Ticket(CachedModel, ModelDiffMixin):
     car_travel = models.BooleanField(_('Did you travel by car?'), default=False,
                                      help_text=_('Do you request reimbursement of car-type travel expense?'))
     is_completed = models.BooleanField(_('Is this ticket completed?'), default=False)
+    state = models.CharField(_('state'), max_length=20, choices=TICKET_STATES, default='draft', db_index=True)
+
+    objects = TicketQuerySet.as_manager()
+
+    # cached values shown in ticket tables, see CachedMixin.prefetch_cache
+    listing_cached_getters = (
+        'media_count', 'preexpeditures', 'expeditures', 'accepted_expeditures', 'paid_expeditures', 'ack_set')
 
     @staticmethod
     def currency():
         return settings.TRACKER_CURRENCY
 
     def update_payment_status(self, save_afterwards=True):
-        paid_len = len(self.expediture_set.filter(paid=True))
-        all_len = len(self.expediture_set.all())
-
-        if all_len == 0:
-            self.payment_status = 'n/a'
-        elif paid_len == 0 and all_len > 0:
-            self.payment_status = 'unpaid'
-        elif paid_len < all_len:
-            self.payment_status = 'partially_paid'
-        elif paid_len == all_len:
-            self.payment_status = 'paid'
+        counts = {'all': 0, 'paid': 0}
+        if self.pk:
+            counts = self.expediture_set.aggregate(all=models.Count('id'), paid=models.Count('id', filter=models.Q(paid=True)))
+        self.payment_status = payment_status(counts['all'], counts['paid'])
 
         if save_afterwards:
             self.save(just_payment_status=True)
@@ -344,41 +632,42 @@ class Ticket(CachedModel, ModelDiffMixin):
         if not just_payment_status:
             self.update_payment_status(save_afterwards=False)
 
-        acks = self.ack_set()
+        acks = set(self.ticketack_set.values_list('ack_type', flat=True)) if self.pk else set()
         self.is_completed = ('archive' in acks) or ('close' in acks)
+        self.state = ticket_state(self.imported, self.rating_percentage, acks)
 
         super(Ticket, self).save(*args, **kwargs)
+        self.flush_cache()
+        # Django's Model.save() comes before ModelDiffMixin.save() in MRO
+        self.reset_diff()
 
-        # update MediaWiki templates if appropriate
+        # update MediaWiki templates if appropriate; payment status is not a part of them
         user_id = MediaInfo.get_maintenance_user_id()
         if get_request():
             user_id = get_request().user.id
-        if user_id:
-            Ticket._update_mediainfo(self.id, user_id)
-
-        self.flush_cache()
+        if user_id and not just_payment_status and settings.MEDIAINFO_MEDIAWIKI_TEMPLATE \
+                and settings.MEDIAINFO_MEDIAWIKI_INFO_TEMPLATE:
+            schedule_ticket_job(Ticket._update_mediainfo, self.id, user_id)
 
     @staticmethod
     @background(schedule=10)
     def _update_mediainfo(ticket_id, user_id):
         try:
-            ticket = Ticket.objects.get(id=ticket_id)
+            ticket = Ticket.objects.select_related('subtopic').get(id=ticket_id)
         except Ticket.DoesNotExist:
             return
-        for mi in ticket.mediainfo_set.all():
-            MediaInfo.add_to_mediawiki(mi.id, user_id)
+        media = list(ticket.mediainfo_set.all())
+        MediaInfo.resolve_pages(media, save=True)
+        MediaInfo.add_templates(ticket, media, user_id)
 
     def _note_comment(self, **kwargs):
         self.save()
 
     @staticmethod
-    def get_tickets_with_state(state):
-        tickets = Ticket.objects.all()
-        result = []
-        for ticket in tickets:
-            if ticket.state_str() == state:
-                result.append(ticket)
-        return result
+    def get_tickets_with_state(*states):
+        """ Tickets in any of given states, identified by their (translated) labels """
+        codes = [code for code, label in TICKET_STATES if label in states]
+        return Ticket.objects.filter(state__in=codes)
 
     def admin_topic(self):
         return '%s (%s)' % (self.topic, self.topic.grant)
@@ -386,37 +675,11 @@ class Ticket(CachedModel, ModelDiffMixin):
     def is_concept(self):
         return len(self.ack_set()) == 0
 
-    def state_str(self):
-        if self.imported:
-            return _('historical')
+    def state_code(self):
+        return ticket_state(self.imported, self.rating_percentage, self.ack_set())
 
-        acks = self.ack_set()
-        if 'close' in acks:
-            return _('closed')
-        elif 'archive' in acks:
-            return _('archived')
-        elif 'content' in acks:
-            if not self.rating_percentage:
-                return _('waiting for content rating')
-
-            if 'docs' in acks:
-                return _('complete')
-            elif 'user_docs' in acks:
-                return _('waiting for filing of documents')
-            else:
-                return _('waiting for document submission')
-        elif 'precontent' in acks:
-            if 'user_content' in acks:
-                return _('waiting for approval')
-            else:
-                return _('waiting for submitting')
-        else:
-            if 'user_precontent' in acks:
-                return _('waiting for preapproval')
-            elif 'user_content' in acks:
-                return _('waiting for approval')
-            else:
-                return _('draft')
+    def state_str(self):
+        return dict(TICKET_STATES)[self.state_code()]
 
     state_str.admin_order_field = 'state'
     state_str.short_description = _('state')
@@ -542,6 +805,8 @@ class Ticket(CachedModel, ModelDiffMixin):
 
     @cached_getter
     def ack_set(self):
+        if 'ticketack_set' in getattr(self, '_prefetched_objects_cache', {}):
+            return set([x.ack_type for x in self.ticketack_set.all()])
         return set([x.ack_type for x in self.ticketack_set.only('ack_type')])
 
     def has_ack(self, ack_type):
@@ -581,11 +846,34 @@ class Ticket(CachedModel, ModelDiffMixin):
             ticket = Ticket.objects.get(id=ticket_id)
         except Ticket.DoesNotExist:
             return
-        for media in ticket.mediainfo_set.all():
-            media.store_mediawiki_data_internal()
+        MediaInfo.refresh_mediawiki_data(list(ticket.mediainfo_set.all()))
         ticket.media_updated = datetime.datetime.now(tz=utc)
         ticket.save()
 
+    @staticmethod
+    @background(schedule=10)
+    def sync_media(ticket_id, user_id=None):
+        """
+        Refresh data of all media of the ticket from MediaWiki, and with user_id, add the tracker template to their
+        pages on behalf of that user. Scheduled once per ticket after media are added.
+        """
+        try:
+            ticket = Ticket.objects.select_related('subtopic').get(id=ticket_id)
+        except Ticket.DoesNotExist:
+            return
+        media = list(ticket.mediainfo_set.all())
+        MediaInfo.refresh_mediawiki_data(media)
+        if user_id:
+            MediaInfo.add_templates(ticket, media, user_id)
+        Ticket.objects.filter(id=ticket_id).update(media_updated=datetime.datetime.now(tz=utc))
+        ChangeLogEntry.log(Ticket, [ticket_id])
+
+    @staticmethod
+    def schedule_media_sync(ticket_ids, user_id=None):
+        """ Schedule sync_media for each of given tickets, see schedule_ticket_job """
+        for ticket_id in ticket_ids:
+            schedule_ticket_job(Ticket.sync_media, ticket_id, user_id)
+
     def get_cached_ticket(self):
         subtopic = self.subtopic
         if subtopic:
@@ -618,9 +906,79 @@ class Ticket(CachedModel, ModelDiffMixin):
                     photos_per_category[category.title] = 1
         return OrderedDict(sorted(photos_per_category.items(), key=lambda t: t[1], reverse=True))
 
-    def flush_cache(self):
-        super(Ticket, self).flush_cache()
-        self.topic.flush_cache()
+    @classmethod
+    def compute_cached_values(cls, name, objects):
+        """
+        Values shown in ticket tables are taken from annotations of TicketQuerySet.for_listing() if present, otherwise
+        they are computed with one grouped query
+        """
+        if objects and hasattr(objects[0], 'listing_media_count'):
+            values = {ticket.id: ticket._listing_value(name) for ticket in objects}
+            if None not in values.values():
+                return values
+        ids = [ticket.id for ticket in objects]
+        if name in ('expeditures', 'preexpeditures'):
+            item_model = Expediture if name == 'expeditures' else Preexpediture
+            values = {ticket_id: {'count': 0, 'amount': None} for ticket_id in ids}
+            for row in item_model.objects.filter(ticket_id__in=ids).order_by().values('ticket_id').annotate(
+                    count=models.Count('id'), amount=models.Sum('amount')):
+                values[row.pop('ticket_id')] = row
+            return values
+        elif name in ('accepted_expeditures', 'paid_expeditures'):
+            finances = Ticket.objects.filter(id__in=ids).finance_by('id')
+            attr = 'accepted' if name == 'accepted_expeditures' else 'paid'
+            return {ticket_id: getattr(finances[ticket_id], attr) for ticket_id in ids}
+        elif name == 'media_count':
+            values = dict.fromkeys(ids, 0)
+            for ticket_id, media in MediaInfoOld.objects.filter(ticket_id__in=ids).order_by().values_list(
+                    'ticket_id').annotate(media=models.Sum('count')):
+                values[ticket_id] += media or 0
+            for ticket_id, media in MediaInfo.objects.filter(ticket_id__in=ids).order_by().values_list(
+                    'ticket_id').annotate(media=models.Count('id')):
+                values[ticket_id] += media
+            return values
+        elif name == 'ack_set':
+            values = {ticket_id: set() for ticket_id in ids}
+            for ticket_id, ack_type in TicketAck.objects.filter(ticket_id__in=ids).values_list('ticket_id', 'ack_type'):
+                values[ticket_id].add(ack_type)
+            return values
+        return super(Ticket, cls).compute_cached_values(name, objects)
+
+    def _listing_value(self, name):
+        """ Value of cached getter `name` computed from annotations of TicketQuerySet.for_listing(), if possible """
+        if name == 'expeditures':
+            return {'count': self.listing_expeditures_count, 'amount': self.listing_expeditures_amount}
+        elif name == 'preexpeditures':
+            return {'count': self.listing_preexpeditures_count, 'amount': self.listing_preexpeditures_amount}
+        elif name == 'media_count':
+            return self.listing_media_count
+        elif name == 'ack_set':
+            return Ticket.ack_set.raw_method(self)
+        elif name in ('accepted_expeditures', 'paid_expeditures'):
+            if self.rating_percentage is None:
+                return decimal.Decimal(0)
+            if name == 'accepted_expeditures':
+                if 'content' not in Ticket.ack_set.raw_method(self):
+                    return decimal.Decimal(0)
+                return TicketSummary._reduce(self.listing_expeditures_amount or decimal.Decimal(0), self.rating_percentage)
+            return TicketSummary._reduce(self.listing_paid_amount or decimal.Decimal(0), self.rating_percentage)
+        return None
+
+    def cache_dependents(self):
+        """ Subtopics, topics, grants and requesters aggregating over this ticket, both current and previous ones """
+        subtopic_ids, topic_ids, user_ids = {self.subtopic_id}, {self.topic_id}, {self.requested_user_id}
+        for field, ids in (('subtopic', subtopic_ids), ('topic', topic_ids), ('requested_user', user_ids)):
+            ids.update(self.get_field_diff(field) or ())
+        if topic_ids == {self.topic_id}:
+            grant_ids = {self.topic.grant_id}
+        else:
+            grant_ids = set(Topic.objects.filter(id__in=topic_ids).values_list('grant_id', flat=True))
+        return [
+            CachedMixin.version_key(class_name, object_id)
+            for class_name, ids in (
+                ('Subtopic', subtopic_ids), ('Topic', topic_ids), ('Grant', grant_ids), ('TrackerProfile', user_ids))
+            for object_id in ids if object_id is not None
+        ]
 
     def can_ack_be_added(self, ack):
         """
@@ -669,6 +1027,148 @@ class TicketModerator(CommentModerator):
 moderator.register(Ticket, TicketModerator)
 
 
+class TicketSummary(models.Model):
+    """
+    Denormalized summary of a ticket, as shown in ticket listings.
+
+    Rows are kept up to date by signal receivers on the models the summary
+    is computed from; `manage.py rebuildticketsummary` recomputes all of them.
+    """
+    ticket = models.OneToOneField('tracker.Ticket', primary_key=True, related_name='summary',
+                                  on_delete=models.DO_NOTHING, db_constraint=False)
+    state = models.CharField(_('state'), max_length=20, choices=TICKET_STATES, db_index=True)
+    grant_name = models.CharField(max_length=80, db_index=True)
+    grant_slug = models.SlugField()
+    topic_name = models.CharField(max_length=80, db_index=True)
+    subtopic_name = models.CharField(max_length=80, blank=True)
+    requested_by = models.CharField(max_length=150, blank=True, db_index=True)
+    preexpeditures_amount = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    expeditures_amount = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    accepted_expeditures = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    paid_expeditures = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    media_count = models.PositiveIntegerField(default=0)
+    refreshed = models.DateTimeField(auto_now=True)
+
+    @staticmethod
+    def _reduce(total, rating_percentage):
+        reduced = total * rating_percentage / 100
+        return reduced.quantize(decimal.Decimal('0.01'), rounding=decimal.ROUND_HALF_UP)
+
+    @staticmethod
+    def from_ticket(ticket, acks, preexpeditures, expeditures, paid, media_count):
+        """
+        Build (unsaved) summary of given ticket. Ticket's topic, grant, subtopic and requested_user should be
+        loaded already; the rest is passed in, so that callers can compute it for many tickets at once.
+        """
+        summary = TicketSummary(
+            ticket=ticket,
+            state=ticket_state(ticket.imported, ticket.rating_percentage, acks),
+            grant_name=ticket.topic.grant.full_name,
+            grant_slug=ticket.topic.grant.slug,
+            topic_name=ticket.topic.name,
+            subtopic_name=ticket.subtopic.name if ticket.subtopic else '',
+            requested_by=ticket.requested_user.username if ticket.requested_user else ticket.requested_text,
+            preexpeditures_amount=preexpeditures,
+            expeditures_amount=expeditures,
+            media_count=media_count,
+        )
+        if ticket.rating_percentage is not None:
+            if 'content' in acks:
+                summary.accepted_expeditures = TicketSummary._reduce(expeditures, ticket.rating_percentage)
+            summary.paid_expeditures = TicketSummary._reduce(paid, ticket.rating_percentage)
+        return summary
+
+    @staticmethod
+    def refresh(ticket_id):
+        """ Recompute summary of given ticket """
+        try:
+            ticket = Ticket.objects.select_related('topic__grant', 'subtopic', 'requested_user').get(id=ticket_id)
+        except Ticket.DoesNotExist:
+            TicketSummary.objects.filter(ticket_id=ticket_id).delete()
+            return
+        expeditures = ticket.expediture_set.aggregate(
+            amount=models.Sum('amount'),
+            paid=models.Sum('amount', filter=models.Q(paid=True)),
+        )
+        media_count = (ticket.mediainfoold_set.aggregate(media=models.Sum('count'))['media'] or 0) + ticket.mediainfo_set.count()
+        TicketSummary.from_ticket(
+            ticket,
+            set(ticket.ticketack_set.values_list('ack_type', flat=True)),
+            ticket.preexpediture_set.aggregate(amount=models.Sum('amount'))['amount'] or decimal.Decimal(0),
+            expeditures['amount'] or decimal.Decimal(0),
+            expeditures['paid'] or decimal.Decimal(0),
+            media_count,
+        ).save()
+
+    @staticmethod
+    def rebuild(ticket_ids=None, batch_size=500):
+        """ Recompute summaries of given tickets (all by default), using a fixed number of queries per batch """
+        tickets = Ticket.objects.select_related('topic__grant', 'subtopic', 'requested_user').order_by('id')
+        if ticket_ids is None:
+            TicketSummary.objects.all().delete()
+            ticket_ids = list(tickets.values_list('id', flat=True))
+        else:
+            ticket_ids = sorted(ticket_ids)
+        for i in range(0, len(ticket_ids), batch_size):
+            batch = ticket_ids[i:i + batch_size]
+            TicketSummary.objects.filter(ticket_id__in=batch).delete()
+            acks = {}
+            for ticket_id, ack_type in TicketAck.objects.filter(ticket_id__in=batch).values_list('ticket_id', 'ack_type'):
+                acks.setdefault(ticket_id, set()).add(ack_type)
+            preexpeditures = dict(Preexpediture.objects.filter(ticket_id__in=batch).values('ticket_id').annotate(
+                total=models.Sum('amount')).values_list('ticket_id', 'total'))
+            expeditures = {row['ticket_id']: row for row in Expediture.objects.filter(ticket_id__in=batch).values('ticket_id').annotate(
+                total=models.Sum('amount'), paid_total=models.Sum('amount', filter=models.Q(paid=True)))}
+            media = dict(MediaInfo.objects.filter(ticket_id__in=batch).values('ticket_id').annotate(
+                total=models.Count('id')).values_list('ticket_id', 'total'))
+            media_old = dict(MediaInfoOld.objects.filter(ticket_id__in=batch).values('ticket_id').annotate(
+                total=models.Sum('count')).values_list('ticket_id', 'total'))
+
+            summaries = []
+            for ticket in tickets.filter(id__in=batch):
+                exp = expeditures.get(ticket.id, {})
+                summaries.append(TicketSummary.from_ticket(
+                    ticket,
+                    acks.get(ticket.id, set()),
+                    preexpeditures.get(ticket.id) or decimal.Decimal(0),
+                    exp.get('total') or decimal.Decimal(0),
+                    exp.get('paid_total') or decimal.Decimal(0),
+                    media.get(ticket.id, 0) + (media_old.get(ticket.id) or 0),
+                ))
+            TicketSummary.objects.bulk_create(summaries)
+
+    def as_row(self):
+        """ Render the summary as a row of the ticket list, see Ticket.get_cached_ticket """
+        ticket = self.ticket
+        ticket_url = reverse('ticket_detail', kwargs={'pk': self.ticket_id})
+        if ticket.subtopic_id:
+            subtopic = '<a href="%s">%s</a>' % (reverse('subtopic_detail', kwargs={'pk': ticket.subtopic_id}), self.subtopic_name)
+        else:
+            subtopic = ''
+        if ticket.requested_user_id:
+            requested_by = '<a href="%s">%s</a>' % (reverse('user_detail', kwargs={'username': self.requested_by}), escape(self.requested_by))
+        else:
+            requested_by = escape(self.requested_by)
+        return [
+            '<a href="%s">%s</a>' % (ticket_url, self.ticket_id),
+            str(ticket.event_date),
+            '<a class="ticket-summary" href="%s">%s</a>' % (ticket_url, escape(ticket.name)),
+            '<a href="%s">%s</a>' % (reverse('grant_detail', kwargs={'slug': self.grant_slug}), self.grant_name),
+            '<a href="%s">%s</a>' % (reverse('topic_detail', kwargs={'pk': ticket.topic_id}), self.topic_name),
+            subtopic,
+            requested_by,
+            money(self.preexpeditures_amount),
+            money(self.expeditures_amount),
+            money(self.accepted_expeditures),
+            money(self.paid_expeditures),
+            str(self.get_state_display()),
+            str(ticket.updated),
+        ]
+
+    def __str__(self):
+        return str(self.ticket_id)
+
+
 class FinanceStatus(object):
     """ This is not a model, but rather a representation of topic finance status. """
 
@@ -724,7 +1224,72 @@ class FinanceStatus(object):
         return {'fuzzy': self.fuzzy, 'unpaid': self.unpaid, 'paid': self.paid, 'overpaid': self.overpaid}
 
 
-class Subtopic(CachedModel):
+class TicketFinance(object):
+    """ Finance totals of a group of tickets, computed by TicketQuerySet.finance() and finance_by(). """
+
+    def __init__(self):
+        self.tickets = 0
+        self.tickets_per_payment_status = {}
+        self.expeditures = decimal.Decimal(0)
+        self.paid_expeditures = decimal.Decimal(0)  # not reduced by rating percentage
+        self.accepted = decimal.Decimal(0)  # sum of Ticket.accepted_expeditures
+        self.paid = decimal.Decimal(0)  # sum of Ticket.paid_expeditures
+        self.paid_wages = decimal.Decimal(0)
+        self.status = FinanceStatus()
+
+    def add_ticket(self, rating_percentage, payment_status, expeditures, paid, paid_wages, content_acked):
+        """ Add one ticket, given its rating, payment status, sums of its expeditures and whether it's accepted """
+        expeditures = expeditures or decimal.Decimal(0)
+        paid = paid or decimal.Decimal(0)
+        self.tickets += 1
+        self.tickets_per_payment_status[payment_status] = self.tickets_per_payment_status.get(payment_status, 0) + 1
+        self.expeditures += expeditures
+        self.paid_expeditures += paid
+        if rating_percentage is None:
+            return
+
+        accepted = TicketSummary._reduce(expeditures, rating_percentage) if content_acked else decimal.Decimal(0)
+        self.accepted += accepted
+        self.paid += TicketSummary._reduce(paid, rating_percentage)
+        self.paid_wages += (paid_wages or decimal.Decimal(0)) * rating_percentage / 100
+        if payment_status == 'unpaid':
+            self.status.unpaid += accepted
+        elif payment_status == 'paid':
+            self.status.paid += accepted
+        elif payment_status == 'partially_paid':
+            self.status.paid += paid * rating_percentage / 100
+            self.status.unpaid += (expeditures - paid) * rating_percentage / 100
+
+
+class TicketFinanceMixin(object):
+    """
+    Model summarizing finance of its tickets, which are those with `finance_ticket_field` equal to `finance_key`.
+    Use prefetch_finance() to compute finance of many objects at once.
+    """
+    finance_ticket_field = None
+
+    @property
+    def finance_key(self):
+        return self.pk
+
+    def finance(self):
+        if getattr(self, '_finance', None) is not None:
+            return self._finance
+        return Ticket.objects.filter(**{self.finance_ticket_field: self.finance_key}).finance()
+
+    @classmethod
+    def prefetch_finance(cls, objects):
+        """ Compute finance of all given objects with one query; it's kept on the objects (for use in one request) """
+        objects = list(objects)
+        finances = Ticket.objects.filter(**{
+            '%s__in' % cls.finance_ticket_field: [obj.finance_key for obj in objects]
+        }).finance_by(cls.finance_ticket_field)
+        for obj in objects:
+            obj._finance = finances.get(obj.finance_key, TicketFinance())
+        return objects
+
+
+class Subtopic(CachedModel, TicketFinanceMixin):
     name = models.CharField(_('name'), max_length=80)
     description = models.TextField(_('description'), blank=True,
                                    help_text=_('Description shown to users who enter tickets for this subtopic'))
@@ -733,6 +1298,11 @@ class Subtopic(CachedModel):
     topic = models.ForeignKey('tracker.Topic', verbose_name=_('topic'),
                               help_text=_('Topic where this subtopic belongs'), on_delete=models.CASCADE)
 
+    finance_ticket_field = 'subtopic_id'
+
+    def cache_dependents(self):
+        return [CachedMixin.version_key('Topic', self.topic_id)]
+
     def __str__(self):
         return self.name
 
@@ -741,7 +1311,7 @@ class Subtopic(CachedModel):
 
     @cached_getter
     def media_count(self):
-        return sum([len(t.mediainfo_set.all()) for t in self.ticket_set.all()])
+        return MediaInfo.objects.filter(ticket__subtopic_id=self.id).count()
 
     @cached_getter
     def expeditures(self):
@@ -757,37 +1327,19 @@ class Subtopic(CachedModel):
 
     @cached_getter
     def accepted_expeditures(self):
-        return sum([t.accepted_expeditures() for t in self.ticket_set.filter(rating_percentage__gt=0)])
+        return self.finance().accepted
 
     @cached_getter
     def tickets_per_payment_status(self):
-        out = {}
-        tickets = self.ticket_set.order_by()  # remove default ordering as it b0rks our aggregation
-        for s in tickets.values('payment_status').annotate(models.Count('payment_status')):
-            out[s['payment_status']] = s['payment_status__count']
-        return out
+        return self.finance().tickets_per_payment_status
 
     @cached_getter
     def paid_wages(self):
-        tosum = []
-        for ticket in self.ticket_set.filter(id__gt=0):
-            ticketsum = []
-            for expediture in ticket.expediture_set.filter(wage=True, paid=True):
-                ticketsum.append(expediture.amount)
-            if ticket.rating_percentage:
-                tosum.append(sum(ticketsum) * ticket.rating_percentage / 100)
-        return sum(tosum)
+        return self.finance().paid_wages
 
     @cached_getter
     def paid_together(self):
-        tosum = []
-        for ticket in self.ticket_set.filter(id__gt=0):
-            ticketsum = []
-            for expediture in ticket.expediture_set.filter(paid=True):
-                ticketsum.append(expediture.amount)
-            if ticket.rating_percentage:
-                tosum.append(decimal.Decimal(sum(ticketsum)) * ticket.rating_percentage / 100)
-        return sum(tosum)
+        return self.finance().paid
 
     class Meta:
         verbose_name = _('Subtopic')
@@ -795,7 +1347,7 @@ class Subtopic(CachedModel):
         ordering = ['name']
 
 
-class Topic(CachedModel):
+class Topic(CachedModel, TicketFinanceMixin):
     """ Topics according to which the tickets are grouped. """
     name = models.CharField(_('name'), max_length=80)
     grant = models.ForeignKey('tracker.Grant', verbose_name=_('grant'),
@@ -820,6 +1372,11 @@ class Topic(CachedModel):
     admin = models.ManyToManyField('auth.User', verbose_name=_('topic administrator'), blank=True,
                                    help_text=_('Selected users will have administration access to this topic.'))
 
+    finance_ticket_field = 'topic_id'
+
+    def cache_dependents(self):
+        return [CachedMixin.version_key('Grant', self.grant_id)]
+
     def __str__(self):
         return self.name
 
@@ -828,7 +1385,7 @@ class Topic(CachedModel):
 
     @cached_getter
     def media_count(self):
-        return sum([len(t.mediainfo_set.all()) for t in self.ticket_set.all()]) + (MediaInfoOld.objects.extra(
+        return MediaInfo.objects.filter(ticket__topic_id=self.id).count() + (MediaInfoOld.objects.extra(
             where=['ticket_id in (select id from tracker_ticket where topic_id = %s)'], params=[self.id]).aggregate(
             objects=models.Count('id'), media=models.Sum('count'))['media'] or 0)
 
@@ -846,38 +1403,23 @@ class Topic(CachedModel):
 
     @cached_getter
     def accepted_expeditures(self):
-        return sum([t.accepted_expeditures() for t in self.ticket_set.filter(rating_percentage__gt=0)])
+        return self.finance().accepted
 
     @cached_getter
     def tickets_per_payment_status(self):
-        out = {}
-        tickets = self.ticket_set.order_by()  # remove default ordering as it b0rks our aggregation
-        for s in tickets.values('payment_status').annotate(models.Count('payment_status')):
-            out[s['payment_status']] = s['payment_status__count']
-        return out
+        return self.finance().tickets_per_payment_status
 
     @cached_getter
     def paid_wages(self):
-        tosum = []
-        for ticket in self.ticket_set.filter(id__gt=0):
-            ticketsum = []
-            for expediture in ticket.expediture_set.filter(wage=True, paid=True):
-                ticketsum.append(expediture.amount)
-            if ticket.rating_percentage:
-                tosum.append(decimal.Decimal(sum(ticketsum) * ticket.rating_percentage / 100))
-        return sum(tosum)
+        return self.finance().paid_wages
 
     @cached_getter
     def paid_together(self):
-        return sum([t.paid_expeditures() for t in self.ticket_set.all()])
+        return self.finance().paid
 
     @cached_getter
     def payment_summary(self):
-        finance = FinanceStatus()
-        for ticket in self.ticket_set.all():
-            finance.add_ticket(ticket)
-
-        return finance
+        return self.finance().status
 
     def watches(self, user, event):
         """Watches given user this topic?"""
@@ -893,7 +1435,7 @@ class Topic(CachedModel):
         )
 
 
-class Grant(CachedModel):
+class Grant(CachedModel, TicketFinanceMixin):
     """ Grant is the bigger thing above topics """
     full_name = models.CharField(_('full name'), max_length=80, help_text=_('Full name for headlines and such'))
     short_name = models.CharField(_('short name'), max_length=16, help_text=_('Shorter name for use in tables'))
@@ -901,6 +1443,8 @@ class Grant(CachedModel):
     description = models.TextField(_('description'), blank=True, help_text=_(
         'Detailed description; HTML is allowed for now, line breaks are auto-parsed'))
 
+    finance_ticket_field = 'topic__grant_id'
+
     def __str__(self):
         return self.full_name
 
@@ -919,24 +1463,19 @@ class Grant(CachedModel):
 
     @cached_getter
     def total_tickets(self):
-        return sum([x.ticket_set.count() for x in self.topic_set.all()])
+        return self.finance().tickets
 
     @cached_getter
     def total_paid_wages(self):
-        return sum([x.paid_wages() for x in self.topic_set.all()])
+        return self.finance().paid_wages
 
     @cached_getter
     def total_paid_together(self):
-        return sum([x.paid_together() for x in self.topic_set.all()])
+        return self.finance().paid
 
     @cached_getter
     def tickets_per_payment_status(self):
-        out = {}
-        for topic in self.topic_set.all():
-            tickets = topic.ticket_set.order_by()  # remove default ordering as it b0rks our aggregation
-            for s in tickets.values('payment_status').annotate(models.Count('payment_status')):
-                out[s['payment_status']] = s['payment_status__count']
-        return out
+        return self.finance().tickets_per_payment_status
 
     class Meta:
         verbose_name = _('Grant')
@@ -988,19 +1527,45 @@ class MediaInfo(Model):
     width = models.IntegerField(_('width'), null=True)
     height = models.IntegerField(_('height'), null=True)
     thumb_url = models.URLField(_('URL'), max_length=500, null=True, blank=True)
+    synced_hash = models.CharField(_('synced hash'), max_length=40, blank=True,
+                                   help_text=_('Hash of the page and template last added to it on MediaWiki'))
+
+    @staticmethod
+    def resolve_pages(media, save=False):
+        """
+        Fill in page IDs of given media which only have a (then canonicalized) title, and titles of those which only
+        have a page ID, asking MediaWiki about up to 50 of them at once. With save, the filled in media are saved
+        (without any side effects of MediaInfo.save).
+        """
+        by_title = [m for m in media if not m.page_id and m.page_title]
+        by_id = [m for m in media if m.page_id and not m.page_title]
+        if not by_title and not by_id:
+            return
+        titles, pageids = MediaWiki(user=None).query_pages(
+            titles=[m.page_title for m in by_title],
+            pageids=[m.page_id for m in by_id],
+        )
+        resolved = []
+        for m in by_title:
+            page = titles.get(m.page_title)
+            if page:
+                m.page_id, m.page_title = page['pageid'], page['title']
+                resolved.append(m)
+        for m in by_id:
+            page = pageids.get(m.page_id)
+            if page:
+                m.page_title = page['title']
+                resolved.append(m)
+        if save and resolved:
+            saved = [m for m in resolved if m.pk]
+            MediaInfo.objects.bulk_update(saved, ['page_id', 'page_title'])
+            ChangeLogEntry.log(MediaInfo, [m.id for m in saved])
 
     @property
     def media_id(self):
         if not self.page_id:
-            mw = MediaWiki(user=None)
-            data = mw.request({
-                "action": "query",
-                "format": "json",
-                "titles": self.page_title
-            }).json()
-            try:
-                self.page_id = int(list(data['query']['pages'].keys())[0])
-            except KeyError:
+            MediaInfo.resolve_pages([self])
+            if not self.page_id:
                 return None
             self.save()
         return self.page_id
@@ -1008,15 +1573,8 @@ class MediaInfo(Model):
     @cached_property
     def _as_str(self):
         if self.page_title == '' or self.page_title is None:
-            mw = MediaWiki(user=None)
-            data = mw.request({
-                "action": "query",
-                "format": "json",
-                "pageids": [self.page_id]
-            }).json()
-            try:
-                self.page_title = data['query']['pages'][list(data['query']['pages'].keys())[0]]['title']
-            except KeyError:
+            MediaInfo.resolve_pages([self])
+            if not self.page_title:
                 return None
             self.save()
         return self.page_title
@@ -1051,8 +1609,8 @@ class MediaInfo(Model):
         return -1
 
     @staticmethod
-    @background(schedule=10)
-    def remove_from_mediawiki(media_id, user_id):
+    def remove_templates(media_ids, user_id):
+        """ Strip the tracker template from given files (by page id) on MediaWiki """
         if not settings.MEDIAINFO_MEDIAWIKI_TEMPLATE or not settings.MEDIAINFO_MEDIAWIKI_INFO_TEMPLATE:
             return
 
@@ -1060,16 +1618,29 @@ class MediaInfo(Model):
             mw = MediaWiki(User.objects.get(id=user_id), settings.MEDIAINFO_MEDIAWIKI_API)
         except User.DoesNotExist:
             return
-        logging.getLogger(__name__).info('Removing MediaInfo %d from MediaWiki by user %d' % (media_id, user_id))
-        try:
-            mw.put_content(media_id, MediaInfo.strip_template(mw.get_content(media_id)), minor=True)
-        except ValueError:
-            # the edited page doesn't exist, ignore
-            pass
+        for media_id in media_ids:
+            logging.getLogger(__name__).info('Removing MediaInfo %d from MediaWiki by user %d' % (media_id, user_id))
+            try:
+                mw.put_content(media_id, MediaInfo.strip_template(mw.get_content(media_id)), minor=True)
+            except ValueError:
+                # the edited page doesn't exist, ignore
+                pass
+
+    @staticmethod
+    @background(schedule=10)
+    def remove_from_mediawiki(media_id, user_id):
+        MediaInfo.remove_templates([media_id], user_id)
+
+    @staticmethod
+    @background(schedule=10)
+    def remove_many_from_mediawiki(media_ids, user_id):
+        """ One job for files removed from tickets at once """
+        MediaInfo.remove_templates(media_ids, user_id)
 
     @staticmethod
     @background(schedule=10)
     def add_to_mediawiki(media_id, user_id):
+        """ Deprecated, only runs jobs queued before templates were added per ticket (see Ticket._update_mediainfo) """
         if not settings.MEDIAINFO_MEDIAWIKI_TEMPLATE or not settings.MEDIAINFO_MEDIAWIKI_INFO_TEMPLATE:
             return
 
@@ -1077,13 +1648,26 @@ class MediaInfo(Model):
             media = MediaInfo.objects.get(id=media_id)
         except MediaInfo.DoesNotExist:
             return
+
+        try:
+            mw = MediaWiki(User.objects.get(id=user_id), settings.MEDIAINFO_MEDIAWIKI_API)
+        except User.DoesNotExist:
+            return
+
+        media.add_template(mw, user_id)
+
+    def add_template(self, mw, user_id):
+        """
+        Add the tracker template to the file page of this media, edited through mw (a MediaWiki of user_id). Nothing
+        is done if the very same template was already synced to the same page (see synced_hash).
+        """
         parameters_unsorted = {
             'rok': datetime.date.today().year,
-            'podtéma': media.ticket.subtopic or '',
-            'tiket': media.ticket.id,
+            'podtéma': self.ticket.subtopic or '',
+            'tiket': self.ticket.id,
         }
-        if media.created is not None:
-            parameters_unsorted['rok'] = media.created.year
+        if self.created is not None:
+            parameters_unsorted['rok'] = self.created.year
         parameters = OrderedDict(sorted(parameters_unsorted.items(), key=lambda t: t[0]))
 
         template = '{{%s' % settings.MEDIAINFO_MEDIAWIKI_TEMPLATE
@@ -1091,27 +1675,41 @@ class MediaInfo(Model):
             template += "|%s=%s" % (param, str(parameters[param]))
         template += '}}'
 
-        try:
-            mw = MediaWiki(User.objects.get(id=user_id), settings.MEDIAINFO_MEDIAWIKI_API)
-        except User.DoesNotExist:
+        synced_hash = hashlib.sha1(('%s|%s' % (self.page_id, template)).encode('utf-8')).hexdigest()
+        if synced_hash == self.synced_hash:
             return
 
-        old = mw.get_content(media.page_id)
+        old = mw.get_content(self.page_id)
         if old is None:
             return
 
         if template not in old:
-            logging.getLogger(__name__).info('Adding MediaInfo %d from MediaWiki by user %d' % (media_id, user_id))
+            logging.getLogger(__name__).info('Adding MediaInfo %d from MediaWiki by user %d' % (self.id, user_id))
 
             old = MediaInfo.strip_template(old)
             insert_to = MediaInfo.get_template_end_position(old, settings.MEDIAINFO_MEDIAWIKI_INFO_TEMPLATE)
 
             if insert_to != -1:
-                new = old[:insert_to] + u"\n" + template + old[insert_to:]
-                mw.put_content(media.page_id, new)
-                return
+                mw.put_content(self.page_id, old[:insert_to] + u"\n" + template + old[insert_to:])
+            else:
+                mw.put_content(self.page_id, old + u"\n" + template, minor=True)
 
-            mw.put_content(media.page_id, old + u"\n" + template, minor=True)
+        self.synced_hash = synced_hash
+        MediaInfo.objects.filter(id=self.id).update(synced_hash=synced_hash)
+
+    @staticmethod
+    def add_templates(ticket, media, user_id):
+        """ Add the tracker template to pages of given media of the ticket, on behalf of given user """
+        if not settings.MEDIAINFO_MEDIAWIKI_TEMPLATE or not settings.MEDIAINFO_MEDIAWIKI_INFO_TEMPLATE:
+            return
+        try:
+            mw = MediaWiki(User.objects.get(id=user_id), settings.MEDIAINFO_MEDIAWIKI_API)
+        except User.DoesNotExist:
+            return
+        for mi in media:
+            if mi.page_id:
+                mi.ticket = ticket
+                mi.add_template(mw, user_id)
 
     def mediawiki_link(self):
         return settings.MEDIAINFO_MEDIAWIKI_ARTICLE + str(self)
@@ -1154,21 +1752,118 @@ class MediaInfo(Model):
                 self.get_mediawiki_data(width=width, delete_if_not_found=True)
                 return
 
-            imagedata = data['imageinfo'][0]
+            return MediaInfo._mediawiki_data(data, width)
+
+    @staticmethod
+    def _mediawiki_data(page, width):
+        imagedata = page['imageinfo'][0]
+
+        if width:
+            url = imagedata['thumburl']
+        else:
+            url = imagedata['url']
+
+        return {
+            "url": url,
+            "page_title": imagedata['canonicaltitle'],
+            'width': imagedata['width'],
+            'height': imagedata['height'],
+            'categories': page.get('categories', []),
+            'globalusage': page.get("globalusage", [])
+        }
 
-            if width:
-                url = imagedata['thumburl']
+    @staticmethod
+    def fetch_mediawiki_data(media, width=None):
+        """
+        Get data of given media, like get_mediawiki_data does, asking MediaWiki about up to 50 of them per request.
+        Returns dict mapping page IDs to the data; media which were not found are left out.
+        """
+        MediaInfo.resolve_pages([m for m in media if not m.page_id], save=True)  # titles come with the data
+        pageids = sorted({m.page_id for m in media if m.page_id})
+        pages = {}
+        mw = MediaWiki(user=None)
+        for i in range(0, len(pageids), MediaWiki.MAX_QUERY_PAGES):
+            for query in mw.query_continued({
+                "action": "query",
+                "format": "json",
+                "formatversion": 2,
+                "prop": "imageinfo|categories|globalusage",
+                "pageids": "|".join(str(page_id) for page_id in pageids[i:i + MediaWiki.MAX_QUERY_PAGES]),
+                "iiprop": "dimensions|url|canonicaltitle",
+                "iiurlwidth": width,
+                "clprop": "hidden",
+                "cllimit": "max",
+                "gulimit": "max",
+            }):
+                # a continued response carries the next part of categories and usages of the same pages
+                for page in query.get('pages', []):
+                    merged = pages.setdefault(page.get('pageid'), {'categories': [], 'globalusage': []})
+                    merged['categories'].extend(page.get('categories', []))
+                    merged['globalusage'].extend(page.get('globalusage', []))
+                    if 'imageinfo' in page:
+                        merged['imageinfo'] = page['imageinfo']
+        return {page_id: MediaInfo._mediawiki_data(page, width) for page_id, page in pages.items() if 'imageinfo' in page}
+
+    @staticmethod
+    def apply_mediawiki_data(media_data):
+        """
+        Store data from MediaWiki (as returned by get_mediawiki_data) of media, given as (media, data) pairs.
+        Categories and usages are diffed against the stored ones, so that only changed rows are written.
+        """
+        media = [m for m, data in media_data]
+        categories = set()
+        usages = set()
+        for m, data in media_data:
+            m.thumb_url = data['url']
+            m.page_title = data['page_title']
+            m.width = data.get('width')
+            m.height = data.get('height')
+            for category in data.get("categories", []):
+                if "hidden" not in category:
+                    categories.add((m.id, category['title']))
+            for usage in data.get("globalusage", []):
+                usages.add((m.id, usage["url"], usage["title"], usage["wiki"]))
+        MediaInfo.objects.bulk_update(media, ['page_id', 'page_title', 'thumb_url', 'width', 'height'], batch_size=500)
+        ChangeLogEntry.log(MediaInfo, [m.id for m in media])
+
+        stale = []
+        for category_id, *key in MediaInfoCategory.objects.filter(mediainfo__in=media).values_list('id', 'mediainfo_id', 'title'):
+            if tuple(key) in categories:
+                categories.remove(tuple(key))
+            else:
+                stale.append(category_id)
+        MediaInfoCategory.objects.filter(id__in=stale).delete()
+        MediaInfoCategory.objects.bulk_create(
+            MediaInfoCategory(mediainfo_id=mediainfo_id, title=title) for mediainfo_id, title in sorted(categories))
+
+        stale = []
+        for usage_id, *key in MediaInfoUsage.objects.filter(mediainfo__in=media).values_list('id', 'mediainfo_id', 'url', 'title', 'project'):
+            if tuple(key) in usages:
+                usages.remove(tuple(key))
             else:
-                url = imagedata['url']
+                stale.append(usage_id)
+        MediaInfoUsage.objects.filter(id__in=stale).delete()
+        MediaInfoUsage.objects.bulk_create(
+            MediaInfoUsage(mediainfo_id=mediainfo_id, url=url, title=title, project=project)
+            for mediainfo_id, url, title, project in sorted(usages))
 
-            return {
-                "url": url,
-                "page_title": imagedata['canonicaltitle'],
-                'width': imagedata['width'],
-                'height': imagedata['height'],
-                'categories': data.get('categories', []),
-                'globalusage': data.get("globalusage", [])
-            }
+    @staticmethod
+    def refresh_mediawiki_data(media, width=200):
+        """ Batch version of store_mediawiki_data_internal, for any number of media """
+        if not settings.MEDIAINFO_MEDIAWIKI_API:
+            return
+        data = MediaInfo.fetch_mediawiki_data(media, width)
+        not_found = [m for m in media if m.page_id not in data]
+        if not_found:
+            # as get_mediawiki_data does, reload page IDs of media not found using their titles, and drop media
+            # which are not found even then
+            for m in not_found:
+                m.page_id = None
+            data.update(MediaInfo.fetch_mediawiki_data(not_found, width))
+            gone = {m.id for m in not_found if m.page_id not in data}
+            MediaInfo.objects.filter(id__in=gone).delete()
+            media = [m for m in media if m.id not in gone]
+        MediaInfo.apply_mediawiki_data([(m, data[m.page_id]) for m in media])
 
     def store_mediawiki_data_internal(self):
         data = self.get_mediawiki_data(width=200)
@@ -1176,30 +1871,12 @@ class MediaInfo(Model):
         if data is None:
             return
 
-        self.thumb_url = data['url']
-        self.page_title = data['page_title']
-        self.width = data.get('width')
-        self.height = data.get('height')
-
-        self.mediainfocategory_set.all().delete()
-        for category in data.get("categories", []):
-            if "hidden" not in category:
-                MediaInfoCategory.objects.create(mediainfo=self, title=category['title'])
-
-        self.mediainfousage_set.all().delete()
-        for usage in data.get("globalusage", []):
-            MediaInfoUsage.objects.create(
-                mediainfo=self,
-                url=usage["url"],
-                title=usage["title"],
-                project=usage["wiki"]
-            )
-
-        self.save(no_update=True)
+        MediaInfo.apply_mediawiki_data([(self, data)])
 
     @staticmethod
     @background(schedule=10)
     def store_mediawiki_data(media_id):
+        """ Deprecated, only runs jobs queued before media were refreshed per ticket (see Ticket.update_media) """
         try:
             media = MediaInfo.objects.get(id=media_id)
         except MediaInfo.DoesNotExist:
@@ -1207,32 +1884,21 @@ class MediaInfo(Model):
         media.store_mediawiki_data_internal()
 
     def save(self, no_update=False, *args, **kwargs):
+        # Same as MediaInfo.media_id; done first, as it canonicalizes the title
+        if not self.page_id and self.page_title:
+            MediaInfo.resolve_pages([self])
+
         if MediaInfo.objects.filter(ticket_id=self.ticket_id, page_title=self.page_title).exclude(id=self.id).exists():
             # we found a duplicate, self destruct instead
             self.delete()
             return
 
-        # Same as MediaInfo.media_id
-        if not self.page_id and self.page_title:
-            mw = MediaWiki(user=None)
-            data = mw.request({
-                "action": "query",
-                "format": "json",
-                "titles": self.page_title
-            }).json()
-            self.page_id = int(list(data['query']['pages'].keys())[0])
-
         super(MediaInfo, self).save(*args, **kwargs)
 
-        if get_request() and settings.MEDIAINFO_MEDIAWIKI_TEMPLATE and settings.MEDIAINFO_MEDIAWIKI_INFO_TEMPLATE and not no_update:
-            logging.getLogger(__name__).info('Scheduling adding MediaInfo %d' % self.id)
-            MediaInfo.add_to_mediawiki(self.id, get_request().user.id)
-
         if not no_update:
-            MediaInfo.store_mediawiki_data(self.id)
-            if not Task.objects.filter(task_name="tracker.models.update_media",
-                                       task_params="[[%s], {}]" % self.ticket.id).exists():
-                Ticket.update_media(self.ticket.id)
+            # data of the media are refreshed (and the template added, if saved by a user) by one job per ticket
+            logging.getLogger(__name__).info('Scheduling sync of MediaInfo %d' % self.id)
+            Ticket.schedule_media_sync([self.ticket_id], get_request().user.id if get_request() else None)
 
     class Meta:
         verbose_name = _('Ticket media')
@@ -1245,6 +1911,8 @@ task_error.connect(notify_on_failure)
 
 @receiver(post_delete, sender=MediaInfo)
 def delete_mediainfo(sender, instance, **kwargs):
+    if in_bulk_deletion():
+        return
     if get_request() and settings.MEDIAINFO_MEDIAWIKI_TEMPLATE and settings.MEDIAINFO_MEDIAWIKI_INFO_TEMPLATE:
         MediaInfo.remove_from_mediawiki(instance.media_id, get_request().user.id)
 
@@ -1374,7 +2042,7 @@ class TrackerPreferences(models.Model):
         verbose_name_plural = _('Tracker user preferences')
 
 
-class TrackerProfile(models.Model):
+class TrackerProfile(models.Model, TicketFinanceMixin, CachedMixin):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     mediawiki_username = models.CharField(_('Username on mediawiki'), max_length=120, blank=True)
     chapter_username = models.CharField(_('Chapter-issued username'), max_length=120, blank=True)
@@ -1388,21 +2056,32 @@ class TrackerProfile(models.Model):
     def get_absolute_url(self):
         return reverse('user_detail', kwargs={'username': self.user.username})
 
+    @cached_getter
     def media_count(self):
-        return sum([len(t.mediainfo_set.all()) for t in self.user.ticket_set.all()]) + (MediaInfoOld.objects.extra(
+        return MediaInfo.objects.filter(ticket__requested_user_id=self.user_id).count() + (MediaInfoOld.objects.extra(
             where=['ticket_id in (select id from tracker_ticket where requested_user_id = %s)'],
             params=[self.user.id]).aggregate(media=models.Sum('count'))['media'] or 0)
 
+    finance_ticket_field = 'requested_user_id'
+
+    @property
+    def finance_key(self):
+        return self.user_id
+
+    @property
+    def cache_id(self):
+        # tickets know their requester, not their requester's profile
+        return self.user_id
+
+    @cached_getter
     def accepted_expeditures(self):
-        return sum([t.accepted_expeditures() for t in self.user.ticket_set.filter(rating_percentage__gt=0)])
+        return self.finance().accepted
 
+    @cached_getter
     def paid_expeditures(self):
-        tickets = self.user.ticket_set.all()
-        res = 0
-        for ticket in tickets:
-            res += sum(e.amount for e in Expediture.objects.filter(ticket_id=ticket.id, paid=True))
-        return res
+        return self.finance().paid_expeditures
 
+    @cached_getter
     def count_ticket_created(self):
         return len(self.user.ticket_set.all())
 
@@ -1417,6 +2096,15 @@ class TrackerProfile(models.Model):
         except UserSocialAuth.DoesNotExist:
             return False
 
+    @staticmethod
+    @background(schedule=0)
+    def revalidate_mediawiki_token(user_id):
+        try:
+            user = User.objects.get(id=user_id)
+        except User.DoesNotExist:
+            return
+        check_token(user)
+
     def __str__(self):
         return str(self.user)
 
@@ -1438,6 +2126,13 @@ def create_user_profile(sender, **kwargs):
         TrackerPreferences.objects.create(user=user)
 
 
+@receiver(post_save, sender=UserSocialAuth)
+@receiver(post_delete, sender=UserSocialAuth)
+def forget_mediawiki_token_status(sender, instance, **kwargs):
+    if instance.provider == 'mediawiki':
+        forget_token_status(instance.user_id)
+
+
 class Transaction(Model):
     """ One payment to or from the user. """
     date = models.DateField(_('date'))
@@ -1564,73 +2259,288 @@ def flush_ticket_after_ack_delete(sender, instance, **kwargs):
         instance.ticket.save()
 
 
+# TicketSummary maintenance. Saving an Expediture or adding/removing a TicketAck saves its ticket as well, so those are
+# covered by refresh_summary_after_ticket_save.
+@receiver(post_save, sender=Ticket)
+def refresh_summary_after_ticket_save(sender, instance, raw, **kwargs):
+    if not raw:
+        TicketSummary.refresh(instance.id)
+
+
+@receiver(post_delete, sender=Ticket)
+def delete_summary_after_ticket_delete(sender, instance, **kwargs):
+    TicketSummary.objects.filter(ticket_id=instance.id).delete()
+
+
+@receiver(post_save, sender=Preexpediture)
+@receiver(post_save, sender=MediaInfo)
+@receiver(post_save, sender=MediaInfoOld)
+def refresh_summary_after_item_save(sender, instance, raw, **kwargs):
+    if not raw:
+        TicketSummary.refresh(instance.ticket_id)
+
+
+@receiver(post_delete, sender=Preexpediture)
+@receiver(post_delete, sender=Expediture)
+@receiver(post_delete, sender=MediaInfo)
+@receiver(post_delete, sender=MediaInfoOld)
+def refresh_summary_after_item_delete(sender, instance, **kwargs):
+    if in_bulk_deletion():
+        return
+    TicketSummary.refresh(instance.ticket_id)
+
+
+@receiver(post_save, sender=Grant)
+def refresh_summary_after_grant_save(sender, instance, raw, **kwargs):
+    if not raw:
+        names = {'grant_name': instance.full_name, 'grant_slug': instance.slug}
+        TicketSummary.objects.filter(ticket__topic__grant=instance).exclude(**names).update(refreshed=timezone.now(), **names)
+
+
+@receiver(post_save, sender=Topic)
+def refresh_summary_after_topic_save(sender, instance, raw, **kwargs):
+    if not raw:
+        names = {'topic_name': instance.name, 'grant_name': instance.grant.full_name, 'grant_slug': instance.grant.slug}
+        TicketSummary.objects.filter(ticket__topic=instance).exclude(**names).update(refreshed=timezone.now(), **names)
+
+
+@receiver(post_save, sender=Subtopic)
+def refresh_summary_after_subtopic_save(sender, instance, raw, **kwargs):
+    if not raw:
+        TicketSummary.objects.filter(ticket__subtopic=instance).exclude(subtopic_name=instance.name).update(
+            subtopic_name=instance.name, refreshed=timezone.now())
+
+
+@receiver(pre_delete, sender=Subtopic)
+def refresh_summary_before_subtopic_delete(sender, instance, **kwargs):
+    TicketSummary.objects.filter(ticket__subtopic=instance).update(subtopic_name='', refreshed=timezone.now())
+
+
+@receiver(post_save, sender=User)
+def refresh_summary_after_user_save(sender, instance, raw, update_fields, **kwargs):
+    if not raw and (update_fields is None or 'username' in update_fields):
+        TicketSummary.objects.filter(ticket__requested_user=instance).exclude(requested_by=instance.username).update(
+            requested_by=instance.username, refreshed=timezone.now())
+
+
+# Cache invalidation. Saving a ticket flushes its cache (and the aggregates depending on it) in Ticket.save, saving an
+# Expediture or adding/removing a TicketAck saves its ticket as well.
+@receiver(post_delete, sender=Ticket)
+@receiver(post_save, sender=Subtopic)
+@receiver(post_delete, sender=Subtopic)
+@receiver(post_save, sender=Topic)
+@receiver(post_delete, sender=Topic)
+@receiver(post_save, sender=Grant)
+@receiver(post_delete, sender=Grant)
+def flush_cache_after_change(sender, instance, **kwargs):
+    instance.flush_cache()
+
+
+@receiver(pre_save, sender=Topic)
+def flush_grant_before_topic_move(sender, instance, raw, **kwargs):
+    if not raw and instance.id is not None:
+        old_grant_id = Topic.objects.filter(id=instance.id).values_list('grant_id', flat=True).first()
+        if old_grant_id not in (None, instance.grant_id):
+            Grant(id=old_grant_id).flush_cache()
+
+
+@receiver(post_save, sender=Preexpediture)
+@receiver(post_save, sender=MediaInfo)
+@receiver(post_save, sender=MediaInfoOld)
+@receiver(post_delete, sender=Preexpediture)
+@receiver(post_delete, sender=Expediture)
+@receiver(post_delete, sender=MediaInfo)
+@receiver(post_delete, sender=MediaInfoOld)
+def flush_ticket_after_item_change(sender, instance, **kwargs):
+    if kwargs.get('raw') or in_bulk_deletion():
+        return
+    try:
+        instance.ticket.flush_cache()
+    except Ticket.DoesNotExist:
+        pass
+
+
+class ChangeLogEntry(models.Model):
+    """
+    Append-only log of changes of objects exposed in the API, read by the /api/tracker/changes/ feed and the
+    updated_since filter. Id of the entry is its sequence number; entries are written by the receivers below and
+    explicitly by bulk updates, which don't send any signals. Entries older than TRACKER_CHANGE_LOG_RETENTION_DAYS
+    are pruned (see prune), positions before that can't be followed.
+    """
+    LOGGED_MODELS = ('grant', 'topic', 'subtopic', 'ticket', 'mediainfo', 'mediainfoold', 'expediture', 'preexpediture')
+
+    model = models.CharField(verbose_name=_('model'), max_length=20)
+    object_id = models.IntegerField(verbose_name=_('object id'))
+    deleted = models.BooleanField(verbose_name=_('deleted'), default=False)
+    changed = models.DateTimeField(verbose_name=_('changed'), auto_now_add=True)
+
+    @classmethod
+    def log(cls, model, object_ids, deleted=False):
+        """ Record a change of given objects of a model (class or model name); changes of other models are ignored """
+        name = model if isinstance(model, str) else model._meta.model_name
+        if name in cls.LOGGED_MODELS:
+            cls.objects.bulk_create([cls(model=name, object_id=object_id, deleted=deleted) for object_id in object_ids])
+
+    @classmethod
+    def last_seq(cls):
+        return cls.objects.aggregate(seq=models.Max('id'))['seq'] or 0
+
+    @staticmethod
+    def retained_since():
+        """ Time since which all changes are in the log """
+        return timezone.now() - datetime.timedelta(days=settings.TRACKER_CHANGE_LOG_RETENTION_DAYS)
+
+    @classmethod
+    def first_seq(cls):
+        """ Sequence number of the oldest entry kept; entries before it may have been pruned """
+        return cls.objects.aggregate(seq=models.Min('id'))['seq'] or 0
+
+    @classmethod
+    def prune(cls):
+        """ Delete entries older than TRACKER_CHANGE_LOG_RETENTION_DAYS, return how many """
+        # the last entry is kept, so that sequence numbers never start over (and ETags stay stable)
+        deleted, _rows = cls.objects.filter(changed__lt=cls.retained_since()).exclude(id=cls.last_seq()).delete()
+        return deleted
+
+    def __str__(self):
+        return '#%s %s %s' % (self.id, self.model, self.object_id)
+
+    class Meta:
+        verbose_name = _('Change log entry')
+        verbose_name_plural = _('Change log entries')
+        indexes = [models.Index(fields=['model', 'changed'])]
+
+
+@receiver(post_save, sender=Grant)
+@receiver(post_save, sender=Topic)
+@receiver(post_save, sender=Subtopic)
+@receiver(post_save, sender=Ticket)
+@receiver(post_save, sender=MediaInfo)
+@receiver(post_save, sender=MediaInfoOld)
+@receiver(post_save, sender=Expediture)
+@receiver(post_save, sender=Preexpediture)
+def log_change_after_save(sender, instance, raw, **kwargs):
+    if not raw:
+        ChangeLogEntry.log(sender, [instance.id])
+
+
+@receiver(post_delete, sender=Grant)
+@receiver(post_delete, sender=Topic)
+@receiver(post_delete, sender=Subtopic)
+@receiver(post_delete, sender=Ticket)
+@receiver(post_delete, sender=MediaInfo)
+@receiver(post_delete, sender=MediaInfoOld)
+@receiver(post_delete, sender=Expediture)
+@receiver(post_delete, sender=Preexpediture)
+def log_change_after_delete(sender, instance, **kwargs):
+    if in_bulk_deletion():
+        return
+    ChangeLogEntry.log(sender, [instance.id], deleted=True)
+
+
 class Notification(models.Model):
     """Notification that is supposed to be sent."""
     target_user = models.ForeignKey('auth.User', null=True, blank=True, on_delete=models.SET_NULL)
     fired = models.DateTimeField('fired', auto_now_add=True)
     text = models.TextField('text', default="")
     notification_type = models.CharField('notification_type', max_length=50, choices=NOTIFICATION_TYPES, null=True)
+    dedup_key = models.CharField('dedup_key', max_length=40, blank=True, db_index=True)
+    ticket_id = models.IntegerField('ticket_id', null=True, blank=True)
+    event_key = models.CharField('event_key', max_length=100, blank=True)
+    payload = models.TextField('payload', blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['ticket_id', 'notification_type']),
+            models.Index(fields=['event_key', 'notification_type']),
+        ]
 
     def __str__(self):
-        return self.text
+        return self.render()
+
+    def render(self):
+        """Text of the notification, in the currently active language."""
+        if not self.payload:
+            return self.text
+        payload = json.loads(self.payload)
+        data = {
+            key: translation.gettext(value) if key in payload['translated'] else value
+            for key, value in payload['data'].items()
+        }
+        return translation.gettext(payload['text']) % data
+
+    @staticmethod
+    def make_payload(raw_text, text_data={}):
+        """Serialize untranslated text and its data; translation happens in render()."""
+        with translation.override(None):
+            return json.dumps({
+                'text': force_text(raw_text),
+                'data': {key: force_text(value) for key, value in text_data.items()},
+                'translated': sorted(key for key, value in text_data.items() if isinstance(value, Promise)),
+            }, sort_keys=True)
+
+    @staticmethod
+    def make_dedup_key(notification_type, payload):
+        """Hash identifying one event, shared by all notifications fired for it."""
+        return hashlib.sha1(('%s\n%s' % (notification_type, payload)).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def get_recipients(ticket, notification_type, additional=set()):
+        """IDs of users that should be notified about notification_type event on ticket.
+
+        Requester and topic admins are notified by default, unless they watch
+        the ticket, its topic or its grant (then their watchers decide).
+        """
+        watched = models.Q(watcher_type='Ticket', object_id=ticket.id) | models.Q(watcher_type='Topic', object_id=ticket.topic_id)
+        if ticket.topic.grant_id is not None:
+            watched |= models.Q(watcher_type='Grant', object_id=ticket.topic.grant_id)
+        watching, recipients = set(), set()
+        for user_id, watched_type in Watcher.objects.filter(watched).values_list('user_id', 'notification_type'):
+            watching.add(user_id)
+            if watched_type == notification_type:
+                recipients.add(user_id)
+
+        defaults = set(ticket.topic.admin.values_list('id', flat=True))
+        if ticket.requested_user_id is not None:
+            defaults.add(ticket.requested_user_id)
+        recipients |= defaults - watching
+        recipients |= {user.id for user in additional}
+        return recipients
 
     @staticmethod
-    def fire_notification(ticket, raw_text, notification_type, sender, additional=set(), text_data={}, ack_type=None):
+    def fire_notification(ticket, raw_text, notification_type, sender, additional=set(), text_data={}, ack_type=None,
+                          event_key=''):
         if sender is None:
             return
-        users = set([])
-        if ticket.requested_user is not None:
-            users = {ticket.requested_user}
-            if Watcher.objects.filter(watcher_type='Ticket', object_id=ticket.id, user=ticket.requested_user).exists() \
-                    or Watcher.objects.filter(watcher_type='Topic', object_id=ticket.topic.id,
-                                              user=ticket.requested_user).exists() \
-                    or Watcher.objects.filter(watcher_type='Grant', object_id=ticket.topic.grant.id,
-                                              user=ticket.requested_user).exists():
-                users.remove(ticket.requested_user)
-        admins = set(ticket.topic.admin.all())
-        admins_to_be_removed_from_set = []
-        for admin in admins:
-            if Watcher.objects.filter(watcher_type='Ticket', object_id=ticket.id, user=admin).exists() \
-                    or Watcher.objects.filter(watcher_type='Topic', object_id=ticket.topic.id, user=admin).exists() \
-                    or Watcher.objects.filter(watcher_type='Grant', object_id=ticket.topic.grant.id,
-                                              user=admin).exists():
-                admins_to_be_removed_from_set.append(admin)
-        for admin in admins_to_be_removed_from_set:
-            admins.remove(admin)
-        topicwatchers = set([tw.user for tw in Watcher.objects.filter(watcher_type='Topic', object_id=ticket.topic.id,
-                                                                      notification_type=notification_type)])
-        ticketwatchers = set([tw.user for tw in Watcher.objects.filter(watcher_type='Ticket', object_id=ticket.id,
-                                                                       notification_type=notification_type)])
-        grantwatchers = set([tw.user for tw in
-                             Watcher.objects.filter(watcher_type='Grant', object_id=ticket.topic.grant.id,
-                                                    notification_type=notification_type)])
-        users = users.union(admins, additional, topicwatchers, ticketwatchers, grantwatchers)
 
         # Don't create a Notification again if there's already the exact same
         # notification in the database.
-        if len(Notification.objects.filter(
-                text=raw_text, notification_type=notification_type)) > 0:
+        payload = Notification.make_payload(raw_text, text_data)
+        dedup_key = Notification.make_dedup_key(notification_type, payload)
+        if Notification.objects.filter(dedup_key=dedup_key).exists():
             return
 
-        for user in users:
-            with translation.override(user.trackerpreferences.email_language):
-                if user == sender:
-                    continue
-                if notification_type == 'comment' and not ticket.can_see_comments(user):
-                    continue
-                if notification_type in user.trackerpreferences.get_muted_notifications():
-                    continue
-                if 'muted' in user.trackerpreferences.get_muted_notifications():
-                    continue
-                if ack_type in user.trackerpreferences.get_muted_ack():
-                    continue
-
-                if text_data:
-                    text = raw_text % text_data
-                else:
-                    text = raw_text
+        recipients = Notification.get_recipients(ticket, notification_type, additional)
+        recipients.discard(sender.id)
+        if not recipients:
+            return
+
+        notifications = []
+        preferences = TrackerPreferences.objects.filter(user_id__in=recipients).select_related('user__trackerprofile')
+        for preference in preferences:
+            muted = preference.get_muted_notifications()
+            if notification_type in muted or 'muted' in muted:
+                continue
+            if ack_type in preference.get_muted_ack():
+                continue
+            if notification_type == 'comment' and not ticket.can_see_comments(preference.user):
+                continue
 
-                Notification.objects.create(text=text, notification_type=notification_type, target_user=user)
+            notifications.append(Notification(
+                notification_type=notification_type, target_user_id=preference.user_id, dedup_key=dedup_key,
+                ticket_id=ticket.id, event_key=event_key, payload=payload,
+            ))
+        Notification.objects.bulk_create(notifications)
 
 
 @receiver(comment_was_posted)
@@ -1686,59 +2596,53 @@ def notify_ticket(sender, instance, created, raw, **kwargs):
         Notification.fire_notification(instance, text, "ticket_new", get_user(True), text_data=text_data)
 
 
-@receiver(pre_save, sender=Ticket)
-def notify_supervizor_notes(sender, instance, **kwargs):
-    if instance.id is not None:
-        old = Ticket.objects.get(id=instance.id)
-        if old.supervisor_notes != instance.supervisor_notes:
-            text = _(
-                'User <tt>%(user)s</tt> changed supervisor notes of ticket <a href="%(ticket_url)s">%(ticket)s</a>.')
-            text_data = {
-                'user': get_user(),
-                'ticket_url': settings.BASE_URL + instance.get_absolute_url(),
-                'ticket': instance
-            }
-            Notification.fire_notification(instance, text, "supervisor_notes", get_user(True), text_data=text_data)
+TicketChange = namedtuple('TicketChange', ['field', 'old', 'new'])
 
+# field: (notification type, text, skipped while the ticket_new notification is pending)
+TICKET_CHANGE_NOTIFICATIONS = OrderedDict([
+    ('supervisor_notes', ('supervisor_notes', _(
+        'User <tt>%(user)s</tt> changed supervisor notes of ticket <a href="%(ticket_url)s">%(ticket)s</a>.'), False)),
+    ('description', ('ticket_change', _(
+        'User <tt>%(user)s</tt> changed description of ticket <a href="%(ticket_url)s">%(ticket)s</a>.'), True)),
+    ('name', ('ticket_change', _(
+        'User <tt>%(user)s</tt> changed name of ticket <a href="%(ticket_url)s">%(ticket)s</a>.'), True)),
+    ('report_url', ('ticket_change', _(
+        'User <tt>%(user)s</tt> changed link to report of ticket <a href="%(ticket_url)s">%(ticket)s</a>.'), True)),
+    ('deposit', ('ticket_change', _(
+        'User <tt>%(user)s</tt> changed requested deposit of ticket <a href="%(ticket_url)s">%(ticket)s</a>.'), True)),
+    ('mandatory_report', ('ticket_change', _(
+        'User <tt>%(user)s</tt> changed "Is report mandatory?" field of ticket <a href="%(ticket_url)s">%(ticket)s</a>.'), False)),
+])
 
-@receiver(pre_save, sender=Ticket)
-def notify_ticket_change(sender, instance, **kwargs):
-    if instance.id is not None and len(Notification.objects.filter(text__contains=instance.get_absolute_url(),
-                                                                   notification_type="ticket_new")) == 0:
-        old = Ticket.objects.get(id=instance.id)
-        text_data = {
-            'ticket_url': settings.BASE_URL + instance.get_absolute_url(),
-            'user': get_user(),
-            'ticket': instance
-        }
-        if old.description != instance.description:
-            text = _('User <tt>%(user)s</tt> changed description of ticket <a href="%(ticket_url)s">%(ticket)s</a>.')
-            Notification.fire_notification(instance, text, "ticket_change", get_user(True), text_data=text_data)
-        if old.name != instance.name:
-            text = _('User <tt>%(user)s</tt> changed name of ticket <a href="%(ticket_url)s">%(ticket)s</a>.')
-            Notification.fire_notification(instance, text, "ticket_change", get_user(True), text_data=text_data)
-        if old.report_url != instance.report_url:
-            text = _('User <tt>%(user)s</tt> changed link to report of ticket <a href="%(ticket_url)s">%(ticket)s</a>.')
-            Notification.fire_notification(instance, text, "ticket_change", get_user(True), text_data=text_data)
-        if old.deposit != instance.deposit:
-            text = _(
-                'User <tt>%(user)s</tt> changed requested deposit of ticket <a href="%(ticket_url)s">%(ticket)s</a>.')
-            Notification.fire_notification(instance, text, "ticket_change", get_user(True), text_data=text_data)
+
+def ticket_changes(ticket, fields):
+    """ Changes of given fields since the ticket was loaded, computed from ModelDiffMixin.diff """
+    diff = ticket.diff
+    return [TicketChange(field, *diff[field]) for field in fields if field in diff]
 
 
 @receiver(pre_save, sender=Ticket)
-def notify_ticket_change_2(sender, instance, **kwargs):
-    if instance.id is not None:
-        old = Ticket.objects.get(id=instance.id)
-        if old.mandatory_report != instance.mandatory_report:
-            text = _(
-                'User <tt>%(user)s</tt> changed "Is report mandatory?" field of ticket <a href="%(ticket_url)s">%(ticket)s</a>.')
-            text_data = {
-                'ticket_url': settings.BASE_URL + instance.get_absolute_url(),
-                'user': get_user(),
-                'ticket': instance
-            }
-            Notification.fire_notification(instance, text, "ticket_change", get_user(True), text_data=text_data)
+def notify_ticket_change(sender, instance, raw, **kwargs):
+    if raw or instance.id is None or get_user(True) is None:
+        return
+    changes = ticket_changes(instance, TICKET_CHANGE_NOTIFICATIONS.keys())
+    if not changes:
+        return
+
+    text_data = {
+        'ticket_url': settings.BASE_URL + instance.get_absolute_url(),
+        'user': get_user(),
+        'ticket': instance
+    }
+    new_pending = None
+    for change in changes:
+        notification_type, text, skip_if_new = TICKET_CHANGE_NOTIFICATIONS[change.field]
+        if skip_if_new:
+            if new_pending is None:
+                new_pending = Notification.objects.filter(ticket_id=instance.id, notification_type="ticket_new").exists()
+            if new_pending:
+                continue
+        Notification.fire_notification(instance, text, notification_type, get_user(True), text_data=text_data)
 
 
 @receiver(post_delete, sender=Ticket)
@@ -1780,163 +2684,238 @@ def notify_ack_remove(sender, instance, **kwargs):
                                    ack_type=instance.ack_type)
 
 
-@receiver(post_save, sender=Preexpediture)
-def notify_preexpediture(sender, instance, created, raw, **kwargs):
-    if (len(Notification.objects.filter(text__contains=instance.ticket.get_absolute_url(),
-                                        notification_type="ticket_new")) == 0 and
-            created):
-        # HACK: It turns out `instance` and Preexpediture. objects.get(id=instance.id)
-        # are different. Especially for the `Preexpediture.amount` field which
-        # is intended to be a Decimal with precision of 2 digits.
-        # For example if the wage was (2.00)
-        # If we printed the stringified `instance.wage`, we'd get "2"
-        # on the other hand, if we printed the stringified of
-        # `Preexpediture.objects.get(id=instance.id)` (from the database)
-        # we'd get "2.00".
-        #
-        # We use the data given by the database rather than the instance
-        # because it will affect how `notify_preexpediture_change()`
-        # and `notify_del_preexpediture()` will work.
-        preexpediture_instance = Preexpediture.objects.get(id=instance.id)
-
+def group_by_ticket(items):
+    """ Group ticket items (expeditures, media...) into a dict of ticket_id: list of items """
+    tickets = {}
+    for item in items:
+        tickets.setdefault(item.ticket_id, []).append(item)
+    return tickets
+
+
+def describe_items(items):
+    return ', '.join(str(item) for item in items)
+
+
+def single_event_key(prefix, items):
+    # Items added at once share one notification, which can't be keyed by each of them,
+    # so only a lone new item suppresses notifications about its later changes.
+    return '%s:%d' % (prefix, items[0].id) if len(items) == 1 else ''
+
+
+def notify_preexpeditures_added(preexpeditures):
+    """ Notify about created planned expeditures, once per ticket """
+    tickets = group_by_ticket(preexpeditures)
+    for ticket_id in Notification.objects.filter(ticket_id__in=tickets.keys(), notification_type="ticket_new").values_list('ticket_id', flat=True):
+        tickets.pop(ticket_id, None)
+
+    # HACK: It turns out `instance` and Preexpediture. objects.get(id=instance.id)
+    # are different. Especially for the `Preexpediture.amount` field which
+    # is intended to be a Decimal with precision of 2 digits.
+    # For example if the wage was (2.00)
+    # If we printed the stringified `instance.wage`, we'd get "2"
+    # on the other hand, if we printed the stringified of
+    # `Preexpediture.objects.get(id=instance.id)` (from the database)
+    # we'd get "2.00".
+    #
+    # We use the data given by the database rather than the instance
+    # because it will affect how `notify_preexpediture_change()`
+    # and `notify_del_preexpediture()` will work.
+    stored = Preexpediture.objects.in_bulk([item.id for items in tickets.values() for item in items])
+    for items in tickets.values():
+        ticket = items[0].ticket
         text_data = {
             'user': get_user(),
-            'ticket_url': settings.BASE_URL + instance.ticket.get_absolute_url(),
-            'expeditures': preexpediture_instance,
-            'ticket': instance.ticket
+            'ticket_url': settings.BASE_URL + ticket.get_absolute_url(),
+            'expeditures': describe_items(stored[item.id] for item in items),
+            'ticket': ticket
         }
         text = _(
             'User <tt>%(user)s</tt> added planned expeditures <tt>%(expeditures)s</tt> to ticket <a href="%(ticket_url)s">%(ticket)s</a>.')
-        Notification.fire_notification(instance.ticket, text, "preexpeditures_new", get_user(True), text_data=text_data)
-
-
-@receiver(pre_save, sender=Preexpediture)
-def notify_preexpediture_change(sender, instance, **kwargs):
-    if instance.id is not None:
-        old = Preexpediture.objects.get(id=instance.id)
-        if Notification.objects.filter(text__contains=str(old), notification_type="preexpeditures_new"):
-            return
-
+        Notification.fire_notification(ticket, text, "preexpeditures_new", get_user(True), text_data=text_data,
+                                       event_key=single_event_key('preexpediture', items))
+
+
+def notify_preexpeditures_changed(changes):
+    """ Notify about changed planned expeditures, given as (old, new) pairs, once per ticket and kind of change """
+    pending = set(Notification.objects.filter(
+        event_key__in=['preexpediture:%d' % old.id for old, new in changes],
+        notification_type="preexpeditures_new").values_list('event_key', flat=True))
+    tickets = {}
+    for old, new in changes:
+        if 'preexpediture:%d' % old.id not in pending:
+            tickets.setdefault(new.ticket_id, []).append((old, new))
+
+    for pairs in tickets.values():
+        ticket = pairs[0][1].ticket
         text_data = {
             'user': get_user(),
-            'ticket_url': settings.BASE_URL + instance.ticket.get_absolute_url(),
-            'expeditures': instance,
-            'old_expediture': old,
-            'ticket': instance.ticket
+            'ticket_url': settings.BASE_URL + ticket.get_absolute_url(),
+            'ticket': ticket
         }
 
-        if old.amount != instance.amount or old.description != instance.description:
+        edited = [(old, new) for old, new in pairs if old.amount != new.amount or old.description != new.description]
+        if edited:
             text = _(
                 'User <tt>%(user)s</tt> changed planned expediture from <tt>%(old_expediture)s</tt> to <tt>%(expeditures)s</tt> of ticket <a href="%(ticket_url)s">%(ticket)s</a>.')
-            Notification.fire_notification(instance.ticket, text, "preexpeditures_change", get_user(True),
-                                           text_data=text_data)
-
-        if old.wage != instance.wage:
-            if instance.wage:
-                text = _(
-                    'User <tt>%(user)s</tt> set planned expediture <tt>%(expeditures)s</tt> of ticket <a href="%(ticket_url)s">%(ticket)s</a> as wage.')
-            else:
-                text = _(
-                    'User <tt>%(user)s</tt> set planned expediture <tt>%(expeditures)s</tt> of ticket <a href="%(ticket_url)s">%(ticket)s</a> as not wage.')
-            Notification.fire_notification(instance.ticket, text, "preexpeditures_change", get_user(True),
-                                           text_data=text_data)
-
-
-@receiver(post_delete, sender=Preexpediture)
-def notify_del_preexpediture(sender, instance, **kwargs):
-    if len(Ticket.objects.filter(id=instance.ticket.id)) > 0 and len(
-            Notification.objects.filter(text__contains=instance.ticket.get_absolute_url(),
-                                        notification_type="ticket_new")) == 0:
+            Notification.fire_notification(ticket, text, "preexpeditures_change", get_user(True), text_data=dict(
+                text_data, old_expediture=describe_items(old for old, new in edited),
+                expeditures=describe_items(new for old, new in edited)))
+
+        for wage, text in (
+            (True, _('User <tt>%(user)s</tt> set planned expediture <tt>%(expeditures)s</tt> of ticket <a href="%(ticket_url)s">%(ticket)s</a> as wage.')),
+            (False, _('User <tt>%(user)s</tt> set planned expediture <tt>%(expeditures)s</tt> of ticket <a href="%(ticket_url)s">%(ticket)s</a> as not wage.')),
+        ):
+            toggled = [new for old, new in pairs if old.wage != new.wage and bool(new.wage) == wage]
+            if toggled:
+                Notification.fire_notification(ticket, text, "preexpeditures_change", get_user(True),
+                                               text_data=dict(text_data, expeditures=describe_items(toggled)))
+
+
+def notify_preexpeditures_removed(preexpeditures):
+    """ Notify about deleted planned expeditures of existing tickets, once per ticket """
+    tickets = group_by_ticket(preexpeditures)
+    for ticket_id in Notification.objects.filter(ticket_id__in=tickets.keys(), notification_type="ticket_new").values_list('ticket_id', flat=True):
+        tickets.pop(ticket_id, None)
+
+    for items in tickets.values():
+        ticket = items[0].ticket
         text_data = {
             'user': get_user(),
-            'expediture': instance,
-            'ticket_url': settings.BASE_URL + instance.ticket.get_absolute_url(),
-            'ticket': instance.ticket
+            'expediture': describe_items(items),
+            'ticket_url': settings.BASE_URL + ticket.get_absolute_url(),
+            'ticket': ticket
         }
         text = _(
             'User <tt>%(user)s</tt> removed planned expediture <tt>%(expediture)s</tt> from ticket <a href="%(ticket_url)s">%(ticket)s</a>.')
-        Notification.fire_notification(instance.ticket, text, "preexpeditures_change", get_user(True),
-                                       text_data=text_data)
+        Notification.fire_notification(ticket, text, "preexpeditures_change", get_user(True), text_data=text_data)
 
 
-@receiver(post_save, sender=Expediture)
-def notify_expediture(sender, instance, created, raw, **kwargs):
-    if (len(Notification.objects.filter(text__contains=instance.ticket.get_absolute_url(),
-                                        notification_type__in=["ticket_new", "expeditures_new"])) == 0 and
-            created):
-        # HACK: See comments in `notify_preexpediture()`
-        expediture_instance = Expediture.objects.get(id=instance.id)
+@receiver(post_save, sender=Preexpediture)
+def notify_preexpediture(sender, instance, created, raw, **kwargs):
+    if created:
+        notify_preexpeditures_added([instance])
+
+
+@receiver(pre_save, sender=Preexpediture)
+def notify_preexpediture_change(sender, instance, **kwargs):
+    if instance.id is not None:
+        notify_preexpeditures_changed([(Preexpediture.objects.get(id=instance.id), instance)])
+
 
+@receiver(post_delete, sender=Preexpediture)
+def notify_del_preexpediture(sender, instance, **kwargs):
+    if in_bulk_deletion():
+        return
+    if Ticket.objects.filter(id=instance.ticket_id).exists():
+        notify_preexpeditures_removed([instance])
+
+
+def notify_expeditures_added(expeditures):
+    """ Notify about created real expeditures, once per ticket """
+    tickets = group_by_ticket(expeditures)
+    pending = Notification.objects.filter(ticket_id__in=tickets.keys(), notification_type__in=["ticket_new", "expeditures_new"])
+    for ticket_id in pending.values_list('ticket_id', flat=True):
+        tickets.pop(ticket_id, None)
+
+    # HACK: See comments in `notify_preexpeditures_added()`
+    stored = Expediture.objects.in_bulk([item.id for items in tickets.values() for item in items])
+    for items in tickets.values():
+        ticket = items[0].ticket
         text_data = {
-            'ticket_url': settings.BASE_URL + instance.ticket.get_absolute_url(),
-            'ticket': instance.ticket,
+            'ticket_url': settings.BASE_URL + ticket.get_absolute_url(),
+            'ticket': ticket,
             'user': get_user(),
-            'expeditures': expediture_instance
+            'expeditures': describe_items(stored[item.id] for item in items)
         }
-
         text = _(
             'User <tt>%(user)s</tt> added real expeditures <tt>%(expeditures)s</tt> to ticket <a href="%(ticket_url)s">%(ticket)s</a>.')
-        Notification.fire_notification(instance.ticket, text, "expeditures_new", get_user(True), text_data=text_data)
-
-
-@receiver(pre_save, sender=Expediture)
-def notify_expediture_change(sender, instance, **kwargs):
-    if instance.id is not None:
-        old = Expediture.objects.get(id=instance.id)
-        if Notification.objects.filter(text__contains=str(old), notification_type="expeditures_new"):
-            return
-
+        Notification.fire_notification(ticket, text, "expeditures_new", get_user(True), text_data=text_data,
+                                       event_key=single_event_key('expediture', items))
+
+
+def notify_expeditures_changed(changes):
+    """ Notify about changed real expeditures, given as (old, new) pairs, once per ticket and kind of change """
+    pending = set(Notification.objects.filter(
+        event_key__in=['expediture:%d' % old.id for old, new in changes],
+        notification_type="expeditures_new").values_list('event_key', flat=True))
+    tickets = {}
+    for old, new in changes:
+        if 'expediture:%d' % old.id not in pending:
+            tickets.setdefault(new.ticket_id, []).append((old, new))
+
+    for pairs in tickets.values():
+        ticket = pairs[0][1].ticket
         text_data = {
-            'ticket_url': settings.BASE_URL + instance.ticket.get_absolute_url(),
-            'ticket': instance.ticket,
+            'ticket_url': settings.BASE_URL + ticket.get_absolute_url(),
+            'ticket': ticket,
             'user': get_user(),
-            'old_expediture': old,
-            'expeditures': instance
         }
 
-        if old.amount != instance.amount or old.description != instance.description or old.accounting_info != instance.accounting_info:
+        edited = [(old, new) for old, new in pairs if old.amount != new.amount or old.description != new.description or
+                  old.accounting_info != new.accounting_info]
+        if edited:
             text = _(
                 'User <tt>%(user)s</tt> changed real expediture from <tt>%(old_expediture)s</tt> to <tt>%(expeditures)s</tt> of ticket <a href="%(ticket_url)s">%(ticket)s</a>.')
-            Notification.fire_notification(instance.ticket, text, "expeditures_change", get_user(True), text_data=text_data)
-
-        if old.paid != instance.paid:
-            if instance.paid:
-                text = _(
-                    'User <tt>%(user)s</tt> set real expediture <tt>%(expeditures)s</tt> of ticket <a href="%(ticket_url)s">%(ticket)s</a> as paid.')
-            else:
-                text = _(
-                    'User <tt>%(user)s</tt> set real expediture <tt>%(expeditures)s</tt> of ticket <a href="%(ticket_url)s">%(ticket)s</a> as not paid.')
-            Notification.fire_notification(instance.ticket, text, "expeditures_change", get_user(True), text_data=text_data)
-        if old.wage != instance.wage:
-            if instance.wage:
-                text = _(
-                    'User <tt>%(user)s</tt> set real expediture <tt>%(expeditures)s</tt> of ticket <a href="%(ticket_url)s">%(ticket)s</a> as wage.')
-            else:
-                text = _(
-                    'User <tt>%(user)s</tt> set real expediture <tt>%(expeditures)s</tt> of ticket <a href="%(ticket_url)s">%(ticket)s</a> as not wage.')
-            Notification.fire_notification(instance.ticket, text, "expeditures_change", get_user(True), text_data=text_data)
-
-
-@receiver(post_delete, sender=Expediture)
-def notify_del_expediture(sender, instance, **kwargs):
-    if len(Ticket.objects.filter(id=instance.ticket.id)) > 0 and len(
-            Notification.objects.filter(text__contains=instance.ticket.get_absolute_url(),
-                                        notification_type="ticket_new")) == 0:
+            Notification.fire_notification(ticket, text, "expeditures_change", get_user(True), text_data=dict(
+                text_data, old_expediture=describe_items(old for old, new in edited),
+                expeditures=describe_items(new for old, new in edited)))
+
+        for field, value, text in (
+            ('paid', True, _('User <tt>%(user)s</tt> set real expediture <tt>%(expeditures)s</tt> of ticket <a href="%(ticket_url)s">%(ticket)s</a> as paid.')),
+            ('paid', False, _('User <tt>%(user)s</tt> set real expediture <tt>%(expeditures)s</tt> of ticket <a href="%(ticket_url)s">%(ticket)s</a> as not paid.')),
+            ('wage', True, _('User <tt>%(user)s</tt> set real expediture <tt>%(expeditures)s</tt> of ticket <a href="%(ticket_url)s">%(ticket)s</a> as wage.')),
+            ('wage', False, _('User <tt>%(user)s</tt> set real expediture <tt>%(expeditures)s</tt> of ticket <a href="%(ticket_url)s">%(ticket)s</a> as not wage.')),
+        ):
+            toggled = [new for old, new in pairs
+                       if getattr(old, field) != getattr(new, field) and bool(getattr(new, field)) == value]
+            if toggled:
+                Notification.fire_notification(ticket, text, "expeditures_change", get_user(True),
+                                               text_data=dict(text_data, expeditures=describe_items(toggled)))
+
+
+def notify_expeditures_removed(expeditures):
+    """ Notify about deleted real expeditures of existing tickets, once per ticket """
+    tickets = group_by_ticket(expeditures)
+    for ticket_id in Notification.objects.filter(ticket_id__in=tickets.keys(), notification_type="ticket_new").values_list('ticket_id', flat=True):
+        tickets.pop(ticket_id, None)
+
+    for items in tickets.values():
+        ticket = items[0].ticket
         text_data = {
-            'ticket_url': settings.BASE_URL + instance.ticket.get_absolute_url(),
-            'ticket': instance.ticket,
+            'ticket_url': settings.BASE_URL + ticket.get_absolute_url(),
+            'ticket': ticket,
             'user': get_user(),
-            'expeditures': instance
+            'expeditures': describe_items(items)
         }
         text = _(
             'User <tt>%(user)s</tt> removed real expeditures <tt>%(expeditures)s</tt> from ticket <a href="%(ticket_url)s">%(ticket)s</a>.')
-        Notification.fire_notification(instance.ticket, text, "expeditures_change", get_user(True), text_data=text_data)
+        Notification.fire_notification(ticket, text, "expeditures_change", get_user(True), text_data=text_data)
+
+
+@receiver(post_save, sender=Expediture)
+def notify_expediture(sender, instance, created, raw, **kwargs):
+    if created:
+        notify_expeditures_added([instance])
+
+
+@receiver(pre_save, sender=Expediture)
+def notify_expediture_change(sender, instance, **kwargs):
+    if instance.id is not None:
+        notify_expeditures_changed([(Expediture.objects.get(id=instance.id), instance)])
+
+
+@receiver(post_delete, sender=Expediture)
+def notify_del_expediture(sender, instance, **kwargs):
+    if in_bulk_deletion():
+        return
+    if Ticket.objects.filter(id=instance.ticket_id).exists():
+        notify_expeditures_removed([instance])
 
 
 @receiver(post_save, sender=MediaInfo)
 def notify_media(sender, instance, created, raw, **kwargs):
-    if len(Notification.objects.filter(text__contains=instance.ticket.get_absolute_url(),
-                                       notification_type__in=["ticket_new", "media_new"])) == 0:
+    if not Notification.objects.filter(ticket_id=instance.ticket_id,
+                                       notification_type__in=["ticket_new", "media_new"]).exists():
         text_data = {
             'ticket_url': settings.BASE_URL + instance.ticket.get_absolute_url(),
             'ticket': instance.ticket,
@@ -1952,9 +2931,10 @@ def notify_media(sender, instance, created, raw, **kwargs):
 
 @receiver(post_delete, sender=MediaInfo)
 def notify_del_media(sender, instance, **kwargs):
-    if len(Ticket.objects.filter(id=instance.ticket.id)) > 0 and len(
-            Notification.objects.filter(text__contains=instance.ticket.get_absolute_url(),
-                                        notification_type="ticket_new")) == 0:
+    if in_bulk_deletion():
+        return
+    if Ticket.objects.filter(id=instance.ticket_id).exists() and not Notification.objects.filter(
+            ticket_id=instance.ticket_id, notification_type="ticket_new").exists():
         text_data = {
             'ticket_url': settings.BASE_URL + instance.ticket.get_absolute_url(),
             'ticket': instance.ticket,
@@ -1966,8 +2946,8 @@ def notify_del_media(sender, instance, **kwargs):
 
 @receiver(post_save, sender=Document)
 def notify_document(sender, instance, created, **kwargs):
-    if len(Notification.objects.filter(text__contains=instance.ticket.get_absolute_url(),
-                                       notification_type__in=["ticket_new", "document"])) == 0:
+    if not Notification.objects.filter(ticket_id=instance.ticket_id,
+                                       notification_type__in=["ticket_new", "document"]).exists():
         text_data = {
             'ticket_url': settings.BASE_URL + instance.ticket.get_absolute_url(),
             'ticket': instance.ticket,
@@ -1985,9 +2965,8 @@ def notify_document(sender, instance, created, **kwargs):
 
 @receiver(post_delete, sender=Document)
 def notify_del_document(sender, instance, **kwargs):
-    if len(Ticket.objects.filter(id=instance.ticket.id)) > 0 and len(
-            Notification.objects.filter(text__contains=instance.ticket.get_absolute_url(),
-                                        notification_type__in=["ticket_new", "document_new"])) == 0:
+    if Ticket.objects.filter(id=instance.ticket_id).exists() and not Notification.objects.filter(
+            ticket_id=instance.ticket_id, notification_type__in=["ticket_new", "document_new"]).exists():
         text_data = {
             'ticket_url': settings.BASE_URL + instance.ticket.get_absolute_url(),
             'ticket': instance.ticket,
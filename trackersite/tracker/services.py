@@ -3,3 +3,13 @@ from crequest.middleware import CrequestMiddleware
 
 def get_request():
     return CrequestMiddleware.get_request()
+
+
+def get_request_cache():
+    """ Dictionary which lives as long as the current request; outside of a request, a new one is returned each time """
+    request = get_request()
+    if request is None:
+        return {}
+    if not hasattr(request, 'tracker_cache'):
+        request.tracker_cache = {}
+    return request.tracker_cache
@@ -4,22 +4,38 @@ import csv
 import datetime
 import io
 import json
+import os
 import random
+import shutil
+import tempfile
 from decimal import Decimal
 from unittest.mock import patch
 
+import requests
+
 from django.conf import settings
 from django.contrib.auth.models import User, Permission
 from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core import mail
 from django.core.files.base import ContentFile
-from django.core.management import call_command
-from django.test import TestCase
+from django.core.management import call_command, CommandError
+from django.db import connection, DatabaseError
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.test.client import Client
 from django.urls import reverse
+from django.utils import timezone
+from django.utils.translation import ugettext_lazy
+from background_task.models import Task
+from social_django.models import UserSocialAuth
 
+from socialauth import api
 from socialauth.api import MediaWiki
 from tracker.models import Ticket, Topic, Subtopic, Grant, MediaInfo, Expediture, Preexpediture, TrackerProfile, \
-    Document, TrackerPreferences
+    Document, TrackerPreferences, TicketSummary, Notification, MediaInfoCategory, MediaInfoUsage, Watcher, TicketAck, \
+    FinanceStatus, Cluster, ChangeLogEntry
+from tracker.utils import schedule_ticket_job
 from users.models import UserWrapper
 
 
@@ -57,6 +73,44 @@ class SimpleTicketTest(TestCase):
                 except ValueError:
                     self.fail("Response was not JSON as expected!")
 
+    def test_ticket_json_server_side(self):
+        url = reverse('tickets_json', kwargs={'lang': 'en'})
+        response = Client().get(url, {'draw': 3, 'start': 0, 'length': 1, 'order[0][column]': 0, 'order[0][dir]': 'asc'})
+        data = json.loads(response.content.decode('utf8'))
+        self.assertEqual(3, data['draw'])
+        self.assertEqual(2, data['recordsTotal'])
+        self.assertEqual(2, data['recordsFiltered'])
+        self.assertEqual(1, len(data['data']))
+        self.assertIn('>%s</a>' % self.ticket1.id, data['data'][0][0])
+
+        response = Client().get(url, {'draw': 4, 'search[value]': 'bar'})
+        data = json.loads(response.content.decode('utf8'))
+        self.assertEqual(1, data['recordsFiltered'])
+        self.assertIn('>%s</a>' % self.ticket2.id, data['data'][0][0])
+
+        response = Client().get(url, {'columns[6][search][value]': 'req1'})
+        data = json.loads(response.content.decode('utf8'))
+        self.assertEqual(1, data['recordsFiltered'])
+        self.assertIn('>%s</a>' % self.ticket1.id, data['data'][0][0])
+
+        self.ticket2.expediture_set.create(description='foo', amount=100)
+        response = Client().get(url, {'order[0][column]': 8, 'order[0][dir]': 'desc'})
+        data = json.loads(response.content.decode('utf8'))
+        self.assertIn('>%s</a>' % self.ticket2.id, data['data'][0][0])
+
+        for column in (7, 9, 10, 11, 12):
+            response = Client().get(url, {'order[0][column]': column})
+            self.assertEqual(200, response.status_code)
+
+        self.ticket1.add_acks('user_precontent')
+        response = Client().get(url, {'columns[11][search][value]': 'preapproval'})
+        data = json.loads(response.content.decode('utf8'))
+        self.assertEqual(1, data['recordsFiltered'])
+        self.assertIn('>%s</a>' % self.ticket1.id, data['data'][0][0])
+
+        response = Client().get(url, {'order[0][column]': 99})
+        self.assertEqual(400, response.status_code)
+
     def test_ticket_detail(self):
         response = Client().get(reverse('ticket_detail', kwargs={'pk': self.ticket1.id}))
         self.assertEqual(response.status_code, 200)
@@ -162,6 +216,116 @@ class TicketSumTests(TestCase):
         self.assertEqual({'count': 2, 'amount': 200}, full_ticket.preexpeditures())
 
 
+class TicketSummaryTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='summary_user')
+        self.grant = Grant.objects.create(full_name='g', short_name='g', slug='g')
+        self.topic = Topic.objects.create(name='topic', grant=self.grant)
+        self.subtopic = Subtopic.objects.create(name='subtopic', topic=self.topic)
+        self.ticket = Ticket.objects.create(name='ticket', topic=self.topic, subtopic=self.subtopic,
+                                            requested_user=self.user, rating_percentage=50)
+        self.ticket.expediture_set.create(description='foo', amount=200, paid=True)
+        self.ticket.expediture_set.create(description='bar', amount=100)
+        self.ticket.preexpediture_set.create(description='foo', amount=400)
+        self.ticket.mediainfoold_set.create(description='foo', count=5)
+
+    def assertSummaryUpToDate(self, ticket):
+        ticket = Ticket.objects.get(id=ticket.id)
+        ticket.flush_cache()
+        self.assertEqual(ticket.get_cached_ticket(), TicketSummary.objects.get(ticket=ticket).as_row())
+
+    def test_summary_follows_changes(self):
+        summary = TicketSummary.objects.get(ticket=self.ticket)
+        self.assertEqual('draft', summary.state)
+        self.assertEqual(400, summary.preexpeditures_amount)
+        self.assertEqual(300, summary.expeditures_amount)
+        self.assertEqual(0, summary.accepted_expeditures)
+        self.assertEqual(100, summary.paid_expeditures)
+        self.assertEqual(5, summary.media_count)
+        self.assertSummaryUpToDate(self.ticket)
+
+        self.ticket.add_acks('user_content', 'content')
+        self.assertEqual(150, TicketSummary.objects.get(ticket=self.ticket).accepted_expeditures)
+        self.assertSummaryUpToDate(self.ticket)
+
+        self.ticket.expediture_set.get(description='bar').delete()
+        self.ticket.preexpediture_set.all().delete()
+        self.ticket.ticketack_set.filter(ack_type='content').delete()
+        summary = TicketSummary.objects.get(ticket=self.ticket)
+        self.assertEqual('wfapproval', summary.state)
+        self.assertEqual(0, summary.preexpeditures_amount)
+        self.assertEqual(200, summary.expeditures_amount)
+        self.assertSummaryUpToDate(self.ticket)
+
+    def test_summary_follows_renames(self):
+        self.grant.full_name = 'renamed grant'
+        self.grant.save()
+        self.topic.name = 'renamed topic'
+        self.topic.save()
+        self.subtopic.name = 'renamed subtopic'
+        self.subtopic.save()
+        self.user.username = 'renamed_user'
+        self.user.save()
+        self.assertSummaryUpToDate(self.ticket)
+
+        self.subtopic.delete()
+        self.assertSummaryUpToDate(self.ticket)
+
+    def test_summary_deleted_with_ticket(self):
+        self.ticket.delete()
+        self.assertFalse(TicketSummary.objects.exists())
+
+    def test_rebuild(self):
+        ticket2 = Ticket.objects.create(name='ticket2', topic=self.topic, requested_text='someone', imported=True)
+        TicketSummary.objects.all().delete()
+        call_command('rebuildticketsummary', stdout=io.StringIO())
+        self.assertEqual(2, TicketSummary.objects.count())
+        self.assertEqual('historical', TicketSummary.objects.get(ticket=ticket2).state)
+        self.assertSummaryUpToDate(self.ticket)
+        self.assertSummaryUpToDate(ticket2)
+
+    def test_get_tickets_with_state(self):
+        self.assertEqual([self.ticket], list(Ticket.get_tickets_with_state('draft')))
+        self.assertEqual([], list(Ticket.get_tickets_with_state('waiting for approval')))
+
+    def test_stored_state(self):
+        tickets = {
+            'historical': Ticket.objects.create(name='t', topic=self.topic, imported=True),
+            'draft': Ticket.objects.create(name='t', topic=self.topic),
+            'wfpreapproval': Ticket.objects.create(name='t', topic=self.topic),
+            'wfsubmiting': Ticket.objects.create(name='t', topic=self.topic),
+            'wfapproval': Ticket.objects.create(name='t', topic=self.topic),
+            'wfrating': Ticket.objects.create(name='t', topic=self.topic, rating_percentage=None),
+            'wfdocssub': Ticket.objects.create(name='t', topic=self.topic),
+            'wffill': Ticket.objects.create(name='t', topic=self.topic),
+            'complete': Ticket.objects.create(name='t', topic=self.topic),
+            'archived': Ticket.objects.create(name='t', topic=self.topic),
+            'closed': Ticket.objects.create(name='t', topic=self.topic),
+        }
+        tickets['wfpreapproval'].add_acks('user_precontent')
+        tickets['wfsubmiting'].add_acks('user_precontent', 'precontent')
+        tickets['wfapproval'].add_acks('precontent', 'user_content')
+        tickets['wfrating'].add_acks('content')
+        tickets['wfdocssub'].add_acks('content')
+        tickets['wffill'].add_acks('content', 'user_docs')
+        tickets['complete'].add_acks('content', 'docs')
+        tickets['archived'].add_acks('content', 'archive')
+        tickets['closed'].add_acks('archive', 'close')
+
+        computed = dict(Ticket.objects.with_computed_state().values_list('id', 'computed_state'))
+        for state, ticket in tickets.items():
+            ticket = Ticket.objects.get(id=ticket.id)
+            self.assertEqual(state, ticket.state)
+            self.assertEqual(state, computed[ticket.id])
+            self.assertEqual(state, ticket.state_code())
+
+        with self.assertNumQueries(1):
+            self.assertEqual([tickets['wffill'].id], [t.id for t in Ticket.get_tickets_with_state('waiting for filing of documents')])
+
+        tickets['closed'].ticketack_set.get(ack_type='close').delete()
+        self.assertEqual('archived', Ticket.objects.get(id=tickets['closed'].id).state)
+
+
 class TicketTests(TestCase):
     def setUp(self):
         self.open_topic = Topic(name='test_topic', open_for_tickets=True, ticket_media=True, grant=self.get_grant())
@@ -1106,6 +1270,156 @@ class ImportTests(TestCase):
             })
             self.assertEqual(testConfiguration['superuser'], response.status_code)
 
+    def import_rows(self, user, type, rows):
+        csvfile = io.StringIO()
+        csvwriter = csv.writer(csvfile, delimiter=';')
+        for row in rows:
+            csvwriter.writerow(row)
+        csvfile.seek(0)
+        c = Client()
+        c.login(username=user.username, password='pw')
+        return c.post(reverse('importcsv'), {'type': type, 'csvfile': csvfile})
+
+    def test_import_tickets(self):
+        user = User.objects.create_user(username='user', password='pw')
+        admin = User.objects.create_user(username='admin', password='pw')
+        topic = Topic.objects.create(name='topic', grant=Grant.objects.create(full_name='grant', short_name='g', slug='g'))
+        topic.admin.add(admin)
+        header = ['event_date', 'name', 'topic', 'event_url', 'description', 'deposit']
+
+        response = self.import_rows(user, 'ticket', [header] + [
+            ['2010-04-23', 'ticket %d' % i, 'topic', 'http://wikimedia.cz', 'description', '0'] for i in range(3)
+        ])
+        self.assertEqual(302, response.status_code)
+        tickets = Ticket.objects.order_by('id')
+        self.assertEqual(['ticket 0', 'ticket 1', 'ticket 2'], [t.name for t in tickets])
+        for ticket in tickets:
+            self.assertEqual(user, ticket.requested_user)
+            self.assertEqual('draft', ticket.state)
+            self.assertEqual('user', ticket.summary.requested_by)
+            self.assertEqual('topic', ticket.summary.topic_name)
+        self.assertEqual(3, Notification.objects.filter(target_user=admin, notification_type='ticket_new').count())
+
+        response = self.import_rows(user, 'ticket', [header, ['None', 'no event date', 'topic', '', '', '0']])
+        self.assertEqual(302, response.status_code)
+        self.assertEqual(datetime.date.today(), Ticket.objects.get(name='no event date').event_date)
+
+    def test_import_reports_invalid_rows(self):
+        user = User.objects.create_user(username='user', password='pw')
+        Topic.objects.create(name='topic', grant=Grant.objects.create(full_name='grant', short_name='g', slug='g'))
+
+        response = self.import_rows(user, 'ticket', [
+            ['event_date', 'name', 'topic', 'event_url', 'description', 'deposit'],
+            ['2010-04-23', 'valid', 'topic', '', '', '0'],
+            ['2010-04-23', 'unknown topic', 'no such topic', '', '', '0'],
+            ['not a date', 'invalid', 'topic', '', '', 'lots'],
+        ])
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(0, Ticket.objects.count())
+        self.assertEqual(
+            [(3, 'topic'), (4, 'event_date'), (4, 'deposit')],
+            [(error.line, error.column) for error in response.context['errors']]
+        )
+
+        response = self.import_rows(user, 'ticket', [['name', 'topic'], ['no columns', 'topic']])
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(1, len(response.context['errors']))
+        self.assertEqual(0, Ticket.objects.count())
+
+    def test_import_expenses(self):
+        user = User.objects.create_user(username='user', password='pw')
+        topic = Topic.objects.create(name='topic', grant=Grant.objects.create(full_name='grant', short_name='g', slug='g'))
+        ticket = Ticket.objects.create(name='ticket', topic=topic, requested_user=user)
+        other_ticket = Ticket.objects.create(name='other', topic=topic)
+        header = ['ticket_id', 'description', 'amount', 'wage']
+
+        response = self.import_rows(user, 'expense', [header, [ticket.id, 'first', '100', 'False'], [ticket.id, 'second', '50.5', 'True']])
+        self.assertEqual(302, response.status_code)
+        ticket.refresh_from_db()
+        self.assertEqual(2, ticket.expediture_set.count())
+        self.assertEqual('unpaid', ticket.payment_status)
+        self.assertEqual(Decimal('150.5'), TicketSummary.objects.get(ticket=ticket).expeditures_amount)
+
+        response = self.import_rows(user, 'expense', [header, [ticket.id, 'third', '1', 'False'], [other_ticket.id, 'not mine', '1', 'False']])
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([(3, 'ticket_id')], [(error.line, error.column) for error in response.context['errors']])
+        self.assertEqual(2, Expediture.objects.count())
+
+        # rows are not imported without their side effects
+        with patch('tracker.csvimport.TicketSummary.rebuild', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                self.import_rows(user, 'expense', [header, [ticket.id, 'third', '1', 'False']])
+        self.assertEqual(2, Expediture.objects.count())
+        self.assertEqual(2, ChangeLogEntry.objects.filter(model='expediture').count())
+
+    @patch("socialauth.api.MediaWiki.request", side_effect=lambda *args, **kwargs: fake_query(*args, **kwargs))
+    def test_import_media(self, mock_request):
+        user = User.objects.create_user(username='user', password='pw')
+        topic = Topic.objects.create(name='topic', grant=Grant.objects.create(full_name='grant', short_name='g', slug='g'))
+        ticket = Ticket.objects.create(name='ticket', topic=topic, requested_user=user)
+
+        with patch('django.db.transaction.on_commit', side_effect=lambda func: func()):
+            response = self.import_rows(user, 'media', [['ticket_id', 'name']] + [[ticket.id, 'file:%d.jpg' % i] for i in range(1, 61)])
+        self.assertEqual(302, response.status_code)
+        self.assertEqual(1, Task.objects.filter(task_name='tracker.models.sync_media').count())
+        self.assertEqual(2, mock_request.call_count)
+        self.assertEqual(60, ticket.mediainfo_set.count())
+        self.assertEqual(7, ticket.mediainfo_set.get(page_title='File:7.jpg').page_id)
+        self.assertEqual(60, TicketSummary.objects.get(ticket=ticket).media_count)
+
+        response = self.import_rows(user, 'media', [['ticket_id', 'name'], [ticket.id, 'File:7.jpg'], [ticket.id, 'File:999.jpg']])
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([(2, 'name'), (3, 'name')], [(error.line, error.column) for error in response.context['errors']])
+
+    def test_import_users(self):
+        superuser = User.objects.create_superuser(username='superuser', password='pw', email='superuser@example.com')
+        header = ['username', 'password', 'first_name', 'last_name', 'is_superuser', 'is_staff', 'is_active', 'email']
+
+        response = self.import_rows(superuser, 'user', [header, ['new', 'secret', 'New', 'User', 'False', 'True', 'True', 'new@example.com']])
+        self.assertEqual(302, response.status_code)
+        new = User.objects.get(username='new')
+        self.assertTrue(new.check_password('secret'))
+        self.assertTrue(new.is_staff)
+        self.assertFalse(new.is_superuser)
+        self.assertTrue(TrackerProfile.objects.filter(user=new).exists())
+        self.assertTrue(TrackerPreferences.objects.filter(user=new).exists())
+
+        response = self.import_rows(superuser, 'user', [header, ['new', 'secret', '', '', 'False', 'False', 'True', ''], ['another', 'secret', '', '', 'False', 'False', 'True', '']])
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([(2, 'username')], [(error.line, error.column) for error in response.context['errors']])
+        self.assertFalse(User.objects.filter(username='another').exists())
+
+    def test_import_query_count(self):
+        staffer = User.objects.create_user(username='staffer', password='pw', is_staff=True)
+        header = ['full_name', 'short_name', 'slug', 'description']
+
+        def count_queries(type, rows):
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(302, self.import_rows(staffer, type, rows).status_code)
+            return len(queries)
+
+        few = count_queries('grant', [header] + [['grant %d' % i, 'g', 'few-%d' % i, ''] for i in range(2)])
+        many = count_queries('grant', [header] + [['grant %d' % i, 'g', 'many-%d' % i, ''] for i in range(50)])
+        self.assertEqual(few, many)
+        self.assertEqual(52, Grant.objects.count())
+
+        admin = User.objects.create_user(username='admin', password='pw')
+        topic = Topic.objects.create(name='topic', grant=Grant.objects.get(slug='few-0'))
+        topic.admin.add(admin)
+        ticket = Ticket.objects.create(name='ticket', topic=topic, requested_user=staffer)
+        Notification.objects.all().delete()
+        header = ['ticket_id', 'description', 'amount', 'wage']
+        for type in ('expense', 'preexpense'):
+            few = count_queries(type, [header] + [[ticket.id, 'few %d' % i, '10', 'False'] for i in range(2)])
+            Notification.objects.all().delete()
+            many = count_queries(type, [header] + [[ticket.id, 'many %d' % i, '10', 'False'] for i in range(50)])
+            self.assertEqual(few, many)
+            notification = Notification.objects.get(target_user=admin)
+            self.assertIn('many 49 (10.00 ', str(notification))
+            Notification.objects.all().delete()
+        self.assertEqual(52, ticket.expediture_set.count())
+        self.assertEqual(52, ticket.preexpediture_set.count())
+
 
 class ExportTests(TestCase):
     def setUp(self):
@@ -1135,9 +1449,9 @@ class ExportTests(TestCase):
         self.expeditureWithWagePaid2 = Expediture.objects.create(ticket=self.ticket1, description='tt2', amount='33', accounting_info='', wage=True, paid=True)
         self.expeditureWithoutWagePaid = Expediture.objects.create(ticket=self.ticket2, description='ff', amount='34', accounting_info='', wage=False, paid=False)
 
-    def read_csv(self, csvContent):
+    def read_csv(self, response):
         result = []
-        content = csv.reader(io.StringIO(csvContent.decode('utf-8')))
+        content = csv.reader(io.StringIO(b''.join(response.streaming_content).decode('utf-8')))
         for row in content:
             result.append(row[0].replace('\"', '').split(';'))
         return result
@@ -1154,7 +1468,7 @@ class ExportTests(TestCase):
             'acceptedexpeditures-larger': '',
             'acceptedexpeditures-smaller': ''
         })
-        csvContent = self.read_csv(response.content)
+        csvContent = self.read_csv(response)
         self.assertEqual(200, response.status_code)
         self.assertEqual(len(csvContent) - 1, 2)
         self.assertEqual(csvContent[1][0], str(self.ticket1.id))
@@ -1172,17 +1486,80 @@ class ExportTests(TestCase):
             'acceptedexpeditures-smaller': '',
             'ticket-report-mandatory': ''
         })
-        csvContent = self.read_csv(response.content)
+        csvContent = self.read_csv(response)
         self.assertEqual(200, response.status_code)
         self.assertEqual(len(csvContent) - 1, 1)
         self.assertEqual(csvContent[1][0], str(self.ticket2.id))
         self.assertEqual(csvContent[1][13], str(self.ticket2.mandatory_report))
 
+    def test_export_tickets_by_state(self):
+        self.ticket2.add_acks('user_precontent')
+        response = self.client.post(reverse('export'), {
+            'type': 'ticket',
+            'wfpreapproval': 'waiting for preapproval',
+            'preexpeditures-larger': '',
+            'preexpeditures-smaller': '',
+            'expeditures-larger': '',
+            'expeditures-smaller': '',
+            'acceptedexpeditures-larger': '',
+            'acceptedexpeditures-smaller': ''
+        })
+        csvContent = self.read_csv(response)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(len(csvContent) - 1, 1)
+        self.assertEqual(csvContent[1][0], str(self.ticket2.id))
+
+    def test_export_tickets_filters(self):
+        post = {
+            'type': 'ticket',
+            'preexpeditures-larger': '40',
+            'preexpeditures-smaller': '',
+            'expeditures-larger': '',
+            'expeditures-smaller': '65',
+            'acceptedexpeditures-larger': '',
+            'acceptedexpeditures-smaller': '',
+            'ticket-user-%d' % self.standardUser.id: self.standardUser.id,
+        }
+        with self.assertNumQueries(2):  # missing summaries and tickets
+            csvContent = self.read_csv(self.client.post(reverse('export'), post))
+        self.assertEqual([str(self.ticket1.id)], [row[0] for row in csvContent[1:]])
+        self.assertEqual(45, Decimal(csvContent[1][15]))
+        self.assertEqual(65, Decimal(csvContent[1][16]))
+
+        TicketSummary.objects.filter(ticket=self.ticket1).delete()
+        csvContent = self.read_csv(self.client.post(reverse('export'), post))
+        self.assertEqual([str(self.ticket1.id)], [row[0] for row in csvContent[1:]])
+        self.assertEqual(65, Decimal(csvContent[1][16]))
+
+        post['preexpeditures-larger'] = ''
+        post['ticket-topic-%d' % self.topic2.id] = self.topic2.id
+        csvContent = self.read_csv(self.client.post(reverse('export'), post))
+        self.assertEqual([str(self.ticket2.id)], [row[0] for row in csvContent[1:]])
+
+        post['expeditures-smaller'] = 'many'
+        self.assertEqual(400, self.client.post(reverse('export'), post).status_code)
+
+    def test_export_users_amounts(self):
+        self.client.login(username=self.staffUser.username, password=self.password)
+        self.ticket1.add_acks('content')
+        response = self.client.post(reverse('export'), {
+            'type': 'user',
+            'users-created-larger': '1',
+            'users-accepted-larger': '',
+            'users-paid-larger': '',
+        })
+        csvContent = self.read_csv(response)
+        self.assertEqual(1, len(csvContent) - 1)
+        self.assertEqual(str(self.standardUser.id), csvContent[1][0])
+        self.assertEqual('2', csvContent[1][10])
+        self.assertEqual(65, Decimal(csvContent[1][11]))
+        self.assertEqual(65, Decimal(csvContent[1][12]))
+
     def test_export_grants(self):
         response = self.client.post(reverse('export'), {
             'type': 'grant'
         })
-        csvContent = self.read_csv(response.content)
+        csvContent = self.read_csv(response)
         self.assertEqual(200, response.status_code)
         self.assertEqual(len(csvContent) - 1, 2)
 
@@ -1193,7 +1570,7 @@ class ExportTests(TestCase):
             'preexpediture-amount-larger': '',
             'preexpediture-wage': ''
         })
-        csvContent = self.read_csv(response.content)
+        csvContent = self.read_csv(response)
         self.assertEqual(200, response.status_code)
         self.assertEqual(len(csvContent) - 1, 2)
         self.assertEqual(csvContent[1][0], str(self.ticket1.id))
@@ -1207,7 +1584,7 @@ class ExportTests(TestCase):
             'type': 'preexpediture',
             'preexpediture-amount-larger': ''
         })
-        csvContent = self.read_csv(response.content)
+        csvContent = self.read_csv(response)
         self.assertEqual(200, response.status_code)
         self.assertEqual(len(csvContent) - 1, 1)
         self.assertEqual(csvContent[1][0], str(self.ticket2.id))
@@ -1222,7 +1599,7 @@ class ExportTests(TestCase):
             'expediture-wage': '',
             'expediture-paid': ''
         })
-        csvContent = self.read_csv(response.content)
+        csvContent = self.read_csv(response)
         self.assertEqual(200, response.status_code)
         self.assertEqual(len(csvContent) - 1, 2)
         self.assertEqual(csvContent[1][0], str(self.ticket1.id))
@@ -1239,7 +1616,7 @@ class ExportTests(TestCase):
             'expediture-amount-larger': '',
             'expediture-amount-smaller': ''
         })
-        csvContent = self.read_csv(response.content)
+        csvContent = self.read_csv(response)
         self.assertEqual(200, response.status_code)
         self.assertEqual(len(csvContent) - 1, 1)
         self.assertEqual(csvContent[1][0], str(self.ticket2.id))
@@ -1254,7 +1631,7 @@ class ExportTests(TestCase):
             'topics-tickets-smaller': '',
             'topics-paymentstate': 'default'
         })
-        csvContent = self.read_csv(response.content)
+        csvContent = self.read_csv(response)
         self.assertEqual(200, response.status_code)
         self.assertEqual(len(csvContent) - 1, 2)
         self.assertEqual(csvContent[1][0], str(self.topic1.name))
@@ -1272,7 +1649,7 @@ class ExportTests(TestCase):
             'topics-paymentstate-larger': '',
             'topics-paymentstate-smaller': ''
         })
-        csvContent = self.read_csv(response.content)
+        csvContent = self.read_csv(response)
         self.assertEqual(200, response.status_code)
         self.assertEqual(len(csvContent) - 1, 2)
         self.assertEqual(csvContent[1][0], str(self.topic1.name))
@@ -1316,7 +1693,7 @@ class ExportTests(TestCase):
             'users-accepted-smaller': '',
             'users-paid-larger': ''
         })
-        csvContent = self.read_csv(response.content)
+        csvContent = self.read_csv(response)
         self.assertEqual(200, response.status_code)
         self.assertEqual(len(csvContent) - 1, 3)
 
@@ -1334,7 +1711,7 @@ class ExportTests(TestCase):
             'users-paid-larger': '',
             'user-permision': 'normal'
         })
-        csvContent = self.read_csv(response.content)
+        csvContent = self.read_csv(response)
         self.assertEqual(200, response.status_code)
         self.assertEqual(len(csvContent) - 1, 1)
         self.assertEqual(csvContent[1][0], str(self.standardUser.id))
@@ -1348,7 +1725,7 @@ class ExportTests(TestCase):
             'users-paid-larger': '',
             'user-permision': 'staff'
         })
-        csvContent = self.read_csv(response.content)
+        csvContent = self.read_csv(response)
         self.assertEqual(200, response.status_code)
         self.assertEqual(len(csvContent) - 1, 2)
 
@@ -1365,7 +1742,7 @@ class ExportTests(TestCase):
             'users-paid-larger': '',
             'user-permision': 'superuser'
         })
-        csvContent = self.read_csv(response.content)
+        csvContent = self.read_csv(response)
         self.assertEqual(200, response.status_code)
         self.assertEqual(len(csvContent) - 1, 1)
         self.assertEqual(csvContent[1][0], str(self.superuser.id))
@@ -1475,6 +1852,51 @@ class CacheTicketsTests(TestCase):
             is_json = False
         self.assertTrue(is_json)
 
+    def test_cachetickets_incremental(self):
+        base_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, base_path)
+
+        def cached_names():
+            data = json.loads(open(os.path.join(base_path, 'en.json')).read())['data']
+            return [row[2] for row in data]
+
+        call_command('cachetickets', base_path=base_path, incremental=True)  # no previous run, full render
+        self.assertTrue(os.path.exists(os.path.join(base_path, 'state.json')))
+        self.assertEqual(1, len(cached_names()))
+
+        new_ticket = Ticket.objects.create(name='new ticket', topic=self.topic, requested_user=self.owner)
+        self.ticket.name = 'renamed ticket'
+        self.ticket.save()
+        self.ticket.add_acks('close')
+        call_command('cachetickets', base_path=base_path, incremental=True)
+        names = cached_names()
+        self.assertEqual(2, len(names))
+        self.assertIn('renamed ticket', names[0])  # archived tickets go first
+        self.assertIn('new ticket', names[1])
+        archived = json.loads(open(os.path.join(base_path, 'archived', 'en.json')).read())
+        self.assertEqual(1, len(archived))
+
+        new_ticket.delete()
+        call_command('cachetickets', base_path=base_path, incremental=True)
+        self.assertEqual(1, len(cached_names()))
+        self.assertEqual([], [name for name in os.listdir(base_path) if name.endswith('.tmp')])
+
+    def test_cachetickets_streamed_output(self):
+        base_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, base_path)
+        archived_ticket = Ticket.objects.create(name='archived ticket', topic=self.topic, requested_user=self.owner)
+        archived_ticket.add_acks('archive')
+
+        call_command('cachetickets', base_path=base_path, do_archived=True)
+        summaries = TicketSummary.objects.select_related('ticket')
+        expected_archived = [summary.as_row() for summary in summaries.filter(ticket=archived_ticket)]
+        expected = expected_archived + [summary.as_row() for summary in summaries.filter(ticket=self.ticket)]
+        self.assertEqual(expected_archived, json.loads(open(os.path.join(base_path, 'archived', 'en.json')).read()))
+        self.assertEqual({'data': expected}, json.loads(open(os.path.join(base_path, 'en.json')).read()))
+
+        with self.assertRaises(CommandError):
+            call_command('cachetickets', base_path=base_path, jobs=0)
+
 
 class AdminTests(TestCase):
     def setUp(self):
@@ -1576,6 +1998,807 @@ class PreferencesTests(TestCase):
         self.assertEqual(preferences.email_language, "es")
 
 
+class NotificationTests(TestCase):
+    def setUp(self):
+        self.sender = User.objects.create_user(username='sender')
+        self.requester = User.objects.create_user(username='requester')
+        self.topic = Topic.objects.create(name='topic', grant=Grant.objects.create(full_name='g', short_name='g', slug='g'))
+        self.ticket = Ticket.objects.create(name='ticket', topic=self.topic, requested_user=self.requester)
+
+    def fire(self, notification_type='ticket_change', text='something happened', **kwargs):
+        Notification.fire_notification(self.ticket, text, notification_type, self.sender, **kwargs)
+
+    def recipients(self):
+        return set(Notification.objects.values_list('target_user__username', flat=True))
+
+    def test_recipients(self):
+        admin = User.objects.create_user(username='admin')
+        watching_admin = User.objects.create_user(username='watching_admin')
+        topic_watcher = User.objects.create_user(username='topic_watcher')
+        grant_watcher = User.objects.create_user(username='grant_watcher')
+        self.topic.admin.add(admin, watching_admin, self.sender)
+        Watcher.objects.create(watcher_type='Ticket', object_id=self.ticket.id, user=watching_admin, notification_type='comment')
+        Watcher.objects.create(watcher_type='Topic', object_id=self.topic.id, user=topic_watcher, notification_type='ticket_change')
+        Watcher.objects.create(watcher_type='Grant', object_id=self.topic.grant.id, user=grant_watcher, notification_type='comment')
+
+        self.fire()
+        self.assertEqual({'requester', 'admin', 'topic_watcher'}, self.recipients())
+
+    def test_muted(self):
+        preferences = self.requester.trackerpreferences
+        preferences.muted_notifications = json.dumps(['ticket_change'])
+        preferences.save()
+        self.fire()
+        self.assertEqual(set(), self.recipients())
+        self.fire(notification_type='supervisor_notes')
+        self.assertEqual({'requester'}, self.recipients())
+
+    def test_text_data(self):
+        self.fire(text='%(user)s changed the ticket', text_data={'user': 'sender'})
+        self.assertEqual(['sender changed the ticket'], [str(n) for n in Notification.objects.all()])
+
+    def test_rendered_at_send_time(self):
+        self.fire(text=ugettext_lazy('Ticket "%(ticket)s" was deleted by user %(user)s'),
+                  text_data={'ticket': self.ticket, 'user': ugettext_lazy('unknown')})
+        notification = Notification.objects.get()
+        self.assertEqual(self.ticket.id, notification.ticket_id)
+        self.assertEqual('', notification.text)
+        self.assertEqual('Ticket "%s" was deleted by user unknown' % self.ticket, str(notification))
+        with patch('tracker.models.translation.gettext', side_effect=lambda text: '<%s>' % text):
+            self.assertEqual('<Ticket "%s" was deleted by user <unknown>>' % self.ticket, str(notification))
+
+    def test_pending_notifications_suppress_followups(self):
+        with patch('tracker.models.get_user', return_value=self.sender):
+            expediture = Expediture.objects.create(ticket=self.ticket, description='exp', amount=10, wage=False)
+            notification = Notification.objects.get(target_user=self.requester)
+            self.assertEqual('expeditures_new', notification.notification_type)
+            self.assertEqual('expediture:%d' % expediture.id, notification.event_key)
+
+            expediture.amount = 20
+            expediture.save()
+            Expediture.objects.create(ticket=self.ticket, description='other', amount=10, wage=False)
+            self.assertEqual(1, Notification.objects.count())
+
+            Notification.objects.all().delete()
+            expediture.amount = 30
+            expediture.save()
+            self.assertEqual(['expeditures_change'], list(Notification.objects.values_list('notification_type', flat=True)))
+
+    def test_deduplicated(self):
+        self.fire()
+        self.fire()
+        self.assertEqual(1, Notification.objects.count())
+        self.fire(text_data={'other': 'data'})
+        self.assertEqual(2, Notification.objects.count())
+
+    def test_query_count(self):
+        def fire_for(admin_count):
+            Notification.objects.all().delete()
+            self.topic.admin.set([User.objects.create_user(username='admin%d-%d' % (admin_count, i)) for i in range(admin_count)])
+            with CaptureQueriesContext(connection) as queries:
+                self.fire()
+            self.assertEqual(admin_count + 1, Notification.objects.count())
+            return len(queries)
+
+        self.assertEqual(fire_for(2), fire_for(20))
+
+
+class TicketSaveTests(TestCase):
+    def setUp(self):
+        self.sender = User.objects.create_user(username='sender')
+        self.requester = User.objects.create_user(username='requester')
+        self.topic = Topic.objects.create(name='topic', grant=Grant.objects.create(full_name='g', short_name='g', slug='g'))
+        self.ticket = Ticket.objects.get(id=Ticket.objects.create(name='ticket', topic=self.topic, requested_user=self.requester).id)
+
+    def test_change_notifications(self):
+        with patch('tracker.models.get_user', return_value=self.sender):
+            self.ticket.name = 'renamed'
+            self.ticket.supervisor_notes = 'notes'
+            self.ticket.save()
+            self.assertEqual(
+                ['supervisor_notes', 'ticket_change'],
+                sorted(Notification.objects.values_list('notification_type', flat=True))
+            )
+
+            # changes are detected against the state after the last save
+            self.ticket.save()
+            self.assertEqual(2, Notification.objects.count())
+
+    def test_new_ticket_pending(self):
+        Notification.objects.create(target_user=self.requester, ticket_id=self.ticket.id, notification_type='ticket_new')
+        with patch('tracker.models.get_user', return_value=self.sender):
+            self.ticket.name = 'renamed'
+            self.ticket.mandatory_report = True
+            self.ticket.save()
+        self.assertEqual(['ticket_change'], list(Notification.objects.exclude(
+            notification_type='ticket_new').values_list('notification_type', flat=True)))
+
+    def test_save_query_count(self):
+        self.ticket.description = 'changed'
+        # payment status, acks, update, summary refresh (7), change log entry and topic for cache flush
+        with self.assertNumQueries(12):
+            self.ticket.save()
+
+
+class SendNotificationsTests(TestCase):
+    def setUp(self):
+        self.topic = Topic.objects.create(name='topic', grant=Grant.objects.create(full_name='g', short_name='g', slug='g'))
+        self.ticket = Ticket.objects.create(name='ticket', topic=self.topic)
+
+    def notify(self, user, notification_type='comment', text='something happened'):
+        return Notification.objects.create(target_user=user, ticket_id=self.ticket.id, notification_type=notification_type,
+                                           payload=Notification.make_payload(text))
+
+    def test_digest(self):
+        alice = User.objects.create_user(username='alice', email='alice@example.com')
+        bob = User.objects.create_user(username='bob', email='bob@example.com')
+        nomail = User.objects.create_user(username='nomail')
+        self.notify(alice, text='comment for alice')
+        self.notify(alice, notification_type='ticket_new', text='new ticket for alice')
+        self.notify(bob, text='comment for bob')
+        self.notify(nomail)
+
+        call_command('sendnotifications', workers=2)
+
+        self.assertEqual(0, Notification.objects.count())
+        messages = {message.to[0]: message for message in mail.outbox}
+        self.assertEqual({'alice@example.com', 'bob@example.com'}, set(messages))
+        alice_message = messages['alice@example.com']
+        self.assertIn('comment for alice', alice_message.body)
+        self.assertIn('new ticket for alice', alice_message.body)
+        self.assertNotIn('bob', alice_message.body)
+        self.assertNotIn('<h1>', alice_message.body)
+        self.assertIn('<h1>', alice_message.alternatives[0][0])
+
+    def test_keep_and_only_process(self):
+        alice = User.objects.create_user(username='alice', email='alice@example.com')
+        bob = User.objects.create_user(username='bob', email='bob@example.com')
+        self.notify(alice)
+        self.notify(bob)
+
+        call_command('sendnotifications', keep=False, process_users=['alice'])
+        self.assertEqual(['alice@example.com'], [message.to[0] for message in mail.outbox])
+        self.assertEqual(2, Notification.objects.count())
+
+        call_command('sendnotifications', process_users=['#%d' % bob.id], email_user=['alice'])
+        self.assertEqual(['alice@example.com'], mail.outbox[1].to)
+        self.assertEqual(['alice'], list(Notification.objects.values_list('target_user__username', flat=True)))
+
+    def test_query_count(self):
+        def send_to(user_count):
+            for i in range(user_count):
+                self.notify(User.objects.create_user(username='user%d-%d' % (user_count, i), email='user@example.com'))
+            with CaptureQueriesContext(connection) as queries:
+                call_command('sendnotifications', batch_size=100)
+            self.assertEqual(0, Notification.objects.count())
+            return len(queries)
+
+        self.assertEqual(send_to(2), send_to(20))
+
+
+class ReadyForApprovalTests(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_user(username='admin', password='pw')
+        self.topic = Topic.objects.create(name='topic', grant=Grant.objects.create(full_name='g', short_name='g', slug='g'))
+        self.topic.admin.add(self.admin)
+        self.tickets = {}
+        for name, acks in (
+            ('ready', ['user_content']),
+            ('recent', ['user_content']),
+            ('approved', ['user_content', 'content']),
+            ('archived', ['user_content', 'archive']),
+            ('preready', ['user_precontent']),
+            ('preapproved', ['user_precontent', 'content']),
+            ('draft', []),
+        ):
+            ticket = Ticket.objects.create(name=name, topic=self.topic)
+            ticket.add_acks(*acks)
+            self.tickets[name] = ticket
+        long_ago = datetime.datetime.now(tz=datetime.timezone.utc) - datetime.timedelta(days=settings.TRACKER_MIN_WAIT_DAYS + 1)
+        TicketAck.objects.exclude(ticket=self.tickets['recent']).update(added=long_ago)
+
+    def test_ready_for(self):
+        for ack, expected in (('content', ['ready']), ('precontent', ['preready'])):
+            self.assertEqual(expected, [t.name for t in Ticket.objects.ready_for(ack)])
+            self.assertEqual(
+                set(expected),
+                {name for name, ticket in self.tickets.items() if Ticket.objects.get(id=ticket.id).can_ack_be_added(ack)},
+            )
+
+    def test_dashboard(self):
+        c = Client()
+        c.login(username='admin', password='pw')
+        response = c.get(reverse('topic_ready_tickets'))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(1, len(response.context['topics']))
+        row = response.context['topics'][0]
+        self.assertEqual(self.topic, row['topic'])
+        self.assertEqual([self.tickets['preready']], row['precontent'])
+        self.assertEqual([self.tickets['ready']], row['content'])
+
+        User.objects.create_user(username='other', password='pw')
+        c.login(username='other', password='pw')
+        self.assertEqual([], c.get(reverse('topic_ready_tickets')).context['topics'])
+
+    def test_api(self):
+        response = self.client.get('/api/tracker/tickets/ready/', {'ack': 'precontent', 'topic': self.topic.id})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(['preready'], [t['name'] for t in response.json()['results']])
+
+        response = self.client.get('/api/tracker/tickets/ready/', {'ack': 'docs'})
+        self.assertEqual(400, response.status_code)
+
+
+class FinanceTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='user', password='pw')
+        self.grants = [Grant.objects.create(full_name='grant %d' % i, short_name='g%d' % i, slug='g%d' % i) for i in range(2)]
+        self.topics = [Topic.objects.create(name='topic %d' % i, grant=self.grants[i % 2]) for i in range(3)]
+        self.subtopic = Subtopic.objects.create(name='subtopic', topic=self.topics[0])
+        for i, (rating, acks, expeditures) in enumerate((
+            (100, ['content'], [('10.00', False, False), ('20.50', True, True)]),
+            (33, ['content'], [('10.01', True, False), ('7.77', False, True), ('3.33', True, True)]),
+            (50, [], [('100.00', True, False)]),
+            (None, ['content'], [('12.00', True, True)]),
+            (0, ['content'], [('1.00', False, False)]),
+            (67, ['content'], [('0.01', True, True), ('5.55', True, False)]),
+            (100, ['content'], []),
+        )):
+            ticket = Ticket.objects.create(
+                name='ticket %d' % i, topic=self.topics[i % 3], rating_percentage=rating,
+                subtopic=self.subtopic if i % 3 == 0 else None, requested_user=self.user if i % 2 else None,
+            )
+            ticket.add_acks(*acks)
+            for amount, paid, wage in expeditures:
+                Expediture.objects.create(ticket=ticket, description='e', amount=amount, paid=paid, wage=wage)
+            ticket.save()
+
+    def python_finance(self, tickets):
+        """ Finance computed by looping over tickets, like Topic and Grant used to do """
+        status = FinanceStatus()
+        paid_wages = 0
+        for ticket in tickets:
+            status.add_ticket(ticket)
+            if ticket.rating_percentage:
+                paid_wages += sum((e.amount for e in ticket.expediture_set.filter(wage=True, paid=True)), Decimal(0)) * ticket.rating_percentage / 100
+        return {
+            'accepted': sum(t.accepted_expeditures() for t in tickets if t.rating_percentage),
+            'paid': sum(t.paid_expeditures() for t in tickets),
+            'paid_wages': paid_wages,
+            'status': status,
+            'tickets': len(tickets),
+        }
+
+    def assertFinance(self, tickets, finance):
+        expected = self.python_finance(list(tickets))
+        self.assertEqual(expected['accepted'], finance.accepted)
+        self.assertEqual(expected['paid'], finance.paid)
+        self.assertEqual(expected['paid_wages'], finance.paid_wages)
+        self.assertEqual(expected['status'], finance.status)
+        self.assertEqual(expected['tickets'], finance.tickets)
+
+    def test_consistency(self):
+        for topic, prefetched in zip(self.topics, Topic.prefetch_finance(Topic.objects.order_by('id'))):
+            tickets = topic.ticket_set.all()
+            self.assertFinance(tickets, topic.finance())
+            self.assertFinance(tickets, prefetched.finance())
+            self.assertEqual(topic.accepted_expeditures(), self.python_finance(list(tickets))['accepted'])
+            self.assertEqual(topic.payment_summary(), self.python_finance(list(tickets))['status'])
+
+        for grant in self.grants:
+            self.assertFinance(Ticket.objects.filter(topic__grant=grant), grant.finance())
+            self.assertEqual(sum(t.paid_wages() for t in grant.topic_set.all()), grant.total_paid_wages())
+            self.assertEqual(sum(t.paid_together() for t in grant.topic_set.all()), grant.total_paid_together())
+
+        self.assertFinance(self.subtopic.ticket_set.all(), self.subtopic.finance())
+
+        profile = self.user.trackerprofile
+        self.assertEqual(self.python_finance(list(self.user.ticket_set.all()))['accepted'], profile.accepted_expeditures())
+        self.assertEqual(
+            sum(e.amount for e in Expediture.objects.filter(ticket__requested_user=self.user, paid=True)),
+            profile.paid_expeditures(),
+        )
+
+    def test_constant_queries(self):
+        def count_queries(url):
+            cache.clear()
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(200, self.client.get(url).status_code)
+            return len(queries)
+
+        for url in (reverse('topic_finance'), reverse('grant_list'), reverse('topic_list')):
+            before = count_queries(url)
+            grant = Grant.objects.create(full_name='another', short_name='a', slug='another-%d' % Grant.objects.count())
+            for i in range(3):
+                topic = Topic.objects.create(name='another %d' % i, grant=grant)
+                Ticket.objects.create(name='another %d' % i, topic=topic, rating_percentage=100)
+            self.assertEqual(before, count_queries(url), url)
+
+
+class CachedModelTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='user', password='pw')
+        self.grant = Grant.objects.create(full_name='g', short_name='g', slug='g')
+        self.topic = Topic.objects.create(name='topic', grant=self.grant)
+        self.subtopic = Subtopic.objects.create(name='subtopic', topic=self.topic)
+        self.ticket = Ticket.objects.create(name='ticket', topic=self.topic, subtopic=self.subtopic,
+                                            requested_user=self.user, rating_percentage=100)
+        self.ticket.add_acks('content')
+
+    def aggregates(self):
+        return (
+            Ticket.objects.get(id=self.ticket.id).preexpeditures()['amount'],
+            Subtopic.objects.get(id=self.subtopic.id).paid_together(),
+            Topic.objects.get(id=self.topic.id).paid_together(),
+            Grant.objects.get(id=self.grant.id).total_paid_together(),
+            TrackerProfile.objects.get(user=self.user).paid_expeditures(),
+        )
+
+    def test_dependents_flushed(self):
+        self.assertEqual((None, 0, 0, 0, 0), self.aggregates())
+        self.ticket.preexpediture_set.create(description='foo', amount=10)
+        expediture = self.ticket.expediture_set.create(description='foo', amount=100, paid=True)
+        self.assertEqual((10, 100, 100, 100, 100), self.aggregates())
+
+        expediture.delete()
+        self.assertEqual((10, 0, 0, 0, 0), self.aggregates())
+
+    def test_ticket_moved(self):
+        self.ticket.expediture_set.create(description='foo', amount=100, paid=True)
+        other_grant = Grant.objects.create(full_name='other', short_name='o', slug='o')
+        other_topic = Topic.objects.create(name='other', grant=other_grant)
+        self.assertEqual((None, 100, 100, 100, 100), self.aggregates())
+        self.assertEqual(0, other_grant.total_paid_together())
+
+        ticket = Ticket.objects.get(id=self.ticket.id)
+        ticket.topic, ticket.subtopic = other_topic, None
+        ticket.save()
+        self.assertEqual((None, 0, 0, 0, 100), self.aggregates())
+        self.assertEqual(100, Grant.objects.get(id=other_grant.id).total_paid_together())
+
+        other_topic.grant = self.grant
+        other_topic.save()
+        self.assertEqual(100, Grant.objects.get(id=self.grant.id).total_paid_together())
+        self.assertEqual(0, Grant.objects.get(id=other_grant.id).total_paid_together())
+
+    def test_request_local_cache(self):
+        class FakeRequest(object):
+            pass
+
+        grant = Grant.objects.get(id=self.grant.id)
+        grant.total_paid_together()
+        with patch('tracker.services.get_request', return_value=FakeRequest()), \
+                patch('tracker.models.cache.get_many', wraps=cache.get_many) as get_many:
+            for i in range(3):
+                self.assertEqual(0, grant.total_paid_together())
+            get_many.assert_called_once()  # version and value in one round trip, then served locally
+
+            self.ticket.expediture_set.create(description='foo', amount=100, paid=True)
+            self.assertEqual(100, grant.total_paid_together())
+
+    def test_prefetch_cache(self):
+        self.ticket.expediture_set.create(description='foo', amount=100, paid=True)
+        self.ticket.preexpediture_set.create(description='foo', amount=10)
+        self.ticket.mediainfoold_set.create(description='foo', count=5)
+        for i in range(3):
+            Ticket.objects.create(name='another %d' % i, topic=self.topic, rating_percentage=50)
+        names = Ticket.listing_cached_getters
+        expected = [[getattr(Ticket, name).raw_method(ticket) for name in names] for ticket in Ticket.objects.order_by('id')]
+
+        cache.clear()
+        with self.assertNumQueries(len(names) + 2):
+            tickets = Ticket.prefetch_cache(Ticket.objects.order_by('id'), names)
+            self.assertEqual(expected, [[getattr(ticket, name)() for name in names] for ticket in tickets])
+
+        with self.assertNumQueries(1), patch('tracker.models.cache.get_many', wraps=cache.get_many) as get_many:
+            tickets = Ticket.prefetch_cache(Ticket.objects.order_by('id'), names)
+            self.assertEqual(expected, [[getattr(ticket, name)() for name in names] for ticket in tickets])
+        get_many.assert_called_once()
+
+    def test_warmcache(self):
+        self.ticket.expediture_set.create(description='foo', amount=100, paid=True)
+        cache.clear()
+        call_command('warmcache', stdout=io.StringIO())
+        with self.assertNumQueries(1):
+            tickets = Ticket.prefetch_cache(Ticket.objects.all(), Ticket.listing_cached_getters)
+            self.assertEqual(100, tickets[0].paid_expeditures())
+        with self.assertNumQueries(0):
+            self.assertEqual(100, self.topic.paid_together())
+
+
+class TicketListingTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='user', password='pw')
+        self.grant = Grant.objects.create(full_name='g', short_name='g', slug='g')
+        self.topic = Topic.objects.create(name='topic', grant=self.grant)
+        self.subtopic = Subtopic.objects.create(name='subtopic', topic=self.topic)
+        self.cluster = None
+        self.add_tickets(2)
+
+    def add_tickets(self, count):
+        for i in range(count):
+            user = User.objects.create_user(username='requester %d' % User.objects.count())
+            ticket = Ticket.objects.create(name='ticket', topic=self.topic, subtopic=self.subtopic,
+                                           requested_user=(user, self.user)[i % 2], rating_percentage=50)
+            ticket.add_acks('content')
+            ticket.expediture_set.create(description='foo', amount=100, paid=True)
+            ticket.preexpediture_set.create(description='foo', amount=10)
+            ticket.mediainfoold_set.create(description='foo', count=5)
+            if self.cluster is None:
+                self.cluster = Cluster.objects.create(id=ticket.id, more_tickets=True)
+        Ticket.objects.update(cluster=self.cluster)
+
+    def test_for_listing(self):
+        expected = [[getattr(Ticket, name).raw_method(ticket) for name in Ticket.listing_cached_getters]
+                    for ticket in Ticket.objects.order_by('id')]
+        tickets = list(Ticket.objects.for_listing().order_by('id'))
+        with self.assertNumQueries(0):
+            self.assertEqual(expected, [[ticket._listing_value(name) for name in Ticket.listing_cached_getters]
+                                        for ticket in tickets])
+        cache.clear()
+        with self.assertNumQueries(0):
+            Ticket.prefetch_cache(tickets, Ticket.listing_cached_getters)
+
+    def test_constant_queries(self):
+        urls = (
+            reverse('topic_detail', kwargs={'pk': self.topic.id}),
+            reverse('subtopic_detail', kwargs={'pk': self.subtopic.id}),
+            reverse('grant_detail', kwargs={'slug': self.grant.slug}),
+            reverse('user_detail', kwargs={'username': self.user.username}),
+            reverse('cluster_detail', kwargs={'pk': self.cluster.id}),
+        )
+
+        def count_queries():
+            counts = []
+            for url in urls:
+                cache.clear()
+                with CaptureQueriesContext(connection) as queries:
+                    response = self.client.get(url)
+                    self.assertEqual(200, response.status_code)
+                counts.append(len(queries))
+            return counts
+
+        count_queries()  # content types of comments are cached by the first request
+        before = count_queries()
+        self.add_tickets(5)
+        self.assertEqual(before, count_queries())
+        self.assertEqual(7, len(self.client.get(urls[0]).context['ticket_list']))
+
+
+class ApiListTests(TestCase):
+    def setUp(self):
+        self.grant = Grant.objects.create(full_name='g', short_name='g', slug='g')
+        self.user = User.objects.create_user(username='user', password='pw')
+        self.add_objects(2)
+
+    def add_objects(self, count):
+        for i in range(count):
+            topic = Topic.objects.create(name='topic', grant=self.grant)
+            topic.admin.add(self.user)
+            Subtopic.objects.create(name='subtopic', topic=topic)
+            ticket = Ticket.objects.create(name='ticket', topic=topic, requested_user=self.user)
+            ticket.add_acks('user_precontent')
+            ticket.expediture_set.create(description='foo', amount=100)
+            MediaInfo(ticket=ticket, page_title='File:%d.jpg' % ticket.id, page_id=ticket.id).save(no_update=True)
+
+    def test_constant_queries(self):
+        urls = ('/api/tracker/tickets/', '/api/tracker/mediainfo/', '/api/tracker/topics/', '/api/tracker/expeditures/',
+                '/api/auth/users/')
+
+        def count_queries():
+            counts = []
+            for url in urls:
+                with CaptureQueriesContext(connection) as queries:
+                    self.assertEqual(200, self.client.get(url).status_code)
+                counts.append(len(queries))
+            return counts
+
+        before = count_queries()
+        self.add_objects(3)
+        self.assertEqual(before, count_queries())
+
+        tickets = self.client.get('/api/tracker/tickets/').json()['results']
+        self.assertEqual(['waiting for preapproval'] * 5, [ticket['state_str'] for ticket in tickets])
+        self.assertEqual(['topic'] * 5, [media['topic'] for media in self.client.get('/api/tracker/mediainfo/').json()['results']])
+        self.assertEqual([1] * 5, [len(topic['subtopics']) for topic in self.client.get('/api/tracker/topics/').json()])
+
+    def test_cursor_pagination(self):
+        self.add_objects(3)
+        response = self.client.get('/api/tracker/tickets/', {'page_size': 2}).json()
+        urls = [ticket['url'] for ticket in response['results']]
+        while response['next']:
+            response = self.client.get(response['next']).json()
+            urls += [ticket['url'] for ticket in response['results']]
+        ids = [int(url.rstrip('/').rsplit('/', 1)[1]) for url in urls]
+        self.assertEqual(sorted(Ticket.objects.values_list('id', flat=True), reverse=True), ids)
+
+    def test_sparse_fields(self):
+        ticket = Ticket.objects.order_by('-id')[0]
+        response = self.client.get('/api/tracker/tickets/', {'fields': 'id,name,topic,state_str', 'links': 'false'})
+        self.assertEqual(
+            {'id': ticket.id, 'name': 'ticket', 'topic': ticket.topic_id, 'state_str': 'waiting for preapproval'},
+            response.json()['results'][0],
+        )
+
+        response = self.client.get('/api/tracker/tickets/', {'fields': 'url,topic'})
+        self.assertEqual(['topic', 'url'], sorted(response.json()['results'][0]))
+        self.assertTrue(response.json()['results'][0]['topic'].endswith('/api/tracker/topics/%d/' % ticket.topic_id))
+
+    def test_expand(self):
+        self.add_objects(3)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/tracker/mediainfo/', {'expand': 'ticket', 'fields': 'page_title,ticket',
+                                                                   'links': 'false'})
+        media = response.json()['results']
+        self.assertEqual(5, len(media))
+        self.assertEqual('ticket', media[0]['ticket']['name'])
+        self.assertEqual(self.user.id, media[0]['ticket']['requested_user'])
+        self.assertLess(len(queries), 5)
+
+    def test_ndjson(self):
+        response = self.client.get('/api/tracker/tickets/', {'format': 'ndjson', 'page_size': 1, 'fields': 'name'})
+        self.assertEqual('application/x-ndjson', response['Content-Type'])
+        self.assertEqual(b'{"name":"ticket"}\n', response.content)
+        self.assertIn('rel="next"', response['Link'])
+
+    def test_change_feed(self):
+        since = ChangeLogEntry.last_seq()
+        ticket = Ticket.objects.order_by('-id')[0]
+        ticket.name = 'renamed'
+        ticket.save()
+        expediture_id = ticket.expediture_set.get().id
+        Expediture.objects.filter(id=expediture_id).delete()
+        changes = self.client.get('/api/tracker/changes/', {'since': since}).json()['results']
+        self.assertEqual(
+            [('expediture', expediture_id, True), ('ticket', ticket.id, False)],
+            sorted((change['model'], change['object_id'], change['deleted']) for change in changes),
+        )
+        self.assertEqual(sorted(change['seq'] for change in changes), [change['seq'] for change in changes])
+        self.assertTrue(all(change['seq'] > since for change in changes))
+        self.assertEqual(400, self.client.get('/api/tracker/changes/', {'since': 'x'}).status_code)
+
+    def test_updated_since(self):
+        ChangeLogEntry.objects.update(changed=timezone.now() - datetime.timedelta(days=2))
+        ticket = Ticket.objects.order_by('id')[0]
+        ticket.name = 'renamed'
+        ticket.save()
+        since = (timezone.now() - datetime.timedelta(days=1)).isoformat()
+        response = self.client.get('/api/tracker/tickets/', {'updated_since': since, 'fields': 'name'})
+        self.assertEqual([{'name': 'renamed'}], response.json()['results'])
+        self.assertEqual([], self.client.get('/api/tracker/topics/', {'updated_since': since}).json())
+        self.assertEqual(400, self.client.get('/api/tracker/tickets/', {'updated_since': 'yesterday'}).status_code)
+
+    def test_prune_change_log(self):
+        ChangeLogEntry.objects.update(changed=timezone.now() - datetime.timedelta(days=100))
+        last = ChangeLogEntry.last_seq()
+        Ticket.objects.order_by('id')[0].save()
+        call_command('prunechangelog', stdout=io.StringIO())
+        self.assertEqual([last + 1], list(ChangeLogEntry.objects.values_list('id', flat=True)))
+
+        self.assertEqual(400, self.client.get('/api/tracker/changes/', {'since': last - 1}).status_code)
+        changes = self.client.get('/api/tracker/changes/', {'since': last}).json()['results']
+        self.assertEqual([last + 1], [change['seq'] for change in changes])
+        since = (timezone.now() - datetime.timedelta(days=100)).isoformat()
+        self.assertEqual(400, self.client.get('/api/tracker/tickets/', {'updated_since': since}).status_code)
+
+        # the last entry is kept, sequence numbers don't start over
+        ChangeLogEntry.objects.update(changed=timezone.now() - datetime.timedelta(days=100))
+        call_command('prunechangelog', stdout=io.StringIO())
+        self.assertEqual(last + 1, ChangeLogEntry.last_seq())
+
+    def test_etag(self):
+        response = self.client.get('/api/tracker/tickets/')
+        etag = response['ETag']
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/tracker/tickets/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+        self.assertNotEqual(etag, self.client.get('/api/tracker/tickets/', {'page_size': 1})['ETag'])
+
+        Topic.objects.all()[0].save()
+        response = self.client.get('/api/tracker/tickets/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertNotEqual(etag, response['ETag'])
+
+
+class ApiBulkTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='user', password='pw')
+        self.topic = Topic.objects.create(name='topic', ticket_media=True, ticket_expenses=True,
+                                          grant=Grant.objects.create(full_name='g', short_name='g', slug='g'))
+        self.ticket = Ticket.objects.create(name='ticket', topic=self.topic, requested_user=self.user)
+        self.ticket_url = '/api/tracker/tickets/%d/' % self.ticket.id
+        self.client.login(username='user', password='pw')
+
+    def post_media(self, first, last):
+        return self.client.post('/api/tracker/mediainfo/bulk/', [
+            {'ticket': self.ticket_url, 'page_id': i, 'page_title': 'File:%d.jpg' % i} for i in range(first, last)
+        ], content_type='application/json')
+
+    @patch('django.db.transaction.on_commit', side_effect=lambda func: func())
+    def test_create_media(self, on_commit):
+        self.assertEqual(201, self.post_media(1, 2).status_code)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(201, self.post_media(2, 3).status_code)
+        with self.assertNumQueries(len(queries)):
+            response = self.post_media(3, 30)
+        self.assertEqual(201, response.status_code)
+        self.assertEqual(27, len(response.json()))
+
+        response = self.post_media(29, 31)
+        self.assertEqual(['File:30.jpg'], [media['page_title'] for media in response.json()])
+        self.assertEqual(30, self.ticket.mediainfo_set.count())
+        self.assertEqual(30, TicketSummary.objects.get(ticket=self.ticket).media_count)
+        self.assertEqual(1, Task.objects.filter(task_name='tracker.models.sync_media').count())
+        self.assertEqual(30, ChangeLogEntry.objects.filter(model='mediainfo').count())
+
+    def test_create_expeditures(self):
+        self.topic.admin.add(User.objects.create_user(username='admin'))
+
+        def count_queries(count):
+            Notification.objects.all().delete()
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post('/api/tracker/expeditures/bulk/', [
+                    {'ticket': self.ticket_url, 'description': 'item %d' % i, 'amount': '10'} for i in range(count)
+                ], content_type='application/json')
+            self.assertEqual(201, response.status_code)
+            self.assertEqual(1, Notification.objects.filter(notification_type='expeditures_new').count())
+            return len(queries)
+
+        self.assertEqual(count_queries(2), count_queries(40))
+        self.assertEqual(42, self.ticket.expediture_set.count())
+        self.assertEqual(420, TicketSummary.objects.get(ticket=self.ticket).expeditures_amount)
+
+        # objects are not created without their side effects
+        with patch('tracker.csvimport.TicketSummary.rebuild', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                self.client.post('/api/tracker/expeditures/bulk/', [
+                    {'ticket': self.ticket_url, 'description': 'item', 'amount': '10'}], content_type='application/json')
+        self.assertEqual(42, self.ticket.expediture_set.count())
+
+    def test_invalid_item(self):
+        response = self.client.post('/api/tracker/expeditures/bulk/', [
+            {'ticket': self.ticket_url, 'description': 'train', 'amount': '100'},
+            {'ticket': self.ticket_url, 'description': 'bus'},
+        ], content_type='application/json')
+        self.assertEqual(400, response.status_code)
+        self.assertEqual([{}, {'amount': ['This field is required.']}], response.json())
+        self.assertEqual(0, Expediture.objects.count())
+
+    def test_update_expeditures(self):
+        self.topic.admin.add(User.objects.create_user(username='admin'))
+        expeditures = [self.ticket.expediture_set.create(description='item %d' % i, amount=100) for i in range(3)]
+        response = self.client.patch('/api/tracker/expeditures/bulk/', [
+            {'id': expediture.id, 'amount': '150.00'} for expediture in expeditures[:2]
+        ], content_type='application/json')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(['150.00', '150.00', '100.00'], [
+            str(amount) for amount in Expediture.objects.order_by('id').values_list('amount', flat=True)])
+        self.assertEqual(400, TicketSummary.objects.get(ticket=self.ticket).expeditures_amount)
+        notification = Notification.objects.get(notification_type='expeditures_change')
+        self.assertIn('from <tt>item 0 (100.00 CZK), item 1 (100.00 CZK)</tt> to <tt>item 0 (150.00 CZK), item 1 (150.00 CZK)</tt>',
+                      str(notification))
+
+        def count_queries(count, amount):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.patch('/api/tracker/expeditures/bulk/', [
+                    {'id': expediture.id, 'amount': amount, 'paid': True} for expediture in expeditures[:count]
+                ], content_type='application/json')
+            self.assertEqual(200, response.status_code)
+            return len(queries)
+
+        expeditures += [self.ticket.expediture_set.create(description='item %d' % i, amount=100) for i in range(3, 40)]
+        self.assertEqual(count_queries(2, '1'), count_queries(40, '2'))
+        self.assertEqual(3, Notification.objects.filter(notification_type='expeditures_change').count())
+
+        response = self.client.patch('/api/tracker/expeditures/bulk/', [{'id': 0, 'amount': '1'}],
+                                     content_type='application/json')
+        self.assertEqual(400, response.status_code)
+
+    def test_delete(self):
+        ids = [self.ticket.preexpediture_set.create(description='item %d' % i, amount=100).id for i in range(3)]
+        other = Ticket.objects.create(name='other', topic=self.topic).preexpediture_set.create(description='x', amount=1)
+
+        response = self.client.delete('/api/tracker/preexpeditures/bulk/', ids[:2] + [other.id],
+                                      content_type='application/json')
+        self.assertEqual(403, response.status_code)
+        self.assertEqual(4, Preexpediture.objects.count())
+
+        self.topic.admin.add(User.objects.create_user(username='admin'))
+        response = self.client.delete('/api/tracker/preexpeditures/bulk/', ids[:2], content_type='application/json')
+        self.assertEqual(204, response.status_code)
+        self.assertEqual([ids[2]], list(self.ticket.preexpediture_set.values_list('id', flat=True)))
+        self.assertEqual(100, TicketSummary.objects.get(ticket=self.ticket).preexpeditures_amount)
+        self.assertEqual(ids[:2], list(ChangeLogEntry.objects.filter(deleted=True).order_by('object_id').values_list('object_id', flat=True)))
+        notification = Notification.objects.get(notification_type='preexpeditures_change')
+        self.assertIn('item 0 (100.00 CZK), item 1 (100.00 CZK)', str(notification))
+
+        def count_queries(count):
+            ids = [self.ticket.preexpediture_set.create(description='item', amount=1).id for i in range(count)]
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.delete('/api/tracker/preexpeditures/bulk/', ids, content_type='application/json')
+            self.assertEqual(204, response.status_code)
+            return len(queries)
+
+        self.assertEqual(count_queries(2), count_queries(40))
+        self.assertEqual(1, self.ticket.preexpediture_set.count())
+
+    @override_settings(MEDIAINFO_MEDIAWIKI_TEMPLATE='Tracker', MEDIAINFO_MEDIAWIKI_INFO_TEMPLATE='Information')
+    @patch('django.db.transaction.on_commit', side_effect=lambda func: func())
+    def test_delete_media(self, on_commit):
+        media = [MediaInfo(ticket=self.ticket, page_id=i, page_title='File:%d.jpg' % i) for i in range(1, 4)]
+        for mediainfo in media:
+            mediainfo.save(no_update=True)
+        MediaInfoCategory.objects.create(mediainfo=media[0], title='Category')
+
+        response = self.client.delete('/api/tracker/mediainfo/bulk/', [m.id for m in media[:2]], content_type='application/json')
+        self.assertEqual(204, response.status_code)
+        self.assertEqual([media[2].id], list(self.ticket.mediainfo_set.values_list('id', flat=True)))
+        self.assertFalse(MediaInfoCategory.objects.exists())
+        task = Task.objects.get(task_name='tracker.models.remove_many_from_mediawiki')
+        self.assertEqual([[[1, 2], self.user.id], {}], json.loads(task.task_params))
+
+
+@override_settings(MEDIAINFO_MEDIAWIKI_TEMPLATE='Tracker', MEDIAINFO_MEDIAWIKI_INFO_TEMPLATE='Information')
+class TicketJobTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='user')
+        self.topic = Topic.objects.create(name='topic', grant=Grant.objects.create(full_name='g', short_name='g', slug='g'))
+        self.ticket = Ticket.objects.create(name='ticket', topic=self.topic, requested_user=self.user)
+        self.media = MediaInfo(ticket=self.ticket, page_id=1, page_title='File:1.jpg')
+        self.media.save(no_update=True)
+
+    def test_coalesce(self):
+        other = User.objects.create_user(username='other')
+        with override_settings(TRACKER_MAINTENANCE_USER_ID=self.user.id):
+            self.ticket.save()
+            first_run_at = Task.objects.get(task_name='tracker.models._update_mediainfo').run_at
+            self.ticket.add_acks('user_precontent')
+        with override_settings(TRACKER_MAINTENANCE_USER_ID=other.id):
+            self.ticket.save()
+        task = Task.objects.get(task_name='tracker.models._update_mediainfo')
+        self.assertEqual([[self.ticket.id, other.id], {}], json.loads(task.task_params))
+        self.assertEqual(first_run_at, task.run_at)
+
+        # a job queued by a concurrent first call is dropped
+        Ticket._update_mediainfo(self.ticket.id, other.id, verbose_name=task.verbose_name)
+        schedule_ticket_job(Ticket._update_mediainfo, self.ticket.id, self.user.id)
+        self.assertEqual([task.id], list(Task.objects.values_list('id', flat=True)))
+
+        # a running job is left alone
+        Task.objects.update(locked_by='1', locked_at=timezone.now())
+        with override_settings(TRACKER_MAINTENANCE_USER_ID=other.id):
+            self.ticket.save()
+        self.assertEqual(2, Task.objects.filter(task_name='tracker.models._update_mediainfo').count())
+
+    def test_requeuetickets(self):
+        MediaInfo(ticket=self.ticket, page_id=2, page_title='File:2.jpg').save(no_update=True)
+        with override_settings(TRACKER_MAINTENANCE_USER_ID=self.user.id):
+            call_command('requeuetickets', self.ticket.id, stdout=io.StringIO())
+        task = Task.objects.get()
+        self.assertEqual('tracker.models._update_mediainfo', task.task_name)
+        self.assertEqual([[self.ticket.id, self.user.id], {}], json.loads(task.task_params))
+
+        with self.assertRaises(CommandError):
+            call_command('requeuetickets', self.ticket.id + 1, stdout=io.StringIO())
+
+    @patch('socialauth.api.MediaWiki.put_content')
+    @patch('socialauth.api.MediaWiki.get_content', return_value='{{Information}}')
+    def test_synced_hash(self, get_content, put_content):
+        MediaInfo.add_templates(self.ticket, [self.media], self.user.id)
+        self.assertEqual(1, put_content.call_count)
+        self.assertIn('|tiket=%d}}' % self.ticket.id, put_content.call_args[0][1])
+
+        MediaInfo.add_templates(self.ticket, list(self.ticket.mediainfo_set.all()), self.user.id)
+        self.assertEqual(1, get_content.call_count)
+        self.assertEqual(1, put_content.call_count)
+
+        self.ticket.subtopic = Subtopic.objects.create(name='subtopic', topic=self.topic)
+        MediaInfo.add_templates(self.ticket, list(self.ticket.mediainfo_set.all()), self.user.id)
+        self.assertEqual(2, put_content.call_count)
+
+
 class MediaInfoCommunicationTests(TestCase):
 
     def setUp(self):
@@ -1614,3 +2837,240 @@ class MediaInfoCommunicationTests(TestCase):
         mock_request.assert_called_once_with(937952,  # Example.svg
                                              MediaInfo.strip_template(self.mediawiki.get_content(937952)),
                                              minor=True)
+
+
+class FakeMediaWikiResponse(object):
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+def fake_query(payload, *args, **kwargs):
+    """ Answers queries for titles and pageids like MediaWiki would; files numbered 900 and more don't exist """
+    query = {'pages': []}
+    for title in payload.get('titles', '').split('|') if payload.get('titles') else []:
+        canonical = title[0].upper() + title[1:]
+        if canonical != title:
+            query.setdefault('normalized', []).append({'from': title, 'to': canonical})
+        page_id = int(title.split(':')[1].split('.')[0].lstrip('f'))
+        if page_id >= 900:
+            query['pages'].append({'ns': 6, 'title': canonical, 'missing': True})
+        else:
+            query['pages'].append({'pageid': page_id, 'ns': 6, 'title': canonical})
+    for page_id in payload.get('pageids', '').split('|') if payload.get('pageids') else []:
+        if int(page_id) >= 900:
+            query['pages'].append({'pageid': int(page_id), 'missing': True})
+        else:
+            query['pages'].append({'pageid': int(page_id), 'ns': 6, 'title': 'File:%s.jpg' % page_id})
+    return FakeMediaWikiResponse({'batchcomplete': True, 'query': query})
+
+
+class MediaWikiQueryPagesTests(TestCase):
+    @patch("socialauth.api.MediaWiki.request", side_effect=fake_query)
+    def test_query_pages(self, mock_request):
+        titles = ['File:%d.jpg' % i for i in range(1, 121)] + ['File:900.jpg', 'file:f5.jpg']
+        by_title, by_id = MediaWiki(user=None).query_pages(titles=titles, pageids=[7, 8, 901])
+        self.assertEqual(3 + 1, mock_request.call_count)
+        self.assertEqual({'pageid': 42, 'ns': 6, 'title': 'File:42.jpg'}, by_title['File:42.jpg'])
+        self.assertEqual('File:f5.jpg', by_title['file:f5.jpg']['title'])
+        self.assertIsNone(by_title['File:900.jpg'])
+        self.assertEqual('File:7.jpg', by_id[7]['title'])
+        self.assertIsNone(by_id[901])
+
+    @patch("socialauth.api.MediaWiki.request", side_effect=fake_query)
+    def test_resolve_pages(self, mock_request):
+        topic = Topic.objects.create(name='topic', grant=Grant.objects.create(full_name='g', short_name='g', slug='g'))
+        ticket = Ticket.objects.create(name='ticket', topic=topic)
+        media = [MediaInfo(ticket=ticket, page_title='file:%d.jpg' % i) for i in range(1, 61)]
+        media += [MediaInfo(ticket=ticket, page_id=i) for i in range(61, 71)]
+        media.append(MediaInfo(ticket=ticket, page_title='File:999.jpg'))
+        MediaInfo.objects.bulk_create(media)
+        media = list(MediaInfo.objects.order_by('id'))
+
+        MediaInfo.resolve_pages(media, save=True)
+        self.assertEqual(2 + 1, mock_request.call_count)
+        self.assertEqual((1, 'File:1.jpg'), (media[0].page_id, media[0].page_title))
+        self.assertEqual('File:61.jpg', MediaInfo.objects.get(page_id=61).page_title)
+        self.assertEqual(60, MediaInfo.objects.get(page_title='File:60.jpg').page_id)
+        self.assertIsNone(MediaInfo.objects.get(page_title='File:999.jpg').page_id)
+
+
+def fake_media_query(categories):
+    """
+    Answers imageinfo|categories|globalusage queries like MediaWiki would, with given categories of every file.
+    Usages come in a continued response. Files numbered 900 and more don't exist.
+    """
+    def query(payload, *args, **kwargs):
+        if 'prop' not in payload:
+            return fake_query(payload)
+        pages = []
+        for page_id in map(int, payload['pageids'].split('|')):
+            if page_id >= 900:
+                pages.append({'pageid': page_id, 'missing': True})
+                continue
+            page = {'pageid': page_id, 'ns': 6, 'title': 'File:%d.jpg' % page_id}
+            if 'clcontinue' in payload:
+                page['globalusage'] = [{'title': 'Article', 'wiki': 'cs.wikipedia.org', 'url': 'https://cs.wikipedia.org/wiki/Article'}]
+            else:
+                page['imageinfo'] = [{'thumburl': 'https://upload.example/%d.jpg' % page_id, 'url': '', 'width': 200,
+                                      'height': 100, 'canonicaltitle': 'File:%d.jpg' % page_id}]
+                page['categories'] = [{'title': title} for title in categories] + [{'title': 'Category:Hidden', 'hidden': True}]
+            pages.append(page)
+        if 'clcontinue' in payload:
+            return FakeMediaWikiResponse({'batchcomplete': True, 'query': {'pages': pages}})
+        return FakeMediaWikiResponse({'continue': {'clcontinue': '1|x', 'continue': '||'}, 'query': {'pages': pages}})
+    return query
+
+
+class MediaRefreshTests(TestCase):
+    def setUp(self):
+        topic = Topic.objects.create(name='topic', grant=Grant.objects.create(full_name='g', short_name='g', slug='g'))
+        self.ticket = Ticket.objects.create(name='ticket', topic=topic)
+
+    def add_media(self, count):
+        MediaInfo.objects.bulk_create([MediaInfo(ticket=self.ticket, page_id=page_id) for page_id in range(1, count + 1)])
+
+    def test_update_media(self):
+        self.add_media(120)
+        MediaInfo.objects.create(ticket=self.ticket, page_id=901, page_title='File:900.jpg')
+        with patch("socialauth.api.MediaWiki.request", side_effect=fake_media_query(['Category:A', 'Category:B'])) as mock_request:
+            Ticket.update_media.task_function(self.ticket.id)
+        self.assertEqual(3 * 2 + 1, mock_request.call_count)  # two responses per 50 media, one to look up File:900.jpg
+        self.assertFalse(MediaInfo.objects.filter(page_id__in=[900, 901]).exists())
+        media = MediaInfo.objects.get(page_id=7)
+        self.assertEqual(('File:7.jpg', 200, 100), (media.page_title, media.width, media.height))
+        self.assertEqual(['Category:A', 'Category:B'], sorted(media.mediainfocategory_set.values_list('title', flat=True)))
+        self.assertEqual(['Article'], list(media.mediainfousage_set.values_list('title', flat=True)))
+        self.assertEqual(240, MediaInfoCategory.objects.count())
+        self.assertIsNotNone(Ticket.objects.get(id=self.ticket.id).media_updated)
+
+        kept = set(MediaInfoCategory.objects.filter(title='Category:B').values_list('id', flat=True))
+        usages = set(MediaInfoUsage.objects.values_list('id', flat=True))
+        with patch("socialauth.api.MediaWiki.request", side_effect=fake_media_query(['Category:B', 'Category:C'])):
+            Ticket.update_media.task_function(self.ticket.id)
+        self.assertEqual(['Category:B', 'Category:C'], sorted(media.mediainfocategory_set.values_list('title', flat=True)))
+        self.assertEqual(kept, set(MediaInfoCategory.objects.filter(title='Category:B').values_list('id', flat=True)))
+        self.assertEqual(usages, set(MediaInfoUsage.objects.values_list('id', flat=True)))
+
+    def test_refresh_query_count(self):
+        def count_queries():
+            media = list(MediaInfo.objects.all())
+            with CaptureQueriesContext(connection) as queries:
+                with patch("socialauth.api.MediaWiki.request", side_effect=fake_media_query(['Category:A'])):
+                    MediaInfo.refresh_mediawiki_data(media)
+            return len(queries)
+
+        self.add_media(10)
+        few = count_queries()
+        MediaInfo.objects.all().delete()
+        self.add_media(100)  # still fits into one batch of every bulk statement, even on SQLite
+        self.assertEqual(few, count_queries())
+
+
+def api_response(status_code=200, headers=None, content=b'{}'):
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    response._content = content
+    response.url = settings.MEDIAINFO_MEDIAWIKI_API
+    response.request = requests.Request('POST', settings.MEDIAINFO_MEDIAWIKI_API).prepare()
+    return response
+
+
+@patch("socialauth.api.time.sleep")
+@override_settings(MEDIAWIKI_MAX_RETRIES=4, MEDIAWIKI_RETRY_DELAY=1, MEDIAWIKI_MAXLAG=5)
+class MediaWikiClientTests(TestCase):
+    def setUp(self):
+        api.stats.reset()
+
+    def test_sessions_are_shared(self, mock_sleep):
+        self.assertIs(MediaWiki(user=None).session, MediaWiki(user=None).session)
+        self.assertIsNot(MediaWiki(user=None).session, MediaWiki(user=None, api_url='https://example.org/w/api.php').session)
+
+    def test_retry_after(self, mock_sleep):
+        with patch("requests.Session.request", side_effect=[
+            api_response(429, {'Retry-After': '7'}),
+            api_response(200, {'MediaWiki-API-Error': 'maxlag', 'Retry-After': '1'}),
+            api_response(200, content=b'{"query": {}}'),
+        ]) as mock_request:
+            self.assertEqual({'query': {}}, MediaWiki(user=None).request({'action': 'query'}).json())
+        self.assertEqual(3, mock_request.call_count)
+        self.assertEqual('5', str(mock_request.call_args[1]['data']['maxlag']))
+        self.assertEqual([7, 2], [call[0][0] for call in mock_sleep.call_args_list])  # Retry-After, then backoff
+        self.assertEqual({'requests': 3, 'errors': 2, 'retries': 2}, {
+            key: value for key, value in api.stats.as_dict().items() if key in ('requests', 'errors', 'retries')})
+
+    def test_give_up(self, mock_sleep):
+        with patch("requests.Session.request", return_value=api_response(503)) as mock_request:
+            with self.assertRaises(requests.exceptions.HTTPError):
+                MediaWiki(user=None, max_retries=2).request({'action': 'query'})
+        self.assertEqual(3, mock_request.call_count)
+        self.assertEqual([1, 2], [call[0][0] for call in mock_sleep.call_args_list])
+
+    def test_connection_errors(self, mock_sleep):
+        with patch("requests.Session.request", side_effect=[requests.exceptions.ConnectTimeout(), api_response()]) as mock_request:
+            MediaWiki(user=None).request({'action': 'query'})
+        self.assertEqual(2, mock_request.call_count)
+
+        with patch("requests.Session.request", side_effect=requests.exceptions.ReadTimeout()) as mock_request:
+            with self.assertRaises(requests.exceptions.ReadTimeout):
+                MediaWiki(user=None).request({'action': 'edit'})
+        self.assertEqual(1, mock_request.call_count)
+
+
+@override_settings(SOCIAL_AUTH_MEDIAWIKI_KEY='key', SOCIAL_AUTH_MEDIAWIKI_SECRET='secret')
+class InvalidOauthTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='user', password='pw')
+        UserSocialAuth.objects.create(user=self.user, provider='mediawiki', uid='1', extra_data={
+            'access_token': {'oauth_token': 'token', 'oauth_token_secret': 'secret'}})
+        self.client.login(username='user', password='pw')
+
+    def get_tickets(self, content=b'{"query": {"userinfo": {"id": 1}}}', headers=None):
+        with patch("requests.Session.request", return_value=api_response(content=content, headers=headers)) as mock_request:
+            response = self.client.get(reverse('ticket_list'))
+        return response, mock_request.call_count
+
+    def test_token_status_is_cached(self):
+        response, calls = self.get_tickets()
+        self.assertEqual((200, 1), (response.status_code, calls))
+        response, calls = self.get_tickets()
+        self.assertEqual((200, 0), (response.status_code, calls))
+        self.assertTrue(api.get_token_status(self.user.id)['valid'])
+
+    def test_invalid_token(self):
+        invalid = b'{"error": {"code": "mwoauth-invalid-authorization"}}'
+        response, calls = self.get_tickets(invalid, {'MediaWiki-API-Error': 'mwoauth-invalid-authorization'})
+        self.assertEqual((302, 1), (response.status_code, calls))
+        self.assertTrue(response['Location'].startswith(reverse('invalid_oauth_tokens', kwargs={'provider': 'mediawiki'})))
+        response, calls = self.get_tickets()
+        self.assertEqual((302, 0), (response.status_code, calls))
+
+        # reconnecting the account forgets the status
+        UserSocialAuth.objects.get(user=self.user).save()
+        response, calls = self.get_tickets()
+        self.assertEqual((200, 1), (response.status_code, calls))
+
+    def test_failed_call_forgets_status(self):
+        self.get_tickets()
+        with patch("requests.Session.request", return_value=api_response(
+                content=b'{"error": {"code": "mwoauth-invalid-authorization"}}',
+                headers={'MediaWiki-API-Error': 'mwoauth-invalid-authorization'})):
+            MediaWiki(self.user).request({'action': 'query'})
+        self.assertIsNone(api.get_token_status(self.user.id))
+
+    def test_revalidation_in_background(self):
+        self.get_tickets()
+        cache.set(api.TOKEN_STATUS_KEY % self.user.id, {'valid': True, 'checked': 0})
+        for i in range(2):
+            response, calls = self.get_tickets()
+            self.assertEqual((200, 0), (response.status_code, calls))
+        self.assertEqual(1, Task.objects.filter(task_name='tracker.models.revalidate_mediawiki_token').count())
+
+        with patch("requests.Session.request", return_value=api_response(content=b'{"query": {}}')) as mock_request:
+            TrackerProfile.revalidate_mediawiki_token.task_function(self.user.id)
+        self.assertEqual(1, mock_request.call_count)
+        self.assertNotEqual(0, api.get_token_status(self.user.id)['checked'])
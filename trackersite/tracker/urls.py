@@ -1,9 +1,7 @@
 # -*- coding: utf-8 -*-
 from django.urls import include, path
-from django.views.generic import DetailView
 
 import tracker.views
-from tracker.models import Grant
 
 urlpatterns = [
     path('tickets/', tracker.views.ticket_list, name='ticket_list'),
@@ -28,12 +26,13 @@ urlpatterns = [
     path('topics/finance/', tracker.views.topic_finance, name='topic_finance'),
     path('topics/acks/', tracker.views.topic_content_acks_per_user, name='topic_content_acks_per_user'),
     path('topics/acks/acks.csv', tracker.views.topic_content_acks_per_user_csv, name='topic_content_acks_per_user_csv'),
+    path('topics/ready/', tracker.views.topic_ready_tickets, name='topic_ready_tickets'),
     path('topic/<int:pk>/', tracker.views.topic_detail, name='topic_detail'),
     path('subtopic/<int:pk>/', tracker.views.subtopic_detail, name='subtopic_detail'),
     path('topic/watch/<int:pk>/', tracker.views.watch_topic, name='watch_topic'),
     path('grants/', tracker.views.grant_list, name='grant_list'),
     path('grant/watch/<int:pk>/', tracker.views.watch_grant, name='watch_grant'),
-    path('grant/<slug:slug>/', DetailView.as_view(model=Grant), name='grant_detail'),
+    path('grant/<slug:slug>/', tracker.views.grant_detail, name='grant_detail'),
     path('users/<str:username>/', tracker.views.user_detail, name='user_detail'),
     path('users/', tracker.views.user_list, name='user_list'),
     path('my/details/', tracker.views.user_details_change, name='user_details_change'),
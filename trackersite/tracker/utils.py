@@ -1,7 +1,13 @@
+import hashlib
+import json
 import traceback
 
+from background_task.models import Task
+from django.conf import settings
 from django.contrib.sites.models import Site
 from django.core.mail import mail_managers
+from django.db import connection, transaction, DatabaseError
+from django.db.models import Max
 from django.template import loader
 from django.urls import reverse
 from django.utils.html import strip_tags
@@ -20,3 +26,45 @@ def notify_on_failure(**kwargs):
     plain_text_content = strip_tags(html_content)
     mail_managers("Error in background task {}".format(kwargs.get("task")), plain_text_content,
                   html_message=html_content)
+
+
+def bulk_create_with_ids(model, objects):
+    """
+    Like model.objects.bulk_create, but makes sure the objects get their primary keys even on databases which can't
+    return them from a bulk insert (MySQL, SQLite). Must be called in a transaction.
+    """
+    if connection.features.can_return_rows_from_bulk_insert:
+        return model.objects.bulk_create(objects)
+    last_pk = model.objects.aggregate(last_pk=Max('pk'))['last_pk'] or 0
+    model.objects.bulk_create(objects)
+    # Rows inserted by this transaction are visible to it in insertion order; rows of other transactions are only
+    # visible if they were committed meanwhile, which the count check detects.
+    pks = list(model.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True))
+    if len(pks) != len(objects):
+        raise DatabaseError('Could not determine primary keys of inserted %s objects' % model.__name__)
+    for obj, pk in zip(objects, pks):
+        obj.pk = pk
+    return objects
+
+
+def schedule_ticket_job(task, ticket_id, *args):
+    """
+    Schedule task (a function decorated with @background, taking ticket id and args) to run for the ticket
+    TRACKER_JOB_DELAY_SECONDS later. A job of the task for the ticket which is still waiting keeps its time and takes
+    the latest args, so that a burst of changes of a ticket ends up as a single job, run at most that long after the
+    first of them.
+    """
+    key = '%s:%s' % (task.name, ticket_id)
+    # same as background_task computes for new tasks
+    task_params = json.dumps(((ticket_id, ) + args, {}), sort_keys=True)
+    task_hash = hashlib.sha1(('%s%s' % (task.name, task_params)).encode('utf-8')).hexdigest()
+    with transaction.atomic():
+        # locked, so that a worker can't start the job before it gets the new args
+        waiting = list(Task.objects.select_for_update().filter(
+            task_name=task.name, verbose_name=key, locked_by=None, failed_at=None).order_by('id').values_list('id', flat=True))
+        if not waiting:
+            task(ticket_id, *args, schedule=settings.TRACKER_JOB_DELAY_SECONDS, verbose_name=key)
+            return
+        Task.objects.filter(id=waiting[0]).update(task_params=task_params, task_hash=task_hash)
+        # jobs queued by concurrent first calls
+        Task.objects.filter(id__in=waiting[1:]).delete()
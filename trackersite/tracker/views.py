@@ -1,10 +1,10 @@
 # -*- coding: utf-8 -*-
-import csv
 import datetime
 import json
 import logging
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from functools import partial
+from itertools import chain
 from io import TextIOWrapper
 
 from django import forms
@@ -17,17 +17,18 @@ from django.contrib.auth.views import redirect_to_login
 from django.core.exceptions import PermissionDenied
 from django.core.mail import mail_admins
 from django.db import models, connection
-from django.db.models import Q
+from django.db.models import Q, OuterRef, Subquery
 from django.db.models.functions import Coalesce
 from django.forms.models import fields_for_model, inlineformset_factory, BaseInlineFormSet
 from django.http import HttpResponse, HttpResponseRedirect, HttpResponseBadRequest, Http404
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
 from django.shortcuts import render, get_object_or_404
 from django.template import Context
 from django.template.loader import get_template
 from django.urls import reverse
 from django.utils.html import strip_tags
 from django.utils.safestring import mark_safe
+from django.utils import translation
 from django.utils.translation import get_language
 from django.utils.translation import ugettext as _, ugettext_lazy
 from django.views.decorators.cache import never_cache
@@ -36,17 +37,19 @@ from django.views.generic import ListView, DetailView, FormView, DeleteView
 from django_sendfile import sendfile
 
 from socialauth.api import MediaWiki
-from tracker.models import ACK_TYPES, NOTIFICATION_TYPES
+from tracker.models import ACK_TYPES, NOTIFICATION_TYPES, TICKET_STATES
 from tracker.models import Ticket, Topic, Subtopic, Grant, FinanceStatus, MediaInfo, MediaInfoOld, Expediture, \
     Preexpediture, Cluster, TrackerPreferences, TrackerProfile, Document, TicketAck, PossibleAck, Watcher, \
-    Signature
+    Signature, TicketSummary
+from tracker.csvimport import IMPORTERS
 from tracker.services import get_request
+from tracker.utils import schedule_ticket_job
 from users.models import UserWrapper
 
 TICKET_EXCLUDE_FIELDS = (
     'created', 'media_updated', 'updated', 'requested_user', 'requested_text',
     'custom_state', 'rating_percentage', 'supervisor_notes', 'cluster', 'payment_status',
-    'mandatory_report', 'imported', 'enable_comments', 'statutory_declaration_date', 'is_completed'
+    'mandatory_report', 'imported', 'enable_comments', 'statutory_declaration_date', 'is_completed', 'state'
 )
 
 
@@ -62,8 +65,98 @@ def ticket_list(request, page=1):
     return response
 
 
+TICKETS_JSON_MAX_LENGTH = 500
+
+# DataTables column index -> (ordering fields, column filter lookup), matches the columns in index.html
+TICKETS_JSON_COLUMNS = (
+    (('ticket_id', ), 'ticket_id'),
+    (('ticket__event_date', ), 'ticket__event_date__startswith'),
+    (('ticket__name', ), 'ticket__name__icontains'),
+    (('grant_name', ), 'grant_name__icontains'),
+    (('topic_name', ), 'topic_name__icontains'),
+    (('subtopic_name', ), 'subtopic_name__icontains'),
+    (('requested_by', ), 'requested_by__icontains'),
+    (('preexpeditures_amount', ), None),
+    (('expeditures_amount', ), None),
+    (('accepted_expeditures', ), None),
+    (('paid_expeditures', ), None),
+    (('state', ), 'state__in'),
+    (('ticket__updated', ), None),
+)
+
+
+def _filter_tickets_json_queryset(queryset, params):
+    search = params.get('search[value]', '').strip()
+    if search:
+        condition = Q(ticket__name__icontains=search) | Q(topic_name__icontains=search) | \
+            Q(grant_name__icontains=search) | Q(subtopic_name__icontains=search) | Q(requested_by__icontains=search)
+        if search.isdigit():
+            condition |= Q(ticket_id=int(search))
+        queryset = queryset.filter(condition)
+
+    for index, (order_fields, lookup) in enumerate(TICKETS_JSON_COLUMNS):
+        value = params.get('columns[%d][search][value]' % index, '').strip()
+        if not value or lookup is None:
+            continue
+        if lookup == 'ticket_id':
+            if not value.isdigit():
+                return queryset.none()
+            value = int(value)
+        elif lookup == 'state__in':
+            value = [code for code, label in TICKET_STATES if value.lower() in str(label).lower()]
+        queryset = queryset.filter(**{lookup: value})
+    return queryset
+
+
+def _order_tickets_json_queryset(queryset, params):
+    ordering = []
+    index = 0
+    while 'order[%d][column]' % index in params:
+        try:
+            column = int(params['order[%d][column]' % index])
+            order_fields = TICKETS_JSON_COLUMNS[column][0]
+        except (ValueError, IndexError):
+            return None
+        prefix = '-' if params.get('order[%d][dir]' % index) == 'desc' else ''
+        ordering += [prefix + field for field in order_fields]
+        index += 1
+    return queryset.order_by(*(ordering + ['-ticket_id']))
+
+
 def tickets_json(request, lang):
-    return JsonResponse({"data": [ticket.get_cached_ticket() for ticket in Ticket.objects.order_by('-id')]})
+    """
+    DataTables server-side processing endpoint for the ticket list.
+
+    Only the requested page is rendered; searching, per-column filtering and
+    sorting happen in SQL over TicketSummary, so the response does not grow
+    with the ticket table.
+    """
+    params = request.GET
+    try:
+        draw = int(params.get('draw', 0))
+        start = max(int(params.get('start', 0)), 0)
+        length = int(params.get('length', 25))
+    except ValueError:
+        return HttpResponseBadRequest('Invalid paging parameters')
+    if length < 1 or length > TICKETS_JSON_MAX_LENGTH:
+        length = TICKETS_JSON_MAX_LENGTH
+
+    queryset = TicketSummary.objects.select_related('ticket')
+    queryset = _order_tickets_json_queryset(_filter_tickets_json_queryset(queryset, params), params)
+    if queryset is None:
+        return HttpResponseBadRequest('Invalid ordering parameters')
+
+    if lang not in dict(settings.LANGUAGES):
+        lang = get_language()
+    with translation.override(lang):
+        data = [summary.as_row() for summary in queryset[start:start + length]]
+
+    return JsonResponse({
+        "draw": draw,
+        "recordsTotal": TicketSummary.objects.count(),
+        "recordsFiltered": queryset.count(),
+        "data": data,
+    })
 
 
 class CommentPostedCatcher(object):
@@ -186,16 +279,19 @@ ticket_ack_delete = TicketAckDeleteView.as_view()
 
 
 def grant_list(request):
+    grants = Grant.prefetch_finance(Grant.objects.annotate(
+        open_topics=models.Count('topic', filter=Q(topic__open_for_tickets=True))))
     return render(request, 'tracker/grant_list.html', {
-        'open_grants': [g for g in Grant.objects.all() if g.open_for_tickets()],
-        'closed_grants': [g for g in Grant.objects.all() if not g.open_for_tickets()],
+        'open_grants': [g for g in grants if g.open_topics],
+        'closed_grants': [g for g in grants if not g.open_topics],
     })
 
 
 def topic_list(request):
+    topics = Topic.prefetch_finance(Topic.objects.select_related('grant').prefetch_related('admin'))
     return render(request, 'tracker/topic_list.html', {
-        'open_topics': Topic.objects.filter(open_for_tickets=True),
-        'closed_topics': Topic.objects.filter(open_for_tickets=False),
+        'open_topics': [t for t in topics if t.open_for_tickets],
+        'closed_topics': [t for t in topics if not t.open_for_tickets],
     })
 
 
@@ -205,6 +301,7 @@ class TopicDetailView(CommentPostedCatcher, DetailView):
     def get_context_data(self, **kwargs):
         context = super(TopicDetailView, self).get_context_data(**kwargs)
         context['user_admin_of_topic'] = self.request.user in self.object.admin.all()
+        context['ticket_list'] = Ticket.prefetch_cache(self.object.ticket_set.for_listing(), Ticket.listing_cached_getters)
         context["container_name"] = "container-fluid"
         return context
 
@@ -212,11 +309,24 @@ class TopicDetailView(CommentPostedCatcher, DetailView):
 topic_detail = TopicDetailView.as_view()
 
 
+class GrantDetailView(DetailView):
+    model = Grant
+
+    def get_context_data(self, **kwargs):
+        context = super(GrantDetailView, self).get_context_data(**kwargs)
+        context['topic_list'] = Topic.prefetch_finance(self.object.topic_set.prefetch_related('admin'))
+        return context
+
+
+grant_detail = GrantDetailView.as_view()
+
+
 class SubtopicDetailView(CommentPostedCatcher, DetailView):
     model = Subtopic
 
     def get_context_data(self, **kwargs):
         context = super(SubtopicDetailView, self).get_context_data(**kwargs)
+        context['ticket_list'] = Ticket.prefetch_cache(self.object.ticket_set.for_listing(), Ticket.listing_cached_getters)
         context["container_name"] = "container-fluid"
         return context
 
@@ -933,13 +1043,15 @@ def download_document(request, ticket_id, filename):
 
 def topic_finance(request):
     grants_out = []
-    for grant in Grant.objects.all():
+    grants = Grant.objects.prefetch_related('topic_set')
+    Topic.prefetch_finance(topic for grant in grants for topic in grant.topic_set.all())
+    for grant in grants:
         topics = []
         grant_finance = FinanceStatus()
         for topic in grant.topic_set.all():
-            topic_finance = topic.payment_summary()
+            topic_finance = topic.finance().status
             grant_finance.add_finance(topic_finance)
-            topics.append({'topic': topic, 'finance': topic_finance})
+            topics.append({'topic': topic, 'finance': topic_finance, 'tickets': topic.finance().tickets})
         grants_out.append({'grant': grant, 'topics': topics, 'finance': grant_finance, 'rows': len(topics) + 1})
 
     return render(request, 'tracker/topic_finance.html', {
@@ -948,6 +1060,10 @@ def topic_finance(request):
     })
 
 
+def csv_line(row):
+    return u';'.join(map(lambda s: u'"' + str(s).replace('"', "'").replace('\r\n', ' ').replace('\n', ' ').replace('\r', ' ') + u'"', row)) + u'\r\n'
+
+
 class HttpResponseCsv(HttpResponse):
     def __init__(self, fields, *args, **kwargs):
         kwargs['content_type'] = 'text/csv'
@@ -955,8 +1071,15 @@ class HttpResponseCsv(HttpResponse):
         self.writerow(fields)
 
     def writerow(self, row):
-        self.write(u';'.join(map(lambda s: u'"' + str(s).replace('"', "'").replace('\r\n', ' ').replace('\n', ' ').replace('\r', ' ') + u'"', row)))
-        self.write(u'\r\n')
+        self.write(csv_line(row))
+
+
+class StreamingHttpResponseCsv(StreamingHttpResponse):
+    """ CSV response rendered line by line from an iterable of rows, as the client downloads it """
+    def __init__(self, fields, rows, filename=None):
+        super(StreamingHttpResponseCsv, self).__init__((csv_line(row) for row in chain([fields], rows)), content_type='text/csv')
+        if filename is not None:
+            self['Content-Disposition'] = 'attachment; filename="%s"' % filename
 
 
 def _get_topic_content_acks_per_user():
@@ -1000,11 +1123,27 @@ def topic_content_acks_per_user_csv(request):
     return response
 
 
+@login_required
+def topic_ready_tickets(request):
+    topics = OrderedDict(
+        (topic.id, {'topic': topic, 'precontent': [], 'content': []})
+        for topic in request.user.topic_set.select_related('grant').order_by('grant__full_name', 'name')
+    )
+    for ack in ('precontent', 'content'):
+        for ticket in Ticket.objects.filter(topic_id__in=topics.keys()).ready_for(ack).select_related('requested_user').order_by('id'):
+            topics[ticket.topic_id][ack].append(ticket)
+
+    return render(request, 'tracker/topic_ready_tickets.html', {
+        'topics': [row for row in topics.values() if row['precontent'] or row['content']],
+        'TRACKER_MIN_WAIT_DAYS': settings.TRACKER_MIN_WAIT_DAYS,
+    })
+
+
 def user_list(request):
     totals = {
         'ticket_count': Ticket.objects.count(),
         'media_count': MediaInfoOld.objects.aggregate(media=Coalesce(models.Sum('count'), 0))['media'] + MediaInfo.objects.aggregate(objects=models.Count('id'))['objects'],
-        'accepted_expeditures': sum([t.accepted_expeditures() for t in Ticket.objects.filter(rating_percentage__gt=0)]),
+        'accepted_expeditures': TicketSummary.objects.aggregate(amount=models.Sum('accepted_expeditures'))['amount'],
         'transactions': Expediture.objects.filter(paid=True).aggregate(amount=models.Sum('amount'))['amount'],
     }
 
@@ -1014,7 +1153,7 @@ def user_list(request):
         unassigned = {
             'ticket_count': userless.count(),
             'media': MediaInfoOld.objects.extra(where=['ticket_id in (select id from tracker_ticket where requested_user_id is null)']).aggregate(objects=models.Count('id'), media=models.Sum('count')),
-            'accepted_expeditures': sum([t.accepted_expeditures() for t in userless]),
+            'accepted_expeditures': TicketSummary.objects.filter(ticket__requested_user=None).aggregate(amount=models.Sum('accepted_expeditures'))['amount'],
         }
     else:
         unassigned = None
@@ -1032,7 +1171,7 @@ def user_detail(request, username):
     return render(request, 'tracker/user_detail.html', {
         'user_obj': user,
         # ^ NOTE 'user' means session user in the template, so we're using user_obj
-        'ticket_list': user.ticket_set.all(),
+        'ticket_list': Ticket.prefetch_cache(user.ticket_set.for_listing(), Ticket.listing_cached_getters),
     })
 
 
@@ -1092,6 +1231,7 @@ def cluster_detail(request, pk):
 
     return render(request, 'tracker/cluster_detail.html', {
         'cluster': cluster,
+        'ticket_list': Ticket.prefetch_cache(cluster.ticket_set.for_listing(), Ticket.listing_cached_getters),
         'ticket_summary': {'accepted_expeditures': cluster.total_tickets},
     })
 
@@ -1109,412 +1249,149 @@ class AdminUserListView(ListView):
 admin_user_list = login_required(AdminUserListView.as_view())
 
 
+EXPORT_CHUNK_SIZE = 500
+
+
+def _filter_range(queryset, field, post, prefix):
+    """ Filter queryset by `field` being within the bounds entered into `<prefix>-larger` and `<prefix>-smaller` """
+    larger = post.get('%s-larger' % prefix, '')
+    smaller = post.get('%s-smaller' % prefix, '')
+    if larger != '':
+        queryset = queryset.filter(**{'%s__gte' % field: int(larger)})
+    if smaller != '':
+        queryset = queryset.filter(**{'%s__lte' % field: int(smaller)})
+    return queryset
+
+
+def _checked_ids(post, prefix):
+    return [int(post[item]) for item in post if item.startswith(prefix)]
+
+
+def _export_tickets(request):
+    post = request.POST
+    # amounts are filtered and read from summaries, which are only a cache and may be missing
+    TicketSummary.rebuild(ticket_ids=Ticket.objects.filter(summary=None).values_list('id', flat=True))
+    tickets = Ticket.objects.select_related('summary', 'topic__grant', 'subtopic').order_by('id')
+    # checkbox names in the export form are the state codes
+    states = [state for state, label in TICKET_STATES if state in post]
+    if states:
+        tickets = tickets.filter(state__in=states)
+    topics = _checked_ids(post, 'ticket-topic-')
+    if topics:
+        tickets = tickets.filter(topic_id__in=topics)
+    users = _checked_ids(post, 'ticket-user-')
+    if users:
+        tickets = tickets.filter(requested_user_id__in=users)
+    tickets = _filter_range(tickets, 'summary__preexpeditures_amount', post, 'preexpeditures')
+    tickets = _filter_range(tickets, 'summary__expeditures_amount', post, 'expeditures')
+    tickets = _filter_range(tickets, 'summary__accepted_expeditures', post, 'acceptedexpeditures')
+    if 'ticket-report-mandatory' in post:
+        tickets = tickets.filter(mandatory_report=True)
+
+    rows = ([
+        ticket.id, ticket.created, ticket.updated, ticket.event_date, ticket.event_url, ticket.name,
+        ticket.summary.requested_by, ticket.topic.grant.full_name, ticket.topic.name, str(ticket.subtopic),
+        ticket.get_state_display(), ticket.deposit, ticket.description, ticket.mandatory_report,
+        ticket.summary.accepted_expeditures, ticket.summary.preexpeditures_amount, ticket.summary.expeditures_amount,
+        ticket.summary.paid_expeditures,
+    ] for ticket in tickets.iterator(chunk_size=EXPORT_CHUNK_SIZE))
+    return StreamingHttpResponseCsv(['id', 'created', 'updated', 'event_date', 'event_url', 'name', 'requested_by', 'grant', 'topic', 'subtopic', 'state', 'deposit', 'description', 'mandatory_report', 'accepted_expeditures', 'preexpeditures', 'expeditures', 'paid_expeditures'], rows, 'exported-tickets.csv')
+
+
+def _export_grants(request):
+    rows = ([grant.full_name, grant.short_name, grant.slug, grant.description] for grant in Grant.objects.order_by('id').iterator(chunk_size=EXPORT_CHUNK_SIZE))
+    return StreamingHttpResponseCsv(['full_name', 'short_name', 'slug', 'description'], rows)
+
+
+def _export_preexpeditures(request):
+    preexpeditures = Preexpediture.objects.filter(wage='preexpediture-wage' in request.POST).order_by('id')
+    preexpeditures = _filter_range(preexpeditures, 'amount', request.POST, 'preexpediture-amount')
+    rows = ([preexpediture.ticket_id, preexpediture.description, preexpediture.amount, preexpediture.wage] for preexpediture in preexpeditures.iterator(chunk_size=EXPORT_CHUNK_SIZE))
+    return StreamingHttpResponseCsv(['ticket_id', 'description', 'amount', 'wage'], rows, 'exported-preexpeditures.csv')
+
+
+def _export_expeditures(request):
+    expeditures = Expediture.objects.filter(wage='expediture-wage' in request.POST, paid='expediture-paid' in request.POST).order_by('id')
+    expeditures = _filter_range(expeditures, 'amount', request.POST, 'expediture-amount')
+    rows = ([expediture.ticket_id, expediture.description, expediture.amount, expediture.wage, expediture.paid] for expediture in expeditures.iterator(chunk_size=EXPORT_CHUNK_SIZE))
+    return StreamingHttpResponseCsv(['ticket_id', 'description', 'amount', 'wage', 'paid'], rows, 'exported-expeditures.csv')
+
+
+def _export_topics(request):
+    post = request.POST
+    topics = Topic.objects.select_related('grant').prefetch_related('admin').order_by('id')
+    users = _checked_ids(post, 'topics-user-')
+    if users:
+        topics = topics.filter(id__in=Topic.admin.through.objects.filter(user_id__in=users).values('topic_id'))
+    topics = _filter_range(topics.annotate(ticket_count=models.Count('ticket')), 'ticket_count', post, 'topics-tickets')
+    if post.get('topics-paymentstate', 'default') != 'default':
+        topics = topics.annotate(payment_status_count=models.Count('ticket', filter=Q(ticket__payment_status=post['topics-paymentstate'])))
+        topics = _filter_range(topics, 'payment_status_count', post, 'topics-paymentstate')
+
+    # topics are few, and iterator() would skip prefetching the admins
+    rows = ([
+        topic.name, topic.grant.full_name, topic.open_for_tickets, topic.ticket_media, topic.ticket_expenses,
+        topic.ticket_preexpenses, topic.description, topic.form_description,
+        ", ".join(admin.username for admin in topic.admin.all()),
+    ] for topic in topics)
+    return StreamingHttpResponseCsv(['name', 'grant', 'open_for_new_tickets', 'media', 'expenses', 'preexpenses', 'description', 'form_description', 'admins'], rows, 'exported-topics.csv')
+
+
+def _export_users(request):
+    if not request.user.is_authenticated or not request.user.is_staff:
+        raise PermissionDenied(_('You must be staffer in order to export users'))
+
+    post = request.POST
+    amount_field = models.DecimalField(max_digits=12, decimal_places=2)
+    paid = Expediture.objects.filter(ticket__requested_user=OuterRef('user'), paid=True).order_by().values(
+        'ticket__requested_user').annotate(total=models.Sum('amount')).values('total')
+    users = TrackerProfile.objects.select_related('user').order_by('user_id').annotate(
+        created_tickets=models.Count('user__ticket'),
+        accepted=Coalesce(models.Sum('user__ticket__summary__accepted_expeditures'), 0, output_field=amount_field),
+        paid=Coalesce(Subquery(paid, output_field=amount_field), 0, output_field=amount_field),
+    )
+    users = _filter_range(users, 'created_tickets', post, 'users-created')
+    users = _filter_range(users, 'accepted', post, 'users-accepted')
+    users = _filter_range(users, 'paid', post, 'users-paid')
+
+    if 'user-permision' in post:
+        priv = post['user-permision']
+        if priv == 'normal':
+            users = users.filter(user__is_staff=False, user__is_superuser=False)
+        elif priv == 'staff':
+            users = users.filter(user__is_staff=True)
+        elif priv == 'superuser':
+            users = users.filter(user__is_superuser=True)
+        else:
+            return HttpResponseBadRequest('You must fill the form validly')
+
+    rows = ([
+        profile.user.id, profile.user.username, profile.user.first_name, profile.user.last_name, profile.user.email,
+        profile.user.is_active, profile.user.is_staff, profile.user.is_superuser, profile.user.last_login,
+        profile.user.date_joined, profile.created_tickets, profile.accepted, profile.paid, profile.bank_account,
+        profile.other_contact, profile.other_identification,
+    ] for profile in users.iterator(chunk_size=EXPORT_CHUNK_SIZE))
+    return StreamingHttpResponseCsv(['id', 'username', 'first_name', 'last_name', 'email', 'is_active', 'is_staff', 'is_superuser', 'last_login', 'date_joined', 'created_tickets', 'accepted_expeditures', 'paid_expeditures', 'bank_account', 'other_contact', 'other_identification'], rows, 'exported-users.csv')
+
+
+EXPORTERS = {
+    'ticket': _export_tickets,
+    'grant': _export_grants,
+    'preexpediture': _export_preexpeditures,
+    'expediture': _export_expeditures,
+    'topic': _export_topics,
+    'user': _export_users,
+}
+
+
 def export(request):
     if request.method == 'POST':
-        typ = request.POST['type']
-        if typ == 'ticket':
-            states = ['draft', 'wfpreapproval', 'wfsubmiting', 'wfapproval', 'wfdocssub', 'wffill', 'complete', 'archived', 'closed', 'custom']
-            tickets = []
-            for state in states:
-                if state in request.POST:
-                    tickets += Ticket.get_tickets_with_state(request.POST[state])
-            if len(tickets) == 0:
-                tickets = list(Ticket.objects.all())
-            tickets = list(set(tickets))
-            topics = []
-            for item in request.POST:
-                if item.startswith('ticket-topic-'):
-                    topics.append(Topic.objects.get(id=int(request.POST[item])))
-            tmp = []
-            if len(topics) != 0:
-                for topic in topics:
-                    for ticket in tickets:
-                        if ticket.topic == topic:
-                            tmp.append(ticket)
-                tickets = tmp
-                tmp = []
-            users = []
-            for item in request.POST:
-                if item.startswith('ticket-user-'):
-                    users.append(User.objects.get(id=int(request.POST[item])))
-            if len(users) != 0:
-                for user in users:
-                    for ticket in tickets:
-                        if ticket.requested_user == user:
-                            tmp.append(ticket)
-                    tickets = tmp
-                    tmp = []
-            larger = request.POST['preexpeditures-larger']
-            smaller = request.POST['preexpeditures-smaller']
-            if larger != '' and smaller != '':
-                larger = int(larger)
-                smaller = int(smaller)
-                for ticket in tickets:
-                    real = ticket.preexpeditures()['amount']
-                    if real is None:
-                        real = 0
-                    if real >= larger and real <= smaller:
-                        tmp.append(ticket)
-                tickets = tmp
-                tmp = []
-            elif larger != '' and smaller == '':
-                larger = int(larger)
-                for ticket in tickets:
-                    real = ticket.preexpeditures()['amount']
-                    if real is None:
-                        real = 0
-                    if real >= larger:
-                        tmp.append(ticket)
-                tickets = tmp
-                tmp = []
-            elif larger == '' and smaller != '':
-                smaller = int(smaller)
-                for ticket in tickets:
-                    real = ticket.preexpeditures()['amount']
-                    if real is None:
-                        real = 0
-                    if real <= smaller:
-                        tmp.append(ticket)
-                tickets = tmp
-                tmp = []
-            larger = request.POST['expeditures-larger']
-            smaller = request.POST['expeditures-smaller']
-            if larger != '' and smaller != '':
-                larger = int(larger)
-                smaller = int(smaller)
-                for ticket in tickets:
-                    real = ticket.expeditures()['amount']
-                    if real is None:
-                        real = 0
-                    if real >= larger and real <= smaller:
-                        tmp.append(ticket)
-                tickets = tmp
-                tmp = []
-            elif larger != '' and smaller == '':
-                larger = int(larger)
-                for ticket in tickets:
-                    real = ticket.expeditures()['amount']
-                    if real is None:
-                        real = 0
-                    if real >= larger:
-                        tmp.append(ticket)
-                tickets = tmp
-                tmp = []
-            elif larger == '' and smaller != '':
-                smaller = int(smaller)
-                for ticket in tickets:
-                    real = ticket.expeditures()['amount']
-                    if real is None:
-                        real = 0
-                    if real <= smaller:
-                        tmp.append(ticket)
-                tickets = tmp
-                tmp = []
-            larger = request.POST['acceptedexpeditures-larger']
-            smaller = request.POST['acceptedexpeditures-smaller']
-            if larger != '' and smaller != '':
-                larger = int(larger)
-                smaller = int(smaller)
-                for ticket in tickets:
-                    real = ticket.accepted_expeditures()
-                    if real >= larger and real <= smaller:
-                        tmp.append(ticket)
-                tickets = tmp
-                tmp = []
-            elif larger != '' and smaller == '':
-                larger = int(larger)
-                for ticket in tickets:
-                    real = ticket.accepted_expeditures()
-                    if real >= larger:
-                        tmp.append(ticket)
-                tickets = tmp
-                tmp = []
-            elif larger == '' and smaller != '':
-                smaller = int(smaller)
-                for ticket in tickets:
-                    real = ticket.accepted_expeditures()
-                    if real <= smaller:
-                        tmp.append(ticket)
-                tickets = tmp
-                tmp = []
-            mandatory_report = 'ticket-report-mandatory' in request.POST
-            if mandatory_report:
-                tmp = []
-                for ticket in tickets:
-                    if ticket.mandatory_report:
-                        tmp.append(ticket)
-                tickets = tmp
-                del(tmp)
-            response = HttpResponseCsv(['id', 'created', 'updated', 'event_date', 'event_url', 'name', 'requested_by', 'grant', 'topic', 'subtopic', 'state', 'deposit', 'description', 'mandatory_report', 'accepted_expeditures', 'preexpeditures', 'expeditures', 'paid_expeditures'])
-            response['Content-Disposition'] = 'attachment; filename="exported-tickets.csv"'
-            for ticket in tickets:
-                response.writerow([ticket.id, ticket.created, ticket.updated, ticket.event_date, ticket.event_url, ticket.name, ticket.requested_by(), ticket.topic.grant.full_name, ticket.topic.name, str(ticket.subtopic), ticket.state_str(), ticket.deposit, ticket.description, ticket.mandatory_report, ticket.accepted_expeditures(), ticket.preexpeditures()['amount'], ticket.expeditures()['amount'], ticket.paid_expeditures()])
-            return response
-        elif typ == 'grant':
-            response = HttpResponseCsv(['full_name', 'short_name', 'slug', 'description'])
-            grants = Grant.objects.all()
-            for grant in grants:
-                response.writerow([grant.full_name, grant.short_name, grant.slug, grant.description])
-            return response
-        elif typ == 'preexpediture':
-            larger = request.POST['preexpediture-amount-larger']
-            smaller = request.POST['preexpediture-amount-larger']
-            wage = 'preexpediture-wage' in request.POST
-            if larger != '' and smaller != '':
-                larger = int(larger)
-                smaller = int(smaller)
-                preexpeditures = Preexpediture.objects.filter(amount__gte=larger, amount__lte=smaller, wage=wage)
-            elif larger != '' and smaller == '':
-                larger = int(larger)
-                preexpeditures = Preexpediture.objects.filter(amount__gte=larger, wage=wage)
-            elif larger == '' and smaller != '':
-                smaller = int(smaller)
-                preexpeditures = Preexpediture.objects.filter(amount__lte=smaller, wage=wage)
-            else:
-                preexpeditures = Preexpediture.objects.filter(wage=wage)
-            response = HttpResponseCsv(['ticket_id', 'description', 'amount', 'wage'])
-            response['Content-Disposition'] = 'attachment; filename="exported-preexpeditures.csv"'
-            for preexpediture in preexpeditures:
-                response.writerow([preexpediture.ticket_id, preexpediture.description, preexpediture.amount, preexpediture.wage])
-            return response
-        elif typ == 'expediture':
-            larger = request.POST['expediture-amount-larger']
-            smaller = request.POST['expediture-amount-smaller']
-            wage = 'expediture-wage' in request.POST
-            paid = 'expediture-paid' in request.POST
-            if larger != '' and smaller != '':
-                larger = int(larger)
-                smaller = int(smaller)
-                expeditures = Expediture.objects.filter(amount__gte=larger, amount__lte=smaller, wage=wage, paid=paid)
-            elif larger != '' and smaller == '':
-                larger = int(larger)
-                expeditures = Expediture.objects.filter(amount__gte=larger, wage=wage, paid=paid)
-            elif larger == '' and smaller != '':
-                smaller = int(smaller)
-                expeditures = Expediture.objects.filter(amount__lte=smaller, wage=wage, paid=paid)
-            else:
-                expeditures = Expediture.objects.filter(wage=wage, paid=paid)
-            response = HttpResponseCsv(['ticket_id', 'description', 'amount', 'wage', 'paid'])
-            response['Content-Disposition'] = 'attachment; filename="exported-expeditures.csv"'
-            for expediture in expeditures:
-                response.writerow([expediture.ticket_id, expediture.description, expediture.amount, expediture.wage, expediture.paid])
-            return response
-        elif typ == 'topic':
-            users = []
-            for item in request.POST:
-                if item.startswith('topics-user-'):
-                    users.append(User.objects.get(id=int(request.POST[item])))
-            topics = Topic.objects.all()
-            if len(users) != 0:
-                tmp = []
-                for user in users:
-                    for topic in topics:
-                        if user in topic.admin.all():
-                            tmp.append(topic)
-                topics = list(set(tmp))
-                tmp = []
-            larger = request.POST['topics-tickets-larger']
-            smaller = request.POST['topics-tickets-smaller']
-            if larger != '' and smaller != '':
-                larger = int(larger)
-                smaller = int(smaller)
-                tmp = []
-                for topic in topics:
-                    if topic.ticket_set.count >= larger and topic.ticket_set.count <= smaller:
-                        tmp.append(topic)
-                topics = tmp
-                tmp = []
-            elif larger != '' and smaller == '':
-                larger = int(larger)
-                tmp = []
-                for topic in topics:
-                    if topic.ticket_set.count >= larger:
-                        tmp.append(topic)
-                topics = tmp
-                tmp = []
-            elif larger == '' and smaller != '':
-                smaller = int(smaller)
-                tmp = []
-                for topic in topics:
-                    if topic.ticket_set.count <= smaller:
-                        tmp.append(topic)
-                topics = tmp
-                tmp = []
-            if request.POST['topics-paymentstate'] != 'default':
-                paymentstatus = request.POST['topics-paymentstate']
-                larger = request.POST['topics-paymentstate-larger']
-                smaller = request.POST['topics-paymentstate-smaller']
-                if larger != '' and smaller != '':
-                    larger = int(larger)
-                    smaller = int(smaller)
-                    tmp = []
-                    for topic in topics:
-                        number = -1
-                        if paymentstatus in topic.tickets_per_payment_status():
-                            number = topic.tickets_per_payment_status()[paymentstatus]
-                        else:
-                            number = 0
-                        if number >= larger and number <= smaller:
-                            tmp.append(topic)
-                    topics = tmp
-                    del(tmp)
-                elif larger != '' and smaller == '':
-                    larger = int(larger)
-                    tmp = []
-                    for topic in topics:
-                        number = -1
-                        if paymentstatus in topic.tickets_per_payment_status():
-                            number = topic.tickets_per_payment_status()[paymentstatus]
-                        else:
-                            number = 0
-                        if number >= larger:
-                            tmp.append(topic)
-                    topics = tmp
-                    del(tmp)
-                elif larger == '' and smaller != '':
-                    smaller = int(smaller)
-                    tmp = []
-                    for topic in topics:
-                        number = -1
-                        if paymentstatus in topic.tickets_per_payment_status():
-                            number = topic.tickets_per_payment_status()[paymentstatus]
-                        else:
-                            number = 0
-                        if number <= smaller:
-                            tmp.append(topic)
-                    topics = tmp
-                    del(tmp)
-            response = HttpResponseCsv(['name', 'grant', 'open_for_new_tickets', 'media', 'expenses', 'preexpenses', 'description', 'form_description', 'admins'])
-            response['Content-Disposition'] = 'attachment; filename="exported-topics.csv"'
-            for topic in topics:
-                names = []
-                for ad in topic.admin.all():
-                    names.append(ad.username)
-                admins = ", ".join(names)
-                response.writerow([topic.name, topic.grant.full_name, topic.open_for_tickets, topic.ticket_media, topic.ticket_expenses, topic.ticket_preexpenses, topic.description, topic.form_description, admins])
-            return response
-        elif typ == 'user':
-            if request.user.is_authenticated:
-                if request.user.is_staff:
-                    users = TrackerProfile.objects.all()
-                    larger = request.POST['users-created-larger']
-                    smaller = request.POST['users-created-smaller']
-                    if larger != '' and smaller != '':
-                        larger = int(larger)
-                        smaller = int(smaller)
-                        tmp = []
-                        for user in users:
-                            real = user.count_ticket_created()
-                            if real >= larger and real <= smaller:
-                                tmp.append(user)
-                        users = tmp
-                        del(tmp)
-                    elif larger != '' and smaller == '':
-                        larger = int(larger)
-                        tmp = []
-                        for user in users:
-                            real = user.count_ticket_created()
-                            if real >= larger:
-                                tmp.append(user)
-                        users = tmp
-                        del(tmp)
-                    elif larger == '' and smaller != '':
-                        smaller = int(smaller)
-                        tmp = []
-                        for user in users:
-                            real = user.count_ticket_created()
-                            if real <= smaller:
-                                tmp.append(user)
-                        users = tmp
-                        del(tmp)
-                    larger = request.POST['users-accepted-larger']
-                    smaller = request.POST['users-accepted-smaller']
-                    if larger != '' and smaller != '':
-                        larger = int(larger)
-                        smaller = int(smaller)
-                        tmp = []
-                        for user in users:
-                            real = user.accepted_expeditures()
-                            if real >= larger and real <= smaller:
-                                tmp.append(user)
-                        users = tmp
-                        del(tmp)
-                    elif larger != '' and smaller == '':
-                        larger = int(larger)
-                        tmp = []
-                        for user in users:
-                            real = user.accepted_expeditures()
-                            if real >= larger:
-                                tmp.append(user)
-                        users = tmp
-                        del(tmp)
-                    elif larger == '' and smaller != '':
-                        smaller = int(smaller)
-                        tmp = []
-                        for user in users:
-                            real = user.accepted_expeditures()
-                            if real <= smaller:
-                                tmp.append(user)
-                        users = tmp
-                        del(tmp)
-
-                    larger = request.POST['users-paid-larger']
-                    smaller = request.POST['users-paid-larger']
-                    if larger != '' and smaller != '':
-                        larger = int(larger)
-                        smaller = int(larger)
-                        tmp = []
-                        for user in users:
-                            real = user.paid_expeditures()
-                            if real >= larger and real <= smaller:
-                                tmp.append(user)
-                        users = tmp
-                        del(tmp)
-                    elif larger != '' and smaller == '':
-                        larger = int(larger)
-                        tmp = []
-                        for user in users:
-                            real = user.paid_expeditures()
-                            if real >= larger:
-                                tmp.append(user)
-                        users = tmp
-                        del(tmp)
-                    elif larger == '' and smaller != '':
-                        smaller = int(smaller)
-                        tmp = []
-                        for user in users:
-                            real = user.paid_expeditures()
-                            if real <= smaller:
-                                tmp.append(user)
-                            users = tmp
-                            del(tmp)
-
-                    if 'user-permision' in request.POST:
-                        priv = request.POST['user-permision']
-                        tmp = []
-                        if priv == 'normal':
-                            for user in users:
-                                if not user.user.is_staff and not user.user.is_superuser:
-                                    tmp.append(user)
-                        elif priv == 'staff':
-                            for user in users:
-                                if user.user.is_staff:
-                                    tmp.append(user)
-                        elif priv == 'superuser':
-                            for user in users:
-                                if user.user.is_superuser:
-                                    tmp.append(user)
-                        else:
-                            return HttpResponseBadRequest('You must fill the form validly')
-                        users = tmp
-                        del(tmp)
-
-                    response = HttpResponseCsv(['id', 'username', 'first_name', 'last_name', 'email', 'is_active', 'is_staff', 'is_superuser', 'last_login', 'date_joined', 'created_tickets', 'accepted_expeditures', 'paid_expeditures', 'bank_account', 'other_contact', 'other_identification'])
-                    response['Content-Disposition'] = 'attachment; filename="exported-users.csv"'
-                    for user in users:
-                        response.writerow([user.user.id, user.user.username, user.user.first_name, user.user.last_name, user.user.email, user.user.is_active, user.user.is_staff, user.user.is_superuser, user.user.last_login, user.user.date_joined, user.count_ticket_created(), user.accepted_expeditures(), user.paid_expeditures(), user.bank_account, user.other_contact, user.bank_account])
-                    return response
-            raise PermissionDenied(_('You must be staffer in order to export users'))
+        exporter = EXPORTERS.get(request.POST.get('type'))
+        if exporter is not None:
+            try:
+                return exporter(request)
+            except ValueError:
+                pass  # a bound is not a number
 
         return HttpResponseBadRequest(_('You must fill the form validly'))
     else:
@@ -1530,160 +1407,30 @@ def export(request):
 
 @login_required
 def importcsv(request):
-    if request.method == 'POST' and not request.FILES['csvfile']:
+    if request.method == 'POST' and not request.FILES.get('csvfile'):
         return render(request, 'tracker/import.html')
-    elif request.method == 'POST' and request.FILES['csvfile']:
+    elif request.method == 'POST':
+        importer_class = IMPORTERS.get(request.POST.get('type'))
+        if importer_class is None:
+            messages.error(request, _('The form has returned strange values. Please contact the systemadmin and tell him what you tried to do.'))
+            return render(request, 'tracker/import.html', {})
+        importer = importer_class(request.user)
+        importer.check_permission()
+
         import_limit = settings.MAX_NUMBER_OF_ROWS_ON_IMPORT
-        import_unlimited = not import_limit
-        too_much_rows_message = _('You do not have permission to import more than %(input_row_limit)s rows. First %(input_row_limit)s rows have already been imported.') % {'input_row_limit': str(import_limit)}
-        imported = 0
+        if not import_limit or request.user.has_perm('tracker.import_unlimited_rows'):
+            import_limit = None
         csvfile = TextIOWrapper(request.FILES['csvfile'].file, encoding=request.encoding)
-        header = None
         with csvfile:
-            reader = csv.reader(csvfile, delimiter=';', quotechar='"')
-            header = next(reader)
-            imported = 0
-            if request.POST['type'] == 'ticket':
-                for line in reader:
-                    imported += 1
-                    if (imported > import_limit and not import_unlimited) and not request.user.has_perm('tracker.import_unlimited_rows'):
-                        messages.warning(request, too_much_rows_message)
-                        break
-                    event_date = line[header.index('event_date')]
-                    if event_date == "None":
-                        event_date = None
-                    name = line[header.index('name')]
-                    topic = Topic.objects.filter(name=line[header.index('topic')])[0]
-                    event_url = line[header.index('event_url')]
-                    description = line[header.index('description')]
-                    deposit = float(line[header.index('deposit')])
-                    ticket = Ticket.objects.create(event_date=event_date, name=name, topic=topic, event_url=event_url, description=description, deposit=deposit)
-                    ticket.requested_user = request.user
-                    ticket.save()
-            elif request.POST['type'] == 'topic':
-                if not request.user.is_staff:
-                    raise PermissionDenied(_('You must be a staffer in order to be able to import topics.'))
-                for line in reader:
-                    imported += 1
-                    if (imported > import_limit and not import_unlimited) and not request.user.has_perm('tracker.import_unlimited_rows'):
-                        messages.warning(request, too_much_rows_message)
-                        break
-                    name = line[header.index('name')]
-                    grant = Grant.objects.get(full_name=line[header.index('grant')]).id
-                    new_tickets = line[header.index('open_for_new_tickets')]
-                    if new_tickets == "False":
-                        new_tickets = False
-                    else:
-                        new_tickets = True
-                    media = line[header.index('media')]
-                    if media == "False":
-                        media = False
-                    else:
-                        media = True
-                    preexpenses = line[header.index('preexpenses')]
-                    if preexpenses == "False":
-                        preexpenses = False
-                    else:
-                        preexpenses = True
-                    expenses = line[header.index('expenses')]
-                    if expenses == "False":
-                        expenses = False
-                    else:
-                        expenses = True
-                    description = line[header.index('description')]
-                    form_description = line[header.index('form_description')]
-                    Topic.objects.create(name=name, grant_id=grant, open_for_tickets=new_tickets, ticket_media=media, ticket_preexpenses=preexpenses, ticket_expenses=expenses, description=description, form_description=form_description)
-            elif request.POST['type'] == 'grant':
-                if not request.user.is_staff:
-                    raise PermissionDenied(_('You must be a staffer in order to be able to import grants.'))
-                for line in reader:
-                    imported += 1
-                    if (imported > import_limit and not import_unlimited) and not request.user.has_perm('tracker.import_unlimited_rows'):
-                        messages.warning(request, too_much_rows_message)
-                        break
-                    full_name = line[header.index('full_name')]
-                    short_name = line[header.index('short_name')]
-                    slug = line[header.index('slug')]
-                    description = line[header.index('description')]
-                    Grant.objects.create(full_name=full_name, short_name=short_name, slug=slug, description=description)
-            elif request.POST['type'] == 'expense':
-                for line in reader:
-                    imported += 1
-                    if (imported > import_limit and not import_unlimited) and not request.user.has_perm('tracker.import_unlimited_rows'):
-                        messages.warning(request, too_much_rows_message)
-                        break
-                    ticket = Ticket.objects.get(id=line[header.index('ticket_id')])
-                    description = line[header.index('description')]
-                    amount = line[header.index('amount')]
-                    wage = line[header.index('wage')]
-                    if request.user.is_staff:
-                        accounting_info = line[header.index('accounting_info')]
-                        paid = line[header.index('paid')]
-                    else:
-                        accounting_info = ''
-                        paid = False
-                    if ticket.can_edit(request.user) or request.user.is_staff:
-                        Expediture.objects.create(ticket=ticket, description=description, amount=amount, wage=wage, accounting_info=accounting_info, paid=paid)
-                    else:
-                        raise PermissionDenied(_("You can't add preexpenses to a ticket that you did not create."))
-            elif request.POST['type'] == 'preexpense':
-                for line in reader:
-                    imported += 1
-                    if (imported > import_limit and not import_unlimited) and not request.user.has_perm('tracker.import_unlimited_rows'):
-                        messages.warning(request, too_much_rows_message)
-                        break
-                    ticket = Ticket.objects.get(id=line[header.index('ticket_id')])
-                    description = line[header.index('description')]
-                    amount = line[header.index('amount')]
-                    wage = line[header.index('wage')]
-                    if ticket.can_edit(request.user) or request.user.is_staff:
-                        Preexpediture.objects.create(ticket=ticket, description=description, amount=amount, wage=wage)
-                    else:
-                        raise PermissionDenied(_("You can't add preexpenses to a ticket that you did not create."))
-            elif request.POST['type'] == 'media':
-                for line in reader:
-                    imported += 1
-                    if (imported > import_limit and not import_unlimited) and not request.user.has_perm('tracker.import_unlimited_rows'):
-                        messages.warning(request, too_much_rows_message)
-                        break
-                    ticket = Ticket.objects.get(id=line[header.index('ticket_id')])
-                    if ticket.can_edit(request.user) or request.user.is_staff:
-                        name = line[header.index('name')]
-
-                        mw = MediaWiki(user=None)
-                        data = mw.request({
-                            "action": "query",
-                            "format": "json",
-                            "titles": name
-                        }).json()
-                        page_id = int(list(data['query']['pages'].keys())[0])
-                        MediaInfo.objects.create(ticket=ticket, page_id=page_id)
-
-                        ticket.save()
-                    else:
-                        raise PermissionDenied(_("You can't add media items to a ticket that you did not create."))
-            elif request.POST['type'] == 'user':
-                if not request.user.is_superuser:
-                    raise PermissionDenied(_('You must be a superuser in order to be able to import users.'))
-                for line in reader:
-                    username = line[header.index('username')]
-                    password = line[header.index('password')]
-                    first_name = line[header.index('first_name')]
-                    last_name = line[header.index('last_name')]
-                    is_superuser = line[header.index('is_superuser')]
-                    is_staff = line[header.index('is_staff')]
-                    is_active = line[header.index('is_active')]
-                    email = line[header.index('email')]
-                    user = User.objects.create_user(username=username, password=password, email=email)
-                    user.first_name = first_name
-                    user.last_name = last_name
-                    user.is_superuser = is_superuser
-                    user.is_staff = is_staff
-                    user.is_active = is_active
-                    user.save()
-            else:
-                messages.error(request, _('The form has returned strange values. Please contact the systemadmin and tell him what you tried to do.'))
-                return render(request, 'tracker/import.html', {})
+            result = importer.run(csvfile, import_limit)
+
+        if result.errors:
+            return render(request, 'tracker/import.html', {
+                'MAX_NUMBER_OF_ROWS_ON_IMPORT': settings.MAX_NUMBER_OF_ROWS_ON_IMPORT,
+                'errors': result.errors,
+            })
+        if result.truncated:
+            messages.warning(request, _('You do not have permission to import more than %(input_row_limit)s rows. First %(input_row_limit)s rows have already been imported.') % {'input_row_limit': str(import_limit)})
         messages.success(request, _('Your CSV file was imported.'))
         return HttpResponseRedirect(reverse('index'))
     else:
@@ -1795,7 +1542,7 @@ def show_media(request, ticket_id):
 @login_required
 def update_media(request, ticket_id):
     ticket = get_object_or_404(Ticket, id=ticket_id)  # this is here to ensure 404 when ticket doesn't exist
-    Ticket.update_media(ticket.id)
+    schedule_ticket_job(Ticket.update_media, ticket.id)
     messages.success(request, _('Updating of medias for this ticket was successfully scheduled.'))
     return HttpResponseRedirect(reverse('show_media', kwargs={"ticket_id": ticket_id}))
 